@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+
+from lsst.log import Log
+from lsst.meas.extensions.astrometryNet import AstrometryNetDataConfig
+from lsst.meas.extensions.astrometryNet.multiindex import getConfigFromEnvironment
+from lsst.meas.extensions.astrometryNet.catalogBenchmark import benchmarkCatalog, compareToBaseline
+
+parser = argparse.ArgumentParser(description="Benchmark the construction of synthetic astrometry.net "
+                                 "catalogs, with and without the cache")
+parser.add_argument("--template", default=None,
+                    help="andConfig.py whose first multi-index is the template for every shard "
+                    "(default: that of the setup astrometry_net_data)")
+parser.add_argument("--shards", type=int, nargs="+", default=[10, 1000, 10000],
+                    help="Numbers of shards in the synthetic catalogs")
+parser.add_argument("--repeat", type=int, default=3, help="Number of times to repeat each measurement")
+parser.add_argument("--timeout", type=float, default=600.0,
+                    help="Maximum time (sec) for each measurement")
+parser.add_argument("--workDir", default=None,
+                    help="Directory in which to make the synthetic catalogs (default: temporary)")
+parser.add_argument("--output", default=None, help="JSON file to which to write the results")
+parser.add_argument("--baseline", default=None, help="JSON file of baseline results to compare against")
+parser.add_argument("--timeFactor", type=float, default=2.0,
+                    help="Maximum allowed ratio of time taken to the baseline")
+parser.add_argument("--rssFactor", type=float, default=1.5,
+                    help="Maximum allowed ratio of peak RSS to the baseline")
+parser.add_argument("--fdMargin", type=int, default=10,
+                    help="Maximum allowed increase in the number of file descriptors over the baseline")
+args = parser.parse_args()
+
+if args.template is None:
+    template = getConfigFromEnvironment()
+else:
+    template = AstrometryNetDataConfig()
+    template.load(args.template)
+
+workDir = args.workDir if args.workDir is not None else tempfile.mkdtemp()
+try:
+    results = benchmarkCatalog(template, args.shards, workDir, repeat=args.repeat,
+                               timeout=args.timeout, log=Log.getDefaultLogger())
+finally:
+    if args.workDir is None:
+        shutil.rmtree(workDir)
+
+if args.output is not None:
+    with open(args.output, "w") as outFile:
+        json.dump(results, outFile, indent=2, sort_keys=True)
+else:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+if args.baseline is not None:
+    with open(args.baseline) as inFile:
+        baseline = json.load(inFile)
+    regressions = compareToBaseline(results, baseline, timeFactor=args.timeFactor,
+                                    rssFactor=args.rssFactor, fdMargin=args.fdMargin)
+    for regression in regressions:
+        print("REGRESSION: " + regression)
+    if regressions:
+        sys.exit(1)
@@ -1,3 +1,10 @@
 #!/usr/bin/env python
-from lsst.meas.extensions.astromNet.multiindex import generateCache
-generateCache()
+import argparse
+
+from lsst.meas.extensions.astrometryNet.multiindex import generateCache
+
+parser = argparse.ArgumentParser(description="Generate the cache file for the setup astrometry_net_data")
+parser.add_argument("-j", "--processes", type=int, default=1,
+                    help="Number of processes to use when reading the index files")
+args = parser.parse_args()
+generateCache(processes=args.processes)
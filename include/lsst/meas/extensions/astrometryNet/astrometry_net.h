@@ -99,6 +99,15 @@ public:
      */
     void reload();
 
+    /**
+     * Close the files held open by the indices and the star tag-along table
+     *
+     * The loaded data are memory-mapped, so remain available (and are shared
+     * with processes forked afterwards) without the files; the tag-along table
+     * is reopened when next required.
+     */
+    void closeFiles();
+
 private:
     
     struct _Deleter {
@@ -137,6 +146,17 @@ public:
     @param[in] starGalCol  name of "starGal" column (true if object is a star) in astrometry.net data
     @param[in] varCol  name of "var" column (true if brightness is variable) in astrometry.net data
     @param[in] uniqueIds  if true then only return unique IDs (the first of each seen)
+    @param[in] magLimitFilterList  names of filters (in filterNameList) whose magnitudes are limited
+    @param[in] minMagList  minimum (brightest) magnitude, one per element of magLimitFilterList
+    @param[in] maxMagList  maximum (faintest) magnitude, one per element of magLimitFilterList
+    @param[in] photometricOnly  if true then only return objects that are photometric
+    @param[in] excludeResolved  if true then do not return objects that are resolved
+    @param[in] excludeVariable  if true then do not return objects that are variable
+    @param[in] numThreads  number of threads with which to search the star kd-trees and read their
+        tag-along data; the objects returned, and their order, do not depend on the number
+
+    The magnitude limits and flags are evaluated on the tag-along data before records are made,
+    so objects that fail them cost no memory; objects with NaN magnitudes fail magnitude limits.
 
     Returned schema:
     - id
@@ -144,8 +164,8 @@ public:
     - centroid: centroid on some exposure, if relevant (an lsst::afw::geom::Point2D);
         returned value is not set
     - hasCentroid: if true then centroid has been set; returned value is false
-    - *filterName*_flux: flux in the specified filter (double)
-    - *filterName*_fluxErr: flux uncertainty in the specified filter (double)
+    - *filterName*_flux: flux in the specified filter (double, nJy)
+    - *filterName*_fluxErr: flux uncertainty in the specified filter (double, nJy)
     - resolved (if starGalCol specified): true if object is not resolved
     - variable (if varCol specified): true if brightness is variable
     - photometric: true if not resolved (or starGalCol blank) and not variable (or varCol blank);
@@ -161,7 +181,124 @@ public:
         std::vector<std::string> const& magErrColList,
         const char* starGalCol,
         const char* varCol,
-        bool uniqueIds=true);
+        bool uniqueIds=true,
+        std::vector<std::string> const& magLimitFilterList=std::vector<std::string>(),
+        std::vector<double> const& minMagList=std::vector<double>(),
+        std::vector<double> const& maxMagList=std::vector<double>(),
+        bool photometricOnly=false,
+        bool excludeResolved=false,
+        bool excludeVariable=false,
+        int numThreads=1);
+
+    /**
+    Load reference objects in many regions of the sky, each described by a center coordinate and a radius
+
+    The star kd-trees are searched for all the regions together, and each tag-along row is read
+    at most once, which is cheaper than calling getCatalog for each region when the regions share
+    star kd-trees (e.g., the CCDs of a visit).  Star kd-trees are only searched for regions
+    within range of their healpix.
+
+    @param[in] inds  list of star kd-trees from astrometry.net
+    @param[in] ctrCoordList  centers of search regions
+    @param[in] radiusList  search radii, one per center
+    @param[in] idCol  name of ID column in astrometry.net data
+    @param[in] filterNameList  names of filters in astrometry.net data
+    @param[in] magColList  names of magnitude columns in astrometry.net data
+    @param[in] magErrColList  names of magnitude uncertainty (sigma) columns in astrometry.net data
+    @param[in] starGalCol  name of "starGal" column (true if object is a star) in astrometry.net data
+    @param[in] varCol  name of "var" column (true if brightness is variable) in astrometry.net data
+    @param[in] uniqueIds  if true then only return unique IDs (the first of each seen) in each catalog
+    @param[in] magLimitFilterList  names of filters (in filterNameList) whose magnitudes are limited
+    @param[in] minMagList  minimum (brightest) magnitude, one per element of magLimitFilterList
+    @param[in] maxMagList  maximum (faintest) magnitude, one per element of magLimitFilterList
+    @param[in] photometricOnly  if true then only return objects that are photometric
+    @param[in] excludeResolved  if true then do not return objects that are resolved
+    @param[in] excludeVariable  if true then do not return objects that are variable
+    @param[in] numThreads  number of threads with which to search the star kd-trees and read their
+        tag-along data; the objects returned, and their order, do not depend on the number
+
+    @return one catalog per region, each with the schema documented for getCatalog
+    */
+    std::vector<lsst::afw::table::SimpleCatalog> getCatalogs(
+        std::vector<index_t*> inds,
+        std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+        std::vector<lsst::afw::geom::Angle> const &radiusList,
+        const char* idCol,
+        std::vector<std::string> const& filterNameList,
+        std::vector<std::string> const& magColList,
+        std::vector<std::string> const& magErrColList,
+        const char* starGalCol,
+        const char* varCol,
+        bool uniqueIds=true,
+        std::vector<std::string> const& magLimitFilterList=std::vector<std::string>(),
+        std::vector<double> const& minMagList=std::vector<double>(),
+        std::vector<double> const& maxMagList=std::vector<double>(),
+        bool photometricOnly=false,
+        bool excludeResolved=false,
+        bool excludeVariable=false,
+        int numThreads=1);
+
+    /**
+    Load reference objects in many convex polygons on the sky (e.g., the footprints of CCDs)
+
+    Each star kd-tree is searched in a circle enclosing each polygon, and the stars outside
+    the polygon are dropped before the tag-along data are read, so objects outside the polygons
+    cost no I/O or memory.  The other arguments are those of getCatalogs.
+
+    @param[in] inds  list of star kd-trees from astrometry.net
+    @param[in] polygonList  vertices of each polygon, in order around the polygon; the edges
+        are great circles
+    @param[in] margin  objects within this angle outside the edges of a polygon are also returned
+
+    @return one catalog per polygon, each with the schema documented for getCatalog
+
+    @throw lsst::pex::exceptions::InvalidParameterError if a polygon is not convex
+    */
+    std::vector<lsst::afw::table::SimpleCatalog> getPolygonCatalogs(
+        std::vector<index_t*> inds,
+        std::vector<std::vector<lsst::afw::geom::SpherePoint> > const& polygonList,
+        lsst::afw::geom::Angle const& margin,
+        const char* idCol,
+        std::vector<std::string> const& filterNameList,
+        std::vector<std::string> const& magColList,
+        std::vector<std::string> const& magErrColList,
+        const char* starGalCol,
+        const char* varCol,
+        bool uniqueIds=true,
+        std::vector<std::string> const& magLimitFilterList=std::vector<std::string>(),
+        std::vector<double> const& minMagList=std::vector<double>(),
+        std::vector<double> const& maxMagList=std::vector<double>(),
+        bool photometricOnly=false,
+        bool excludeResolved=false,
+        bool excludeVariable=false,
+        int numThreads=1);
+
+    /**
+    Load reference objects in many regions of the sky, in columns rather than catalogs
+
+    The arguments and objects are those of getCatalogs, but no records are made; use
+    detail::makeCatalogFromColumns to convert the columns to a catalog if records are needed.
+
+    @return one set of columns per region
+    */
+    std::vector<detail::RefObjColumns> getColumns(
+        std::vector<index_t*> inds,
+        std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+        std::vector<lsst::afw::geom::Angle> const &radiusList,
+        const char* idCol,
+        std::vector<std::string> const& filterNameList,
+        std::vector<std::string> const& magColList,
+        std::vector<std::string> const& magErrColList,
+        const char* starGalCol,
+        const char* varCol,
+        bool uniqueIds=true,
+        std::vector<std::string> const& magLimitFilterList=std::vector<std::string>(),
+        std::vector<double> const& minMagList=std::vector<double>(),
+        std::vector<double> const& maxMagList=std::vector<double>(),
+        bool photometricOnly=false,
+        bool excludeResolved=false,
+        bool excludeVariable=false,
+        int numThreads=1);
 
     std::shared_ptr<lsst::daf::base::PropertyList> getSolveStats() const;
 
@@ -233,4 +370,61 @@ private:
  */
 lsst::afw::geom::Angle healpixDistance(int hp, int nside, lsst::afw::geom::SpherePoint const& coord);
 
+/**
+ * Calculate the distances from many coordinates to many healpixes
+ *
+ * This is equivalent to calling healpixDistance for each pair of healpix and
+ * coordinates, except that a negative healpix number (a catalog without a
+ * healpix) is taken to be at zero distance from everything.
+ *
+ * @param[in] hp  healpix numbers, length numHealpix
+ * @param[in] nside  healpix nsides, length numHealpix
+ * @param[in] numHealpix  number of healpixes
+ * @param[in] ra  ICRS right ascension of each centre (degrees), length numCoord
+ * @param[in] dec  ICRS declination of each centre (degrees), length numCoord
+ * @param[in] numCoord  number of centres
+ * @param[out] distances  distance (radians) from each centre to each healpix,
+ *    as a row-major array with numCoord rows and numHealpix columns
+ */
+void healpixDistances(int const* hp, int const* nside, std::size_t numHealpix,
+                      double const* ra, double const* dec, std::size_t numCoord,
+                      double* distances);
+
+/**
+ * Find the healpixes within range of coordinates
+ *
+ * A healpix is returned if and only if healpixDistance(hp, nside, coord) <= radius,
+ * but only the healpixes neighbouring the search region are visited.
+ *
+ * @param[in] coord  ICRS center of search region
+ * @param[in] radius  search radius
+ * @param[in] nside  healpix nside
+ * @return healpix numbers within range, in increasing order
+ */
+std::vector<int> healpixRangeSearch(lsst::afw::geom::SpherePoint const& coord,
+                                    lsst::afw::geom::Angle const& radius, int nside);
+
+/**
+ * Find the healpix containing each of many coordinates
+ *
+ * @param[in] ra  right ascension (deg) of coordinates, length numCoord
+ * @param[in] dec  declination (deg) of coordinates, length numCoord
+ * @param[in] numCoord  number of coordinates
+ * @param[in] nside  healpix nside
+ * @param[out] hp  healpix number containing each coordinate, length numCoord
+ */
+void healpixIndices(double const* ra, double const* dec, std::size_t numCoord, int nside, int* hp);
+
+/**
+ * Get a circle enclosing a healpix
+ *
+ * The circle is centred on the centre of the healpix, and the radius includes a
+ * small margin beyond the furthest point on the boundary of the healpix.
+ *
+ * @param[in] hp  healpix number
+ * @param[in] nside  healpix nside
+ * @return centre and radius of the circle
+ */
+std::pair<lsst::afw::geom::SpherePoint, lsst::afw::geom::Angle> healpixBoundingCircle(int hp, int nside);
+
 }}}}  // namespace lsst::meas::extensions::astrometryNet
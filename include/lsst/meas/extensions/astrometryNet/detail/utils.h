@@ -1,6 +1,8 @@
 #ifndef LSST_MEAS_EXTENSIONS_ASTROMETRYNET_UTILS_H
 #define LSST_MEAS_EXTENSIONS_ASTROMETRYNET_UTILS_H
 
+#include <array>
+#include <cstdint>
 #include <string>
 #include <vector>
 
@@ -24,6 +26,135 @@ namespace detail {
         }
     };
 
+    /// Limits on the magnitude of reference objects in one filter
+    struct MagLimit {
+        std::string filterName; ///< name of filter (as in MagColInfo)
+        double minMag;          ///< minimum (brightest) magnitude
+        double maxMag;          ///< maximum (faintest) magnitude
+    };
+
+    /// Criteria reference objects must satisfy to be returned; by default all are returned
+    struct RefObjFilter {
+        std::vector<MagLimit> magLimits; ///< magnitude limits; objects with NaN magnitudes fail
+        bool photometricOnly = false;    ///< only return objects that are photometric?
+        bool excludeResolved = false;    ///< do not return objects that are resolved?
+        bool excludeVariable = false;    ///< do not return objects that are variable?
+
+        bool isTrivial() const {
+            return magLimits.empty() && !photometricOnly && !excludeResolved && !excludeVariable;
+        }
+    };
+
+    /**
+    Reference objects in columns: one contiguous array per field, with one element per object
+
+    The fields are those of the catalogs returned by getCatalogImpl, in the same units.
+    */
+    struct RefObjColumns {
+        std::vector<MagColInfo> magColInfoList;  ///< magnitude columns read
+        bool hasId = false;        ///< were IDs read (else id is empty)?
+        bool hasResolved = false;  ///< was the "starGal" column read (else resolved is empty)?
+        bool hasVariable = false;  ///< was the "var" column read (else variable is empty)?
+
+        std::vector<double> ra;    ///< ICRS right ascension (radians)
+        std::vector<double> dec;   ///< ICRS declination (radians)
+        std::vector<std::int64_t> id;
+        std::vector<std::vector<double> > flux;     ///< flux for each element of magColInfoList
+        std::vector<std::vector<double> > fluxErr;  ///< flux error for each element with hasErr()
+        std::vector<std::uint8_t> resolved;
+        std::vector<std::uint8_t> variable;
+        std::vector<std::uint8_t> photometric;
+
+        std::size_t size() const {
+            return ra.size();
+        }
+    };
+
+
+/**
+A convex polygon on the sky, with great-circle edges
+
+Used to select reference objects in a region (e.g., the footprint of a CCD) more closely
+than by its bounding circle.
+*/
+class SkyPolygon {
+public:
+    /**
+    Construct a SkyPolygon
+
+    @param[in] vertices  vertices, in order around the polygon (in either direction); at least 3
+    @param[in] margin  points within this angle outside an edge are also contained
+
+    @throw lsst::pex::exceptions::InvalidParameterError if there are fewer than 3 vertices,
+        or the polygon is not convex
+    */
+    explicit SkyPolygon(std::vector<lsst::afw::geom::SpherePoint> const& vertices,
+                        lsst::afw::geom::Angle const& margin=lsst::afw::geom::Angle(0.0));
+
+    /// Is a point, given as a unit vector, inside the polygon (allowing for the margin)?
+    bool contains(double const* xyz) const {
+        for (auto const& normal : _normals) {
+            if (normal[0]*xyz[0] + normal[1]*xyz[1] + normal[2]*xyz[2] < _minDot) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    /// Center of a circle enclosing the polygon (including the margin)
+    lsst::afw::geom::SpherePoint const& getCenter() const { return _center; }
+
+    /// Radius of a circle enclosing the polygon (including the margin)
+    lsst::afw::geom::Angle getRadius() const { return _radius; }
+
+private:
+    std::vector<std::array<double, 3> > _normals;  ///< inward unit normal of each edge
+    double _minDot;  ///< minimum dot product of a contained point with each normal
+    lsst::afw::geom::SpherePoint _center;
+    lsst::afw::geom::Angle _radius;
+};
+
+/// Close a file opened by astrometry.net, if it is open
+inline void closeFile(FILE* & fid) {
+    if (fid) {
+        if (fclose(fid)) {
+            std::cerr << "Error closing an astrometry_net_data quadfile" << std::endl;
+        }
+        fid = NULL;
+    }
+}
+
+/// Close the file backing a kd-tree read by astrometry.net, if it is open
+inline void closeKdtreeFile(kdtree_t* tree) {
+    if (tree && tree->io) {
+        closeFile(reinterpret_cast<kdtree_fits_t*>(tree->io)->fid);
+    }
+}
+
+/// Close the files held open by an astrometry.net index
+///
+/// The index data are memory-mapped, so remain available after the files are closed.
+inline void closeIndexFiles(index_t* index) {
+    // Change once astrometry.net-0.40+ is in...
+    /*
+      if (index_close_fds(ind)) {
+      throw LSST_EXCEPT(lsst::pex::exceptions::IoError,
+      "Failed to index_close_fds() an astrometry_net_data file");
+      }
+    */
+    if (index->quads && index->quads->fb) {
+        closeFile(index->quads->fb->fid);
+    }
+    if (index->codekd) {
+        closeKdtreeFile(index->codekd->tree);
+    }
+    if (index->starkd) {
+        closeKdtreeFile(index->starkd->tree);
+        if (index->starkd->tagalong) {
+            closeFile(index->starkd->tagalong->readfid);
+        }
+    }
+}
 
 /// RAII manager for astrometry.net indices
 ///
@@ -33,33 +164,7 @@ struct IndexManager {
     index_t* index;
     IndexManager(index_t* ind) : index(ind) {}
     ~IndexManager() {
-        // Change once astrometry.net-0.40+ is in...
-        /*
-          if (index_close_fds(ind)) {
-          throw LSST_EXCEPT(lsst::pex::exceptions::IoError,
-          "Failed to index_close_fds() an astrometry_net_data file");
-          }
-        */
-        if (index->quads && index->quads->fb && index->quads->fb->fid) {
-            _close(index->quads->fb->fid);
-        }
-        if (index->codekd && index->codekd->tree && index->codekd->tree->io) {
-            _close(index->codekd->tree->io);
-        }
-        if (index->starkd && index->starkd->tree && index->starkd->tree->io) {
-            _close(index->starkd->tree->io);
-        }
-    }
-    void _close(FILE* & fid) {
-        if (fid) {
-            if (fclose(fid)) {
-                std::cerr << "Error closing an astrometry_net_data quadfile" << std::endl;
-            }
-            fid = NULL;
-        }
-    }
-    void _close(void* io) {
-        _close(reinterpret_cast<kdtree_fits_t*>(io)->fid);
+        closeIndexFiles(index);
     }
 };
 
@@ -74,14 +179,19 @@ Implementation for index_t::getCatalog method
 @param[in] starGalCol  name of "starGal" column (true if object is a star) in astrometry.net data
 @param[in] varCol  name of "var" column (true if brightness is variable) in astrometry.net data
 @param[in] uniqueIds  if true then only return unique IDs (the first of each seen)
+@param[in] refObjFilter  criteria reference objects must satisfy to be returned; evaluated on the
+    tag-along data before any record is made.  Duplicate IDs are removed before filtering,
+    so an object rejected by the filter still hides later objects with the same ID.
+@param[in] numThreads  number of threads with which to search the star kd-trees and read their
+    tag-along data; the results do not depend on the number
 
 Returned schema:
 - id
 - coord: ICRS sky position (an lsst::afw::geom::SpherePoint)
 - centroid: centroid on some exposure, if relevant (an lsst::afw::geom::Point2D); returned value is not set
 - hasCentroid: if true then centroid has been set; returned value is false
-- *filterName*_flux: flux in the specified filter (double)
-- *filterName*_fluxErr: flux uncertainty in the specified filter (double)
+- *filterName*_flux: flux in the specified filter (double, nJy)
+- *filterName*_fluxErr: flux uncertainty in the specified filter (double, nJy)
 - resolved (if starGalCol specified): true if object is not resolved
 - variable (if varCol specified): true if brightness is variable
 - photometric: true if not resolved (or starGalCol blank) and not variable (or varCol blank);
@@ -96,7 +206,88 @@ getCatalogImpl(
     std::vector<MagColInfo> const& magColInfoList,
     const char* starGalCol,
     const char* varCol,
-    bool uniqueIds=true);
+    bool uniqueIds=true,
+    RefObjFilter const& refObjFilter=RefObjFilter(),
+    int numThreads=1);
+
+/**
+Implementation for index_t::getCatalogs method: load reference objects for many cones at once
+
+Each star kd-tree is searched for every cone, and the tag-along rows for the union of
+the stars found are read once, so nearby cones (e.g., the CCDs of a visit) share the I/O.
+Each returned catalog is the same as getCatalogImpl returns for its cone.
+
+@param[in] inds  star kd-trees from astrometry.net
+@param[in] ctrCoordList  centers of search regions
+@param[in] radiusList  search radii, one per center
+@param[in] idCol  name of ID column in astrometry.net data
+@param[in] magColInfoList  list of information about magnitude columns in astrometry.net data
+@param[in] starGalCol  name of "starGal" column (true if object is a star) in astrometry.net data
+@param[in] varCol  name of "var" column (true if brightness is variable) in astrometry.net data
+@param[in] uniqueIds  if true then only return unique IDs (the first of each seen) in each catalog;
+    the IDs from earlier indexes are only checked for indexes whose stars overlap theirs (same or
+    neighbouring healpixes), while repeats within an index are always removed
+@param[in] checkRange  if true then skip searching a star kd-tree for cones out of range of its healpix
+@param[in] refObjFilter  criteria reference objects must satisfy to be returned; see getCatalogImpl
+@param[in] polygonList  regions to which to restrict the objects returned, one per cone (each inside
+    its cone), or empty to return all objects in the cones.  Objects outside the polygons are
+    dropped after the star kd-tree search, before the tag-along data are read.
+@param[in] numThreads  number of threads with which to search the star kd-trees and read their
+    tag-along data.  The star kd-trees are shared out among the threads, and the stars found are
+    merged in the order of inds, so the results do not depend on the number of threads.
+
+@return one catalog per cone, with the schema documented for getCatalogImpl
+
+@throw lsst::pex::exceptions::LengthError if ctrCoordList and radiusList differ in length,
+    or polygonList is not empty and differs in length from them
+@throw lsst::pex::exceptions::InvalidParameterError if refObjFilter has magnitude limits
+    for a filter not in magColInfoList
+*/
+std::vector<lsst::afw::table::SimpleCatalog>
+getCatalogsImpl(
+    std::vector<index_t*> inds,
+    std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+    std::vector<lsst::afw::geom::Angle> const &radiusList,
+    const char* idCol,
+    std::vector<MagColInfo> const& magColInfoList,
+    const char* starGalCol,
+    const char* varCol,
+    bool uniqueIds=true,
+    bool checkRange=true,
+    RefObjFilter const& refObjFilter=RefObjFilter(),
+    std::vector<SkyPolygon> const& polygonList=std::vector<SkyPolygon>(),
+    int numThreads=1);
+
+/**
+Implementation for index_t::getColumns method: load reference objects for many cones, in columns
+
+This is getCatalogsImpl without making records; the arguments are the same.
+
+@return one set of columns per cone, containing the objects getCatalogsImpl returns, in the same order
+*/
+std::vector<RefObjColumns>
+getColumnsImpl(
+    std::vector<index_t*> inds,
+    std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+    std::vector<lsst::afw::geom::Angle> const &radiusList,
+    const char* idCol,
+    std::vector<MagColInfo> const& magColInfoList,
+    const char* starGalCol,
+    const char* varCol,
+    bool uniqueIds=true,
+    bool checkRange=true,
+    RefObjFilter const& refObjFilter=RefObjFilter(),
+    std::vector<SkyPolygon> const& polygonList=std::vector<SkyPolygon>(),
+    int numThreads=1);
+
+/**
+Make a catalog from reference objects in columns
+
+@param[in] columns  reference objects in columns
+
+@return catalog with the schema documented for getCatalogImpl
+*/
+lsst::afw::table::SimpleCatalog makeCatalogFromColumns(RefObjColumns const& columns);
 
 }}}}}  // lsst::meas::extensions::astrometryNet::detail
 
@@ -416,7 +416,7 @@ class ANetAstrometryTask(pipeBase.Task):
                 for i in range(self.config.rejectIter):
                     wcs, scatter = fitWcs(wcs, title="Iteration %d" % i)
 
-                    ref = np.array([wcs.skyToPixel(m.first.getCoord()) for m in matches])
+                    ref = np.array(wcs.skyToPixel([m.first.getCoord() for m in matches]))
                     src = np.array([m.second.getCentroid() for m in matches])
                     diff = ref - src
                     rms = diff.std()
@@ -925,25 +925,26 @@ class ANetBasicAstrometryTask(pipeBase.Task):
             multiInds = self.refObjLoader.multiInds
         qlo, qhi = solver.getQuadSizeRangeArcsec()
 
-        toload_multiInds = set()
+        # Select the indices using their metadata, so only those used are loaded
+        toload_multiInds = []
         toload_inds = []
         for mi in multiInds:
             for i in range(len(mi)):
-                ind = mi[i]
-                if not ind.overlapsScaleRange(qlo, qhi):
+                if not mi.getMetadata(i).overlapsScaleRange(qlo, qhi):
                     continue
-                toload_multiInds.add(mi)
-                toload_inds.append(ind)
+                if mi not in toload_multiInds:
+                    toload_multiInds.append(mi)
+                toload_inds.append((mi, i))
 
         import lsstDebug
         if lsstDebug.Info(__name__).display:
             # Use separate context for display, since astrometry.net can segfault if we don't...
-            with LoadMultiIndexes(toload_multiInds):
+            with LoadMultiIndexes(toload_multiInds, self.refObjLoader.residencyPool):
                 displayAstrometry(refCat=self.refObjLoader.loadPixelBox(bbox, wcs, filterName).refCat,
                                   frame=lsstDebug.Info(__name__).frame, pause=lsstDebug.Info(__name__).pause)
 
-        with LoadMultiIndexes(toload_multiInds):
-            solver.addIndices(toload_inds)
+        with LoadMultiIndexes(toload_multiInds, self.refObjLoader.residencyPool):
+            solver.addIndices([mi[i] for mi, i in toload_inds])
             self.memusage('Index files loaded: ')
 
             cpulimit = self.config.maxCpuTime
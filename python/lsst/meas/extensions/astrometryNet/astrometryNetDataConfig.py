@@ -92,6 +92,11 @@ class AstrometryNetDataConfig(object):
          'if it contains a star kd-tree and the first index.'),
         ('allowCache', bool, True, None,
          'Allow use of cache for reading index file regions?'),
+        ('cacheLockTimeout', float, 600.0, None,
+         'Maximum time (sec) to wait for another process to update the cache'),
+        ('cacheDir', str, None, None,
+         'Directory for the cache; if None, use $ASTROMETRY_NET_CACHE_DIR, the '
+         'astrometry_net_data directory if writable, or the per-user cache directory'),
     ]
 
     def load(self, fn):
@@ -21,10 +21,18 @@ extern "C" {
 #undef debug
 }
 
+#include <algorithm>
+#include <atomic>
+#include <cstring>
+#include <deque>
+#include <memory>
+#include <mutex>
 #include <string>
 #include <sstream>
+#include <vector>
 
 #include "pybind11/pybind11.h"
+#include "pybind11/numpy.h"
 #include "pybind11/stl.h"
 
 #include "lsst/log/Log.h"
@@ -40,6 +48,112 @@ namespace extensions {
 namespace astrometryNet {
 namespace {
 
+// declare logging functions for use by the Python
+
+LOG_LOGGER an_log = LOG_GET("meas.astrom.astrometry_net");
+
+/*
+ * Messages logged by astrometry.net are passed to lsst.log, whose appenders may call Python.
+ *
+ * astrometry.net may log from any thread: a thread running a call that has released the GIL,
+ * or a worker thread started by such a call.  Waiting for the GIL in the log callback could
+ * deadlock (e.g., if the thread holding the GIL is waiting for that thread), so messages are
+ * queued, and the queue is flushed by a thread that holds the GIL: by the log callback when
+ * no call has released the GIL, and by ReleaseGil when each call returns.
+ */
+
+/// A message logged by astrometry.net
+struct AnLogMessage {
+    int level;
+    std::string file;
+    std::string func;
+    int line;
+    std::string msg;
+};
+
+std::mutex an_log_mutex;                 // protects an_log_queue
+std::deque<AnLogMessage> an_log_queue;  // messages not yet passed to lsst.log
+std::atomic<int> an_log_num_released(0);  // number of calls that have released the GIL
+
+/// Pass the queued messages to lsst.log; must be called with the GIL held
+void an_log_flush() {
+    std::deque<AnLogMessage> messages;
+    {
+        std::lock_guard<std::mutex> lock(an_log_mutex);
+        messages.swap(an_log_queue);
+    }
+    for (auto const& message : messages) {
+        // not using the LOGS macro because the original location info is wanted
+        an_log.logMsg(log4cxx::Level::toLevel(message.level),
+                      log4cxx::spi::LocationInfo(message.file.c_str(), message.func.c_str(), message.line),
+                      message.msg);
+    }
+}
+
+/**
+ * Call guard releasing the GIL for the duration of a call, after which queued log messages are flushed
+ *
+ * The objects used by the call must not be used by other threads while it runs.
+ */
+class ReleaseGil {
+public:
+    ReleaseGil() : _release() {
+        ++an_log_num_released;
+        _release.reset(new py::gil_scoped_release());
+    }
+
+    ~ReleaseGil() {
+        _release.reset();  // reacquire the GIL
+        --an_log_num_released;
+        an_log_flush();
+    }
+
+private:
+    std::unique_ptr<py::gil_scoped_release> _release;
+};
+
+void an_log_callback(void* baton, enum log_level level, const char* file, int line, const char* func,
+                     const char* format, va_list va) {
+    // translate between logging levels
+    int levelmap[5];
+    levelmap[LOG_NONE] = LOG_LVL_FATAL;
+    levelmap[LOG_ERROR] = LOG_LVL_FATAL;
+    levelmap[LOG_MSG] = LOG_LVL_INFO;
+    levelmap[LOG_VERB] = LOG_LVL_DEBUG;
+    levelmap[LOG_ALL] = LOG_LVL_DEBUG;
+    int lsstlevel = levelmap[level];
+    if (!an_log.isEnabledFor(lsstlevel)) {
+        return;
+    }
+
+    va_list vb;
+    // find out how long the formatted string will be
+    va_copy(vb, va);
+    const int len = vsnprintf(NULL, 0, format, vb) + 1;  // "+ 1" for the '\0'
+    va_end(vb);
+    // format into a heap buffer: worker threads may have small stacks
+    std::vector<char> msg(std::max(len, 1), '\0');
+    va_copy(vb, va);
+    (void)vsnprintf(msg.data(), msg.size(), format, vb);
+    va_end(vb);
+
+    // trim trailing \n
+    std::size_t msgLen = std::strlen(msg.data());
+    if (msgLen > 0 && msg[msgLen - 1] == '\n') {
+        --msgLen;
+    }
+
+    {
+        std::lock_guard<std::mutex> lock(an_log_mutex);
+        an_log_queue.push_back(AnLogMessage{lsstlevel, file ? file : "", func ? func : "", line,
+                                            std::string(msg.data(), msgLen)});
+    }
+    if (an_log_num_released == 0) {
+        // called by a thread holding the GIL
+        an_log_flush();
+    }
+}
+
 /*
  * Wrap index_t
  *
@@ -52,7 +166,12 @@ static void declareIndex(py::module& mod) {
             [](index_t& self, double qlo, double qhi) { return index_overlaps_scale_range(&self, qlo, qhi); },
             "qlow"_a, "qhigh"_a);
     cls.def("reload", [](index_t& self) {
-        if (index_reload(&self)) {
+        int result;
+        {
+            ReleaseGil release;
+            result = index_reload(&self);
+        }
+        if (result) {
             std::ostringstream os;
             os << "Failed to reload multi-index file " << self.indexname;
             throw LSST_EXCEPT(lsst::pex::exceptions::RuntimeError, os.str());
@@ -64,6 +183,8 @@ static void declareIndex(py::module& mod) {
     cls.def_readonly("hpnside", &index_t::hpnside);
     cls.def_readonly("nstars", &index_t::nstars);
     cls.def_readonly("nquads", &index_t::nquads);
+    cls.def_readonly("index_scale_lower", &index_t::index_scale_lower);
+    cls.def_readonly("index_scale_upper", &index_t::index_scale_upper);
 }
 
 /**
@@ -72,7 +193,7 @@ static void declareIndex(py::module& mod) {
 static void declareMultiIndex(py::module& mod) {
     py::class_<MultiIndex> cls(mod, "MultiIndex");
 
-    cls.def(py::init<std::string const&>(), "filepath"_a);
+    cls.def(py::init<std::string const&>(), "filepath"_a, py::call_guard<ReleaseGil>());
 
     cls.def("__getitem__",
             [](MultiIndex const& self, int i) {
@@ -81,12 +202,99 @@ static void declareMultiIndex(py::module& mod) {
             },
             py::return_value_policy::reference_internal, py::is_operator());
 
-    cls.def("addIndex", &MultiIndex::addIndex, "filepath"_a, "metadataOnly"_a);
+    cls.def("addIndex", &MultiIndex::addIndex, "filepath"_a, "metadataOnly"_a, py::call_guard<ReleaseGil>());
     cls.def("isWithinRange", &MultiIndex::isWithinRange, "ra"_a, "dec"_a, "radius"_a);
-    cls.def("unload", &MultiIndex::unload);
+    cls.def("unload", &MultiIndex::unload, py::call_guard<ReleaseGil>());
     cls.def_property_readonly("name", &MultiIndex::getName);
     cls.def("__len__", &MultiIndex::getLength);
-    cls.def("reload", &MultiIndex::reload);
+    cls.def("reload", &MultiIndex::reload, py::call_guard<ReleaseGil>());
+    cls.def("closeFiles", &MultiIndex::closeFiles, py::call_guard<ReleaseGil>());
+}
+
+/**
+ * View the data of a vector as a one-dimensional numpy array, without copying
+ *
+ * @param[in] vec  vector to view
+ * @param[in] base  Python object owning the vector, which is kept alive by the array
+ * @param[in] dtype  numpy data type of the elements
+ */
+template <typename T>
+py::array viewVector(std::vector<T> const& vec, py::handle base,
+                     py::dtype const& dtype = py::dtype::of<T>()) {
+    return py::array(dtype, std::vector<ssize_t>{static_cast<ssize_t>(vec.size())}, std::vector<ssize_t>(),
+                     vec.data(), base);
+}
+
+/**
+ * Wrap detail::RefObjColumns: reference objects in columns
+ *
+ * The columns are returned as numpy arrays that view the data of the object, without copying.
+ */
+static void declareRefObjColumns(py::module& mod) {
+    using detail::RefObjColumns;
+    py::class_<RefObjColumns> cls(mod, "RefObjColumns");
+
+    cls.def("__len__", &RefObjColumns::size);
+    cls.def_property_readonly("filterNames", [](RefObjColumns const& self) {
+        std::vector<std::string> names;
+        for (auto const& mc : self.magColInfoList) {
+            names.push_back(mc.filterName);
+        }
+        return names;
+    });
+    cls.def_property_readonly("ra", [](py::object self) {
+        return viewVector(self.cast<RefObjColumns const&>().ra, self);
+    });
+    cls.def_property_readonly("dec", [](py::object self) {
+        return viewVector(self.cast<RefObjColumns const&>().dec, self);
+    });
+    cls.def_property_readonly("id", [](py::object self) -> py::object {
+        auto const& columns = self.cast<RefObjColumns const&>();
+        if (!columns.hasId) {
+            return py::none();
+        }
+        return viewVector(columns.id, self);
+    });
+    cls.def("getFlux", [](py::object self, std::string const& filterName) -> py::object {
+        auto const& columns = self.cast<RefObjColumns const&>();
+        for (std::size_t j = 0; j < columns.magColInfoList.size(); ++j) {
+            if (columns.magColInfoList[j].filterName == filterName) {
+                return viewVector(columns.flux[j], self);
+            }
+        }
+        throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError, "No flux for filter " + filterName);
+    }, "filterName"_a);
+    cls.def("getFluxErr", [](py::object self, std::string const& filterName) -> py::object {
+        auto const& columns = self.cast<RefObjColumns const&>();
+        std::size_t ej = 0;
+        for (auto const& mc : columns.magColInfoList) {
+            if (mc.hasErr()) {
+                if (mc.filterName == filterName) {
+                    return viewVector(columns.fluxErr[ej], self);
+                }
+                ++ej;
+            }
+        }
+        throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError, "No flux error for filter " + filterName);
+    }, "filterName"_a);
+    cls.def_property_readonly("resolved", [](py::object self) -> py::object {
+        auto const& columns = self.cast<RefObjColumns const&>();
+        if (!columns.hasResolved) {
+            return py::none();
+        }
+        return viewVector(columns.resolved, self, py::dtype::of<bool>());
+    });
+    cls.def_property_readonly("variable", [](py::object self) -> py::object {
+        auto const& columns = self.cast<RefObjColumns const&>();
+        if (!columns.hasVariable) {
+            return py::none();
+        }
+        return viewVector(columns.variable, self, py::dtype::of<bool>());
+    });
+    cls.def_property_readonly("photometric", [](py::object self) {
+        return viewVector(self.cast<RefObjColumns const&>().photometric, self, py::dtype::of<bool>());
+    });
+    cls.def("makeCatalog", &detail::makeCatalogFromColumns);
 }
 
 /**
@@ -110,6 +318,14 @@ static void declareSolver(py::module& mod) {
     @param[in] starGalCol  name of "starGal" column (true if object is a star) in astrometry.net data
     @param[in] varCol  name of "var" column (true if brightness is variable) in astrometry.net data
     @param[in] uniqueIds  if true then only return unique IDs (the first of each seen)
+    @param[in] magLimitFilterList  names of filters (in filterNameList) whose magnitudes are limited
+    @param[in] minMagList  minimum (brightest) magnitude, one per element of magLimitFilterList
+    @param[in] maxMagList  maximum (faintest) magnitude, one per element of magLimitFilterList
+    @param[in] photometricOnly  if true then only return objects that are photometric
+    @param[in] excludeResolved  if true then do not return objects that are resolved
+    @param[in] excludeVariable  if true then do not return objects that are variable
+    @param[in] numThreads  number of threads with which to search the star kd-trees;
+        the results do not depend on the number.  The GIL is released while reading.
 
     Returned schema:
     - id
@@ -117,8 +333,8 @@ static void declareSolver(py::module& mod) {
     - centroid: centroid on some exposure, if relevant (an lsst::afw::geom::Point2D); returned value is not
     set
     - hasCentroid: if true then centroid has been set; returned value is false
-    - <filterName>_flux: flux in the specified filter (double)
-    - <filterName>_fluxErr: flux uncertainty in the specified filter (double)
+    - <filterName>_flux: flux in the specified filter (double, nJy)
+    - <filterName>_fluxErr: flux uncertainty in the specified filter (double, nJy)
     - resolved (if starGalCol specified): true if object is not resolved
     - variable (if varCol specified): true if brightness is variable
     - photometric: true if not resolved (or starGalCol blank) and not variable (or varCol blank);
@@ -126,56 +342,104 @@ static void declareSolver(py::module& mod) {
     */
     cls.def("getCatalog", &Solver::getCatalog, "inds"_a, "ctrCoord"_a, "radius"_a, "idCol"_a,
             "filterNameList"_a, "magColList"_a, "magErrColList"_a, "starGalCol"_a, "varCol"_a,
-            "uniqueIds"_a = true);
+            "uniqueIds"_a = true, "magLimitFilterList"_a = std::vector<std::string>(),
+            "minMagList"_a = std::vector<double>(), "maxMagList"_a = std::vector<double>(),
+            "photometricOnly"_a = false, "excludeResolved"_a = false, "excludeVariable"_a = false,
+            "numThreads"_a = 1, py::call_guard<ReleaseGil>());
+    cls.def("getCatalogs", &Solver::getCatalogs, "inds"_a, "ctrCoordList"_a, "radiusList"_a, "idCol"_a,
+            "filterNameList"_a, "magColList"_a, "magErrColList"_a, "starGalCol"_a, "varCol"_a,
+            "uniqueIds"_a = true, "magLimitFilterList"_a = std::vector<std::string>(),
+            "minMagList"_a = std::vector<double>(), "maxMagList"_a = std::vector<double>(),
+            "photometricOnly"_a = false, "excludeResolved"_a = false, "excludeVariable"_a = false,
+            "numThreads"_a = 1, py::call_guard<ReleaseGil>());
+    cls.def("getPolygonCatalogs", &Solver::getPolygonCatalogs, "inds"_a, "polygonList"_a, "margin"_a,
+            "idCol"_a, "filterNameList"_a, "magColList"_a, "magErrColList"_a, "starGalCol"_a, "varCol"_a,
+            "uniqueIds"_a = true, "magLimitFilterList"_a = std::vector<std::string>(),
+            "minMagList"_a = std::vector<double>(), "maxMagList"_a = std::vector<double>(),
+            "photometricOnly"_a = false, "excludeResolved"_a = false, "excludeVariable"_a = false,
+            "numThreads"_a = 1, py::call_guard<ReleaseGil>());
+    cls.def("getColumns", &Solver::getColumns, "inds"_a, "ctrCoordList"_a, "radiusList"_a, "idCol"_a,
+            "filterNameList"_a, "magColList"_a, "magErrColList"_a, "starGalCol"_a, "varCol"_a,
+            "uniqueIds"_a = true, "magLimitFilterList"_a = std::vector<std::string>(),
+            "minMagList"_a = std::vector<double>(), "maxMagList"_a = std::vector<double>(),
+            "photometricOnly"_a = false, "excludeResolved"_a = false, "excludeVariable"_a = false,
+            "numThreads"_a = 1, py::call_guard<ReleaseGil>());
     cls.def("getSolveStats", &Solver::getSolveStats);
     cls.def("getWcs", &Solver::getWcs);
     cls.def("didSolve", &Solver::didSolve);
-    cls.def("run", &Solver::run, "cpulimit"_a);
+    cls.def("run", &Solver::run, "cpulimit"_a, py::call_guard<ReleaseGil>());
     cls.def("getQuadSizeRangeArcsec", &Solver::getQuadSizeRangeArcsec);
-    cls.def("addIndices", &Solver::addIndices, "indices"_a);
+    cls.def("addIndices", &Solver::addIndices, "indices"_a, py::call_guard<ReleaseGil>());
     cls.def("setParity", &Solver::setParity, "setParityFlipped", "parity"_a);
     cls.def("setMatchThreshold", &Solver::setMatchThreshold, "threshold"_a);
     cls.def("setPixelScaleRange", &Solver::setPixelScaleRange, "low"_a, "high"_a);
     cls.def("setRaDecRadius", &Solver::setRaDecRadius, "ra"_a, "dec"_a, "rad"_a);
     cls.def("setImageSize", &Solver::setImageSize, "width"_a, "height"_a);
     cls.def("setMaxStars", &Solver::setMaxStars, "maxStars"_a);
-    cls.def("setStars", &Solver::setStars, "sourceCat"_a, "x0"_a, "y0"_a);
+    cls.def("setStars", &Solver::setStars, "sourceCat"_a, "x0"_a, "y0"_a, py::call_guard<ReleaseGil>());
 }
 
-// declare logging functions for use by the Python
-
-LOG_LOGGER an_log = LOG_GET("meas.astrom.astrometry_net");
-
-void an_log_callback(void* baton, enum log_level level, const char* file, int line, const char* func,
-                     const char* format, va_list va) {
-    // translate between logging levels
-    int levelmap[5];
-    levelmap[LOG_NONE] = LOG_LVL_FATAL;
-    levelmap[LOG_ERROR] = LOG_LVL_FATAL;
-    levelmap[LOG_MSG] = LOG_LVL_INFO;
-    levelmap[LOG_VERB] = LOG_LVL_DEBUG;
-    levelmap[LOG_ALL] = LOG_LVL_DEBUG;
-    int lsstlevel = levelmap[level];
-
-    va_list vb;
-    // find out how long the formatted string will be
-    va_copy(vb, va);
-    const int len = vsnprintf(NULL, 0, format, va) + 1;  // "+ 1" for the '\0'
-    va_end(va);
-    // allocate a string of the appropriate length
-    char msg[len];
-    (void)vsnprintf(msg, len, format, vb);
-    va_end(vb);
-
-    // trim trailing \n
-    if (msg[len - 2] == '\n') {
-        msg[len - 2] = '\0';
-    }
+/**
+ * Wrap healpixDistances, which works on arrays
+ *
+ * Returns a (len(ra), len(hp)) array of distances, in radians.
+ */
+static void declareHealpixDistances(py::module& mod) {
+    using IntArray = py::array_t<int, py::array::c_style | py::array::forcecast>;
+    using DoubleArray = py::array_t<double, py::array::c_style | py::array::forcecast>;
+    mod.def("healpixDistances",
+            [](IntArray const& hp, IntArray const& nside, DoubleArray const& ra, DoubleArray const& dec) {
+                if (hp.ndim() != 1 || nside.ndim() != 1 || hp.size() != nside.size()) {
+                    throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                                      "hp and nside must be one-dimensional arrays of the same length");
+                }
+                if (ra.ndim() != 1 || dec.ndim() != 1 || ra.size() != dec.size()) {
+                    throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                                      "ra and dec must be one-dimensional arrays of the same length");
+                }
+                std::size_t const numHealpix = hp.size();
+                std::size_t const numCoord = ra.size();
+                DoubleArray distances(std::vector<ssize_t>{static_cast<ssize_t>(numCoord),
+                                                           static_cast<ssize_t>(numHealpix)});
+                int const* hpData = hp.data();
+                int const* nsideData = nside.data();
+                double const* raData = ra.data();
+                double const* decData = dec.data();
+                double* distData = distances.mutable_data();
+                {
+                    py::gil_scoped_release release;
+                    healpixDistances(hpData, nsideData, numHealpix, raData, decData, numCoord, distData);
+                }
+                return distances;
+            },
+            "hp"_a, "nside"_a, "ra"_a, "dec"_a);
+}
 
-    // not using the LOGS macro because the original location info is wanted
-    if (an_log.isEnabledFor(lsstlevel)) {
-        an_log.logMsg(log4cxx::Level::toLevel(lsstlevel), log4cxx::spi::LocationInfo(file, func, line), msg);
-    }
+/**
+ * Wrap healpixIndices, which works on arrays
+ *
+ * Returns an array of healpix numbers, one for each coordinate.
+ */
+static void declareHealpixIndices(py::module& mod) {
+    using DoubleArray = py::array_t<double, py::array::c_style | py::array::forcecast>;
+    mod.def("healpixIndices",
+            [](DoubleArray const& ra, DoubleArray const& dec, int nside) {
+                if (ra.ndim() != 1 || dec.ndim() != 1 || ra.size() != dec.size()) {
+                    throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                                      "ra and dec must be one-dimensional arrays of the same length");
+                }
+                std::size_t const numCoord = ra.size();
+                py::array_t<int> hp(std::vector<ssize_t>{static_cast<ssize_t>(numCoord)});
+                double const* raData = ra.data();
+                double const* decData = dec.data();
+                int* hpData = hp.mutable_data();
+                {
+                    py::gil_scoped_release release;
+                    healpixIndices(raData, decData, numCoord, nside, hpData);
+                }
+                return hp;
+            },
+            "ra"_a, "dec"_a, "nside"_a);
 }
 
 /// start astrometry_net logging
@@ -200,6 +464,8 @@ PYBIND11_MODULE(astrometry_net, mod) {
     start_an_logging();
 
     mod.def("healpixDistance", &healpixDistance, "hp"_a, "nside"_a, "coord"_a);
+    mod.def("healpixRangeSearch", &healpixRangeSearch, "coord"_a, "radius"_a, "nside"_a);
+    mod.def("healpixBoundingCircle", &healpixBoundingCircle, "hp"_a, "nside"_a);
 
     mod.def("an_log_init", [](int level) { log_init(static_cast<log_level>(level)); }, "level"_a);
 
@@ -207,8 +473,11 @@ PYBIND11_MODULE(astrometry_net, mod) {
     mod.def("an_log_set_level", [](int level) { log_set_level(static_cast<log_level>(level)); }, "level"_a);
     mod.def("finalize", &finalize);
 
+    declareHealpixDistances(mod);
+    declareHealpixIndices(mod);
     declareMultiIndex(mod);
     declareIndex(mod);
+    declareRefObjColumns(mod);
     declareSolver(mod);
 }
 
@@ -0,0 +1,208 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Benchmark of the time and resources required to construct an astrometry.net catalog
+
+Synthetic catalogs with many shards are made by linking to the files of a
+template multi-index, and the construction of the AstrometryNetCatalog is
+timed (in a separate process for each measurement, so that the peak memory
+usage is that of the construction) without the cache, with a cold cache
+(which is written) and with a warm cache, as well as the reading of the
+index files by LoadAstrometryNetObjectsTask.  See bin/benchmarkANetCatalog.py.
+"""
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["benchmarkCases", "makeSyntheticCatalog", "benchmarkCatalog", "compareToBaseline"]
+
+from builtins import range
+import copy
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import time
+
+from .multiindex import AstrometryNetCatalog, getCachePath, getIndexPath
+from .loadAstrometryNetObjects import LoadAstrometryNetObjectsTask
+
+# Names of the benchmark cases, in the order in which they are run
+benchmarkCases = ("noCache", "coldCache", "warmCache", "task")
+
+
+def makeSyntheticCatalog(outDir, numShards, template):
+    """!Make a synthetic catalog of many shards, linking to the files of a template multi-index
+
+    @param outDir     Directory in which to make the links; also used for the cache
+    @param numShards  Number of shards (multi-indexes) in the catalog
+    @param template   Configuration (an AstrometryNetDataConfig) whose first
+                      multi-index is used as the template for every shard
+    @return configuration (an AstrometryNetDataConfig) for the synthetic catalog
+    """
+    if not template.multiIndexFiles:
+        raise RuntimeError("Template configuration has no multi-index files")
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    filenameList = template.multiIndexFiles[0]
+    multiIndexFiles = []
+    for shard in range(numShards):
+        shardList = []
+        for fn in filenameList:
+            linkName = os.path.join(outDir, "shard%05d-%s" % (shard, os.path.basename(fn)))
+            if not os.path.lexists(linkName):
+                os.symlink(getIndexPath(fn), linkName)
+            shardList.append(linkName)
+        multiIndexFiles.append(shardList)
+    andConfig = copy.copy(template)
+    andConfig.indexFiles = []
+    andConfig.multiIndexFiles = multiIndexFiles
+    andConfig.cacheDir = outDir
+    return andConfig
+
+
+def _countFileDescriptors():
+    """Count the file descriptors open in this process"""
+    for fdDir in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(fdDir):
+            return len(os.listdir(fdDir))
+    return 0
+
+
+def _getPeakRss():
+    """Get the peak resident set size (bytes) of this process"""
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss if sys.platform == "darwin" else maxRss*1024
+
+
+def _measure(andConfig, case, queue):
+    """!Measure the construction of a catalog, in a child process
+
+    @param andConfig  Configuration (an AstrometryNetDataConfig)
+    @param case       Name of the case (one of benchmarkCases)
+    @param queue      multiprocessing.Queue on which to put the measurements
+    """
+    fds = _countFileDescriptors()
+    start = time.time()
+    if case == "task":
+        task = LoadAstrometryNetObjectsTask(andConfig=andConfig)
+        task._readIndexFiles()
+    else:
+        catalog = AstrometryNetCatalog(andConfig)  # noqa F841: must remain open for the fd count
+    seconds = time.time() - start
+    queue.put(dict(seconds=seconds, peakRss=_getPeakRss(), fds=_countFileDescriptors() - fds))
+
+
+def _runCase(andConfig, case, timeout):
+    """!Run a benchmark case in a child process, returning the measurements
+
+    @param andConfig  Configuration (an AstrometryNetDataConfig)
+    @param case       Name of the case (one of benchmarkCases)
+    @param timeout    Maximum time (sec) to wait for the measurements
+    @throw RuntimeError if the child process fails or times out
+    """
+    resultQueue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(andConfig, case, resultQueue))
+    process.start()
+    try:
+        result = resultQueue.get(timeout=timeout)
+    except queue.Empty:
+        result = None
+        if process.is_alive():
+            process.terminate()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("Benchmark case %s failed with exit code %s" % (case, process.exitcode))
+    if result is None:
+        raise RuntimeError("Benchmark case %s produced no measurements within %s sec" % (case, timeout))
+    return result
+
+
+def benchmarkCatalog(template, shardsList, workDir, repeat=3, timeout=600.0, log=None):
+    """!Benchmark the construction of synthetic catalogs
+
+    For each number of shards and each case, the time taken is the minimum
+    over the repeats, and the peak RSS and number of file descriptors left
+    open are the maximum.
+
+    @param template    Configuration (an AstrometryNetDataConfig) whose first
+                       multi-index is used as the template for every shard
+    @param shardsList  List of numbers of shards for which to make catalogs
+    @param workDir     Directory in which to make the catalogs
+    @param repeat      Number of times to repeat each measurement
+    @param timeout     Maximum time (sec) for each measurement
+    @param log         Log for progress messages, or None
+    @return results: dict of {number of shards (str): {case: {"seconds", "peakRss", "fds"}}}
+    """
+    results = {}
+    for numShards in shardsList:
+        andConfig = makeSyntheticCatalog(os.path.join(workDir, "shards%d" % (numShards,)), numShards,
+                                         template)
+        cacheName = getCachePath(andConfig)
+        caseResults = {}
+        for case in benchmarkCases:
+            measurements = []
+            for _ in range(repeat):
+                andConfig.allowCache = case != "noCache"
+                if case == "coldCache" and os.path.exists(cacheName):
+                    os.unlink(cacheName)
+                measurements.append(_runCase(andConfig, case, timeout))
+            caseResults[case] = dict(seconds=min(mm["seconds"] for mm in measurements),
+                                     peakRss=max(mm["peakRss"] for mm in measurements),
+                                     fds=max(mm["fds"] for mm in measurements))
+            if log is not None:
+                log.info("%d shards, %s: %.3f sec, peak RSS %d bytes, %d fds", numShards, case,
+                         caseResults[case]["seconds"], caseResults[case]["peakRss"], caseResults[case]["fds"])
+        results[str(numShards)] = caseResults
+    return results
+
+
+def compareToBaseline(results, baseline, timeFactor=2.0, rssFactor=1.5, fdMargin=10):
+    """!Compare benchmark results to a baseline
+
+    Only the numbers of shards, cases and quantities present in both are
+    compared, so a baseline may omit quantities (e.g., times) that are not
+    comparable between machines.
+
+    @param results     Benchmark results, from benchmarkCatalog
+    @param baseline    Baseline benchmark results, from benchmarkCatalog
+    @param timeFactor  Maximum allowed ratio of time taken to the baseline
+    @param rssFactor   Maximum allowed ratio of peak RSS to the baseline
+    @param fdMargin    Maximum allowed increase in the number of file descriptors over the baseline
+    @return list of descriptions of regressions; empty if there are none
+    """
+    regressions = []
+    for numShards in sorted(results, key=int):
+        for case in benchmarkCases:
+            if case not in results[numShards] or case not in baseline.get(numShards, {}):
+                continue
+            new = results[numShards][case]
+            old = baseline[numShards][case]
+            prefix = "%s shards, %s: " % (numShards, case)
+            if "seconds" in old and new["seconds"] > timeFactor*old["seconds"]:
+                regressions.append(prefix + "time %.3f sec exceeds %.1f times baseline %.3f sec" %
+                                   (new["seconds"], timeFactor, old["seconds"]))
+            if "peakRss" in old and new["peakRss"] > rssFactor*old["peakRss"]:
+                regressions.append(prefix + "peak RSS %d bytes exceeds %.1f times baseline %d bytes" %
+                                   (new["peakRss"], rssFactor, old["peakRss"]))
+            if "fds" in old and new["fds"] > old["fds"] + fdMargin:
+                regressions.append(prefix + "%d file descriptors exceeds baseline %d by more than %d" %
+                                   (new["fds"], old["fds"], fdMargin))
+    return regressions
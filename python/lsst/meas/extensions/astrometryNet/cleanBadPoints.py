@@ -41,13 +41,8 @@ def clean(srcMatch, wcs, order=3, nsigma=3):
     list of det::SourceMatch of the good data points
     """
 
-    N = len(srcMatch)
-    catX = np.zeros(N)
-    # catY = np.zeros(N)
-    for i in range(N):
-        x, y = wcs.skyToPixel(srcMatch[i].first.getCoord())
-        catX[i] = x
-        # catY[i] = y
+    # Transform all the coordinates at once
+    catX = np.array([point.getX() for point in wcs.skyToPixel([m.first.getCoord() for m in srcMatch])])
 
     # TODO -- why does this only use X?
 
@@ -2,15 +2,124 @@ from __future__ import absolute_import, division, print_function
 
 __all__ = ["LoadAstrometryNetObjectsTask", "LoadAstrometryNetObjectsConfig"]
 
-from builtins import object
+from builtins import object, range
 
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+import lsst.pex.config as pexConfig
+import lsst.pex.exceptions as pexExceptions
 import lsst.pipe.base as pipeBase
 from lsst.meas.algorithms import LoadReferenceObjectsTask, getRefFluxField
-from lsst.meas.algorithms.loadReferenceObjects import convertToNanojansky
 from . import astrometry_net
-from .multiindex import AstrometryNetCatalog, getConfigFromEnvironment
+from .multiindex import AstrometryNetCatalog, MultiIndexResidencyPool, getConfigFromEnvironment
+from .queryCache import ReferenceQueryCache
+from .tileCache import ReferenceTileCache
+
+# Has the deprecation of a.net reference catalogs been logged by this process?
+_warnedDeprecated = False
+
+
+class LoadAstrometryNetObjectsConfig(LoadReferenceObjectsTask.ConfigClass):
+    maxResidentIndexes = pexConfig.Field(
+        doc="Maximum number of multi-index files to keep loaded between queries; "
+        "0 to unload them after every query",
+        dtype=int,
+        default=0,
+    )
+    maxResidentBytes = pexConfig.Field(
+        doc="Maximum number of bytes of multi-index files to keep mapped between queries; "
+        "None for no limit",
+        dtype=int,
+        default=None,
+        optional=True,
+    )
+    maxResidentFiles = pexConfig.Field(
+        doc="Maximum number of multi-index files to keep open between queries; None for no limit",
+        dtype=int,
+        default=None,
+        optional=True,
+    )
+    tileCacheNside = pexConfig.Field(
+        doc="HEALPix nside of the tiles of reference objects cached between queries; "
+        "0 to read every query from the index files",
+        dtype=int,
+        default=0,
+        check=lambda x: x >= 0,
+    )
+    tileCacheMaxBytes = pexConfig.Field(
+        doc="Maximum number of bytes of reference objects to keep in the tile cache",
+        dtype=int,
+        default=256*1024**2,
+    )
+    queryCacheDir = pexConfig.Field(
+        doc="Directory in which to cache reference catalog queries between runs; "
+        "None to not cache queries on disk",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    queryCacheMaxBytes = pexConfig.Field(
+        doc="Maximum total size (bytes) of the reference catalog queries cached on disk",
+        dtype=int,
+        default=1024**3,
+    )
+    polygonSearch = pexConfig.Field(
+        doc="In loadPixelBox, drop the reference objects outside the pixel box (projected onto the sky) "
+        "before reading them from the index files, rather than trimming them afterwards? "
+        "Ignored if the tile or query cache is enabled.",
+        dtype=bool,
+        default=True,
+    )
+    polygonPointsPerSide = pexConfig.Field(
+        doc="Number of vertices per side of the pixel box for the polygon used by polygonSearch",
+        dtype=int,
+        default=4,
+        check=lambda x: x >= 1,
+    )
+    numThreads = pexConfig.Field(
+        doc="Number of threads with which to search the index files and read their reference objects; "
+        "the objects loaded, and their order, do not depend on the number",
+        dtype=int,
+        default=1,
+        check=lambda x: x >= 1,
+    )
+    projectBands = pexConfig.Field(
+        doc="Read only the magnitude columns of the reference filter for the requested filterName "
+        "(or defaultFilter, if filterName is None), instead of every band in magColumnMap? "
+        "The bands in minMagnitude and maxMagnitude are also read.",
+        dtype=bool,
+        default=False,
+    )
+    minMagnitude = pexConfig.DictField(
+        doc="Minimum (brightest) magnitude of reference objects to load, by reference filter",
+        keytype=str,
+        itemtype=float,
+        default={},
+    )
+    maxMagnitude = pexConfig.DictField(
+        doc="Maximum (faintest) magnitude of reference objects to load, by reference filter",
+        keytype=str,
+        itemtype=float,
+        default={},
+    )
+    requirePhotometric = pexConfig.Field(
+        doc="Only load reference objects that are photometric (neither resolved nor variable)?",
+        dtype=bool,
+        default=False,
+    )
+    excludeResolved = pexConfig.Field(
+        doc="Do not load reference objects that are resolved?",
+        dtype=bool,
+        default=False,
+    )
+    excludeVariable = pexConfig.Field(
+        doc="Do not load reference objects that are variable?",
+        dtype=bool,
+        default=False,
+    )
 
-LoadAstrometryNetObjectsConfig = LoadReferenceObjectsTask.ConfigClass
 
 # The following block adds links to this task from the Task Documentation page.
 ## \addtogroup LSST_task_documentation
@@ -40,6 +149,12 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
 
     Load reference objects from astrometry.net index files.
 
+    A LoadAstrometryNetObjectsTask must not be used by several threads at once: its
+    queries share the astrometry.net index structures (including the open tag-along files),
+    which are not thread-safe.  Use a separate loader in each thread; the index files are
+    memory-mapped, so their pages are shared between loaders.  (Loading and unloading the multi-indexes
+    are serialised, so the multi-indexes themselves may be shared between a loader and a solver.)
+
     @section meas_astrom_loadAstrometryNetObjects_Initialize   Task initialisation
 
     @copydoc \_\_init\_\_
@@ -82,7 +197,7 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
         # because astrometry may not be used, in which case it may not be properly configured
 
     @pipeBase.timeMethod
-    def loadSkyCircle(self, ctrCoord, radius, filterName=None, epoch=None):
+    def loadSkyCircle(self, ctrCoord, radius, filterName=None, epoch=None, bands=None, wcs=None):
         """!Load reference objects that overlap a circular sky region
 
         @param[in] ctrCoord  center of search region (an afwGeom.Coord)
@@ -91,6 +206,14 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
             used for flux values in case we have flux limits (which are not yet implemented)
         @param[in] epoch  Epoch for proper motion and parallax correction
                     (an astropy.time.Time), or None
+        @param[in] bands  list of reference filters (keys of andConfig.magColumnMap) whose
+            magnitude columns to read, or None to read those selected by config.projectBands;
+            the bands in config.minMagnitude and config.maxMagnitude are always read
+        @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs) with which to set the centroids of the
+            objects, or None to leave them unset
+
+        Objects failing config.minMagnitude, config.maxMagnitude, config.requirePhotometric,
+        config.excludeResolved or config.excludeVariable are rejected as the index files are read.
 
         No proper motion correction is made, since our astrometry.net catalogs
         typically don't support that, and even if they do they format is uncertain.
@@ -102,51 +225,382 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
         - refCat a catalog of reference objects with the
             \link meas_algorithms_loadReferenceObjects_Schema standard schema \endlink
             as documented in LoadReferenceObjects, including photometric, resolved and variable;
-            hasCentroid is False for all objects.
+            hasCentroid is False for all objects unless wcs is specified.
         - fluxField = name of flux field for specified filterName
+
+        @throw RuntimeError if bands includes a filter not in andConfig.magColumnMap
+        """
+        self._readIndexFiles()
+        bands = self._getBands(filterName, bands)
+
+        self.log.debug("search for objects at %s with radius %s deg", ctrCoord, radius.asDegrees())
+        refCat = self._loadRefCats([ctrCoord], [radius], bands)[0]
+
+        self._warnDeprecated()
+        result = self._finishRefCat(refCat, filterName, bands, wcs)
+        self.log.debug("found %d objects", len(result.refCat))
+        return result
+
+    @pipeBase.timeMethod
+    def loadPixelBox(self, bbox, wcs, filterName=None, photoCalib=None, epoch=None, bands=None):
+        """!Load reference objects that overlap a pixel-based rectangular region
+
+        The search region is the bounding box grown by config.pixelMargin.  If
+        config.polygonSearch is set, the objects are selected by a polygon
+        following the region on the sky before they are read from the index
+        files, so that the objects in the corners of its circumscribing circle
+        (half the circle, for a long thin CCD) are never read.
+
+        @param[in] bbox  bounding box for pixels (an lsst.afw.geom.Box2I or Box2D)
+        @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs)
+        @param[in] filterName  name of filter, or None for the default filter; see loadSkyCircle
+        @param[in] photoCalib  photometric calibration (ignored)
+        @param[in] epoch  Epoch for proper motion and parallax correction (ignored); see loadSkyCircle
+        @param[in] bands  list of reference filters whose magnitude columns to read,
+            or None to read those selected by config.projectBands; see loadSkyCircle
+
+        @return an lsst.pipe.base.Struct as returned by loadSkyCircle, with centroids (and hasCentroid)
+            set from wcs in a single transform
+        """
+        self._readIndexFiles()
+        bands = self._getBands(filterName, bands)
+
+        circle = self._calculateCircle(bbox, wcs)
+        self.log.info("Loading reference objects using center %s and radius %s deg",
+                      circle.coord, circle.radius.asDegrees())
+        refCat = None
+        if self.config.polygonSearch and self.tileCache is None and self.queryCache is None:
+            # (the caches hold circular regions)
+            vertices = self._getPolygonVertices(circle.bbox, wcs)
+            # Allow for the edges of the box not being great circles, because of distortion
+            margin = wcs.getPixelScale(circle.bbox.getCenter())*self.config.pixelMargin
+            try:
+                refCat = self._readPolygon(vertices, margin, circle.coord, circle.radius + margin, bands)
+            except pexExceptions.InvalidParameterError as exc:
+                self.log.debug("Unable to search polygon (%s); searching its circumscribing circle", exc)
+        if refCat is None:
+            refCat = self._loadRefCats([circle.coord], [circle.radius], bands)[0]
+
+        self._warnDeprecated()
+        loadRes = self._finishRefCat(refCat, filterName, bands, wcs)
+        numFound = len(loadRes.refCat)
+        loadRes.refCat = self._trimToPixelBox(loadRes.refCat, circle.bbox)
+        self.log.debug("trimmed %d out-of-bbox objects, leaving %d", numFound - len(loadRes.refCat),
+                       len(loadRes.refCat))
+        self.log.info("Loaded %d reference objects", len(loadRes.refCat))
+        return loadRes
+
+    @pipeBase.timeMethod
+    def loadSkyCircles(self, cones, filterName=None, epoch=None, bands=None, wcs=None):
+        """!Load reference objects that overlap each of several circular sky regions
+
+        This is equivalent to calling loadSkyCircle for each region, but is
+        cheaper when the regions are close together (e.g., the CCDs of a
+        visit): each multi-index file is loaded once for all the regions,
+        and each reference object is read from it at most once.
+
+        @param[in] cones  list of (ctrCoord, radius) tuples: center of search region (an afwGeom.Coord)
+            and radius of search region (an afwGeom.Angle)
+        @param[in] filterName  name of filter, or None for the default filter;
+            used for flux values in case we have flux limits (which are not yet implemented)
+        @param[in] epoch  Epoch for proper motion and parallax correction
+                    (an astropy.time.Time), or None; see loadSkyCircle
+        @param[in] bands  list of reference filters whose magnitude columns to read,
+            or None to read those selected by config.projectBands; see loadSkyCircle
+        @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs) with which to set the centroids of the
+            objects, or None to leave them unset
+
+        @return a list of lsst.pipe.base.Struct, one per region, as returned by loadSkyCircle
         """
         self._readIndexFiles()
+        bands = self._getBands(filterName, bands)
+
+        ctrCoordList = [ctrCoord for ctrCoord, radius in cones]
+        radiusList = [radius for ctrCoord, radius in cones]
+        refCatList = self._loadRefCats(ctrCoordList, radiusList, bands)
+
+        self._warnDeprecated()
+        results = [self._finishRefCat(refCat, filterName, bands, wcs) for refCat in refCatList]
+        self.log.debug("found %d objects in %d regions", sum(len(res.refCat) for res in results), len(results))
+        return results
+
+    def _loadRefCats(self, ctrCoordList, radiusList, bands=None):
+        """!Load reference objects in several circular sky regions
 
+        Queries are answered from the on-disk query cache if enabled, else
+        through the tile cache if enabled, else from the index files.
+
+        @param[in] ctrCoordList  centers of search regions (afwGeom.Coord)
+        @param[in] radiusList  radii of search regions (afwGeom.Angle)
+        @param[in] bands  list of reference filters whose magnitude columns to read, or None for all
+
+        @return list of reference catalogs (lsst.afw.table.SimpleCatalog), one per region,
+            before _finishRefCat
+        """
+        refCatList = [None]*len(ctrCoordList)
+        keys = None
+        if self.queryCache is not None:
+            catalogArgs = self._getCatalogArgs(bands)
+            keys = [self.queryCache.getKey(ctrCoord, radius, catalogArgs) for
+                    ctrCoord, radius in zip(ctrCoordList, radiusList)]
+            refCatList = [self.queryCache.get(key) for key in keys]
+        missing = [i for i, refCat in enumerate(refCatList) if refCat is None]
+        if not missing:
+            return refCatList
+
+        missingCoords = [ctrCoordList[i] for i in missing]
+        missingRadii = [radiusList[i] for i in missing]
+        if self.tileCache is not None:
+            readList = self._queryTileCache(missingCoords, missingRadii, bands)
+        else:
+            readList = self._readCones(missingCoords, missingRadii, bands)
+        for i, refCat in zip(missing, readList):
+            refCatList[i] = refCat
+            if keys is not None:
+                self.queryCache.put(keys[i], refCat)
+        return refCatList
+
+    def _readCones(self, ctrCoordList, radiusList, bands=None, uniqueIds=True):
+        """!Read reference objects in several circular sky regions from the index files
+
+        @param[in] ctrCoordList  centers of search regions (afwGeom.Coord)
+        @param[in] radiusList  radii of search regions (afwGeom.Angle)
+        @param[in] bands  list of reference filters whose magnitude columns to read, or None for all
+        @param[in] uniqueIds  only return the first of objects with the same ID in each region?
+
+        @return list of reference catalogs (lsst.afw.table.SimpleCatalog), one per region,
+            as read by solver.getCatalogs
+        """
+        solver = self._getSolver()
+        catalogArgs = self._getCatalogArgs(bands, uniqueIds=uniqueIds)
+
+        if len(ctrCoordList) == 1:
+            ctrCoord, radius = ctrCoordList[0], radiusList[0]
+
+            # Find multi-index files within range
+            multiInds = self._getMIndexesWithinRange(ctrCoord, radius)
+
+            with LoadMultiIndexes(multiInds, self.residencyPool):
+                # We just want to pass the star kd-trees, so just pass the
+                # first element of each multi-index.
+                inds = tuple(mi[0] for mi in multiInds)
+                return [solver.getCatalog(inds, ctrCoord, radius, *catalogArgs,
+                                          numThreads=self.config.numThreads)]
+
+        multiInds = self._getMIndexesWithinRangeBatch(ctrCoordList, radiusList)
+        self.log.debug("search for objects in %d regions using %d multi-index files",
+                       len(ctrCoordList), len(multiInds))
+        with LoadMultiIndexes(multiInds, self.residencyPool):
+            inds = tuple(mi[0] for mi in multiInds)
+            return solver.getCatalogs(inds, ctrCoordList, radiusList, *catalogArgs,
+                                      numThreads=self.config.numThreads)
+
+    @pipeBase.timeMethod
+    def loadColumns(self, cones, filterName=None, bands=None):
+        """!Load reference objects that overlap each of several circular sky regions, in columns
+
+        The objects are those loadSkyCircles returns, but no records are made:
+        each field is a contiguous numpy array, so array-based code (e.g., matching)
+        can skip the record layer.  Call makeCatalog on the columns for a catalog
+        with the schema of the catalogs returned by Solver.getCatalog.  The caches
+        (config.tileCacheNside and config.queryCacheDir) are not used.
+
+        @param[in] cones  list of (ctrCoord, radius) tuples: center of search region (an afwGeom.Coord)
+            and radius of search region (an afwGeom.Angle)
+        @param[in] filterName  name of filter, or None for the default filter; see loadSkyCircle
+        @param[in] bands  list of reference filters whose magnitude columns to read,
+            or None to read those selected by config.projectBands; see loadSkyCircle
+
+        @return a list of astrometry_net.RefObjColumns, one per region, with:
+        - ra, dec: ICRS position (radians)
+        - id: ID, or None if andConfig.idColumn is None
+        - getFlux(filterName), getFluxErr(filterName): flux and its uncertainty (nJy)
+        - resolved, variable: flags, or None if the corresponding column is not read
+        - photometric: flag
+        """
+        self._readIndexFiles()
+        bands = self._getBands(filterName, bands)
+
+        ctrCoordList = [ctrCoord for ctrCoord, radius in cones]
+        radiusList = [radius for ctrCoord, radius in cones]
+        multiInds = self._getMIndexesWithinRangeBatch(ctrCoordList, radiusList)
+        solver = self._getSolver()
+        with LoadMultiIndexes(multiInds, self.residencyPool):
+            inds = tuple(mi[0] for mi in multiInds)
+            columnsList = solver.getColumns(inds, ctrCoordList, radiusList, *self._getCatalogArgs(bands),
+                                            numThreads=self.config.numThreads)
+
+        self._warnDeprecated()
+        self.log.debug("found %d objects in %d regions", sum(len(cols) for cols in columnsList),
+                       len(columnsList))
+        return columnsList
+
+    def _readPolygon(self, vertices, margin, ctrCoord, radius, bands=None):
+        """!Read reference objects in a convex polygon on the sky from the index files
+
+        @param[in] vertices  vertices of the polygon (afwGeom.SpherePoint), in order around it
+        @param[in] margin  objects within this distance (an afwGeom.Angle) outside the polygon
+            are also read
+        @param[in] ctrCoord  center of a circle enclosing the polygon and margin (an afwGeom.Coord)
+        @param[in] radius  radius of a circle enclosing the polygon and margin (an afwGeom.Angle)
+        @param[in] bands  list of reference filters whose magnitude columns to read, or None for all
+
+        @return reference catalog (lsst.afw.table.SimpleCatalog), as read by solver.getPolygonCatalogs
+
+        @throw lsst.pex.exceptions.InvalidParameterError if the polygon is not convex
+        """
+        solver = self._getSolver()
+        multiInds = self._getMIndexesWithinRange(ctrCoord, radius)
+        with LoadMultiIndexes(multiInds, self.residencyPool):
+            inds = tuple(mi[0] for mi in multiInds)
+            return solver.getPolygonCatalogs(inds, [vertices], margin, *self._getCatalogArgs(bands),
+                                             numThreads=self.config.numThreads)[0]
+
+    def _getPolygonVertices(self, bbox, wcs):
+        """!Get the vertices of a polygon on the sky following a pixel box
+
+        @param[in] bbox  pixel box (an lsst.afw.geom.Box2D)
+        @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs)
+
+        @return list of vertices (afwGeom.SpherePoint), in order around the box
+        """
+        corners = bbox.getCorners()
+        numPerSide = self.config.polygonPointsPerSide
+        points = []
+        for start, end in zip(corners, corners[1:] + corners[:1]):
+            for i in range(numPerSide):
+                frac = i/numPerSide
+                points.append(afwGeom.Point2D(start.getX() + frac*(end.getX() - start.getX()),
+                                              start.getY() + frac*(end.getY() - start.getY())))
+        return wcs.pixelToSky(points)
+
+    def _queryTileCache(self, ctrCoordList, radiusList, bands=None):
+        """!Get reference objects in several circular sky regions through the tile cache
+
+        @param[in] ctrCoordList  centers of search regions (afwGeom.Coord)
+        @param[in] radiusList  radii of search regions (afwGeom.Angle)
+        @param[in] bands  list of reference filters whose magnitude columns to read, or None for all
+
+        @return list of reference catalogs (lsst.afw.table.SimpleCatalog), one per region
+        """
+        catalogArgs = self._getCatalogArgs(bands)
+        key = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in catalogArgs)
+
+        # Duplicates are removed by the tile cache after selecting the objects in each cone: removing
+        # them when reading a tile's bounding circle could drop the copy that lies within the tile
+        def readCones(ctrCoordList, radiusList):
+            return self._readCones(ctrCoordList, radiusList, bands, uniqueIds=False)
+
+        return self.tileCache.query(ctrCoordList, radiusList, readCones, key=key,
+                                    uniqueIds=self.andConfig.idColumn is not None)
+
+    def _getBands(self, filterName, bands=None):
+        """!Get the reference filters whose magnitude columns to read
+
+        @param[in] filterName  name of filter, or None for the default filter
+        @param[in] bands  list of reference filters requested explicitly, or None
+
+        @return list of reference filters, or None for all of those in andConfig.magColumnMap
+
+        @throw RuntimeError if bands includes a filter not in andConfig.magColumnMap
+        """
+        if bands is not None:
+            unknown = [band for band in bands if band not in self.andConfig.magColumnMap]
+            if unknown:
+                raise RuntimeError("Unknown reference filters %s; available filters are %s" %
+                                   (unknown, sorted(self.andConfig.magColumnMap.keys())))
+            # The bands with magnitude limits are needed to evaluate them
+            return list(bands) + sorted(set(self._getMagLimits()) - set(bands))
+        if not self.config.projectBands:
+            return None
+        if filterName is None:
+            filterName = self.config.defaultFilter
+        band = self.config.filterMap.get(filterName, filterName)
+        if band not in self.andConfig.magColumnMap:
+            # Read everything, so that getRefFluxField reports the problem as usual
+            return None
+        return [band] + sorted(set(self._getMagLimits()) - set([band]))
+
+    def _getMagLimits(self):
+        """!Get the magnitude limits on the reference objects to load
+
+        @return dict of reference filter: (minimum magnitude, maximum magnitude)
+        """
+        return dict((band, (self.config.minMagnitude.get(band, -float("inf")),
+                            self.config.maxMagnitude.get(band, float("inf")))) for
+                    band in set(self.config.minMagnitude) | set(self.config.maxMagnitude))
+
+    def _getCatalogArgs(self, bands=None, uniqueIds=True):
+        """!Get the solver.getCatalog arguments that follow the star kd-trees and search regions
+
+        @param[in] bands  list of reference filters whose magnitude columns to read, or None for all
+        @param[in] uniqueIds  eliminate duplicate IDs?
+
+        @return tuple of arguments:
+        - idColumn
+        - names of filters
+        - names of magnitude columns
+        - names of magnitude error columns
+        - star-galaxy column
+        - variability column
+        - whether to eliminate duplicate IDs
+        - names of filters with magnitude limits
+        - minimum magnitudes
+        - maximum magnitudes
+        - whether to only load photometric objects
+        - whether to exclude resolved objects
+        - whether to exclude variable objects
+        """
         names = []
         mcols = []
         ecols = []
         for col, mcol in self.andConfig.magColumnMap.items():
+            if bands is not None and col not in bands:
+                continue
             names.append(col)
             mcols.append(mcol)
             ecols.append(self.andConfig.magErrorColumnMap.get(col, ''))
-        margs = (names, mcols, ecols)
-
-        solver = self._getSolver()
-
-        # Find multi-index files within range
-        multiInds = self._getMIndexesWithinRange(ctrCoord, radius)
-
-        # compute solver.getCatalog arguments that follow the list of star kd-trees:
-        # - center equatorial angle (e.g. RA) in deg
-        # - center polar angle (e.g. Dec) in deg
-        # - radius, in deg
-        # - idColumn
-        # - (margs)
-        # - star-galaxy column
-        # - variability column
-        fixedArgTuple = (
-            ctrCoord,
-            radius,
+        magLimits = self._getMagLimits()
+        limitNames = sorted(magLimits)
+        return (
             self.andConfig.idColumn,
-        ) + margs + (
+            names,
+            mcols,
+            ecols,
             self.andConfig.starGalaxyColumn,
             self.andConfig.variableColumn,
-            True,  # eliminate duplicate IDs
+            uniqueIds,
+            limitNames,
+            [magLimits[name][0] for name in limitNames],
+            [magLimits[name][1] for name in limitNames],
+            self.config.requirePhotometric,
+            self.config.excludeResolved,
+            self.config.excludeVariable,
         )
 
-        self.log.debug("search for objects at %s with radius %s deg", ctrCoord, radius.asDegrees())
-        with LoadMultiIndexes(multiInds):
-            # We just want to pass the star kd-trees, so just pass the
-            # first element of each multi-index.
-            inds = tuple(mi[0] for mi in multiInds)
-            refCat = solver.getCatalog(inds, *fixedArgTuple)
+    def _warnDeprecated(self):
+        """Warn that a.net reference catalogs are deprecated, once per process"""
+        global _warnedDeprecated
+        if _warnedDeprecated:
+            return
+        _warnedDeprecated = True
+        self.log.warn("A.net reference catalogs will not be supported in the future.")
+        self.log.warn("See RFC-562 and RFC-575 for more details.")
+
+    def _finishRefCat(self, refCat, filterName, bands=None, wcs=None):
+        """!Finish a reference catalog read from the index files
+
+        @param[in] refCat  reference catalog, as read by solver.getCatalog
+        @param[in] filterName  name of filter, or None for the default filter
+        @param[in] bands  list of reference filters read, or None for all
+        @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs) with which to set the centroids, or None
 
-        self._addFluxAliases(schema=refCat.schema)
+        @return an lsst.pipe.base.Struct as returned by loadSkyCircle
+        """
+        if bands is None:
+            self._addFluxAliases(schema=refCat.schema)
+        else:
+            self._addBandFluxAliases(refCat.schema, bands)
 
         fluxField = getRefFluxField(schema=refCat.schema, filterName=filterName)
 
@@ -155,18 +609,76 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
         if not refCat.isContiguous():
             refCat = refCat.copy(deep=True)
 
-        # Update flux fields to be nJy. a.net catalogs do not have a conversion script.
-        self.log.warn("Loading A.net reference catalog with old style units in schema.")
-        self.log.warn("A.net reference catalogs will not be supported in the future.")
-        self.log.warn("See RFC-562 and RFC-575 for more details.")
-        refCat = convertToNanojansky(refCat, self.log)
+        if wcs is not None:
+            # transforms all the coordinates at once, and sets hasCentroid
+            afwTable.updateRefCentroids(wcs, refCat)
 
-        self.log.debug("found %d objects", len(refCat))
         return pipeBase.Struct(
             refCat=refCat,
             fluxField=fluxField,
         )
 
+    @staticmethod
+    def _trimToPixelBox(refCat, bbox):
+        """!Trim a reference catalog to a pixel box, using its centroids
+
+        This is LoadReferenceObjectsTask._trimToBBox, without transforming the
+        coordinates again or looping over the records.
+
+        @param[in] refCat  contiguous reference catalog, with centroids set
+        @param[in] bbox  pixel box (an lsst.afw.geom.Box2D)
+
+        @return contiguous catalog of the objects within the box
+        """
+        if len(refCat) == 0:
+            return refCat
+        x = refCat["centroid_x"]
+        y = refCat["centroid_y"]
+        # same criterion as Box2D.contains
+        minPoint = bbox.getMin()
+        maxPoint = bbox.getMax()
+        inside = (x >= minPoint.getX()) & (x < maxPoint.getX()) & (y >= minPoint.getY()) & (y < maxPoint.getY())
+        if np.all(inside):
+            return refCat
+        return refCat.subset(inside).copy(deep=True)
+
+    def _addBandFluxAliases(self, schema, bands):
+        """!Add the flux aliases of _addFluxAliases for the reference filters that were read
+
+        Aliases to reference filters that were not read are omitted, rather than raising.
+
+        @param[in,out] schema  schema of the reference catalog
+        @param[in] bands  list of reference filters read
+        """
+        aliasMap = schema.getAliasMap()
+        filterMap = list(self.config.filterMap.items())
+        if self.config.defaultFilter:
+            filterMap.insert(0, (None, self.config.defaultFilter))
+        for filterName, refFilterName in filterMap:
+            if refFilterName not in bands:
+                continue
+            camFluxName = filterName + "_camFlux" if filterName is not None else "camFlux"
+            aliasMap.set(camFluxName, refFilterName + "_flux")
+            if refFilterName + "_fluxErr" in schema:
+                aliasMap.set(camFluxName + "Err", refFilterName + "_fluxErr")
+
+    def preload(self, ctrCoord=None, radius=None):
+        """!Preload multi-index files, to be shared with forked processes
+
+        Preloaded multi-index files stay loaded for the lifetime of the process,
+        and processes forked afterwards (e.g., by multiprocessing) use them
+        without opening and mapping the files again.  This is worthwhile for
+        a fixed footprint that many forked workers will query.
+
+        @param[in] ctrCoord  center of region to preload (an afwGeom.Coord), or None to preload all
+        @param[in] radius  radius of region to preload (an afwGeom.Angle); ignored if ctrCoord is None
+
+        @return the number of multi-index files preloaded
+        """
+        self._readIndexFiles()
+        multiInds = None if ctrCoord is None else self._getMIndexesWithinRange(ctrCoord, radius)
+        return len(self.multiInds.preload(multiInds))
+
     @pipeBase.timeMethod
     def _readIndexFiles(self):
         """!Read all astrometry.net index files, if not already read
@@ -181,6 +693,18 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
             self.andConfig = getConfigFromEnvironment()
 
         self.multiInds = AstrometryNetCatalog(self.andConfig)
+        self.residencyPool = MultiIndexResidencyPool(
+            maxEntries=self.config.maxResidentIndexes,
+            maxBytes=self.config.maxResidentBytes,
+            maxFiles=self.config.maxResidentFiles,
+        )
+        self.tileCache = None
+        if self.config.tileCacheNside > 0:
+            self.tileCache = ReferenceTileCache(self.config.tileCacheNside, self.config.tileCacheMaxBytes)
+        self.queryCache = None
+        if self.config.queryCacheDir is not None:
+            self.queryCache = ReferenceQueryCache(self.config.queryCacheDir, self.config.queryCacheMaxBytes,
+                                                  fingerprint=self.multiInds.getFingerprint())
 
     def _getMIndexesWithinRange(self, ctrCoord, radius):
         """!Get list of muti-index objects within range
@@ -190,7 +714,18 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
 
         @return list of multiindex objects
         """
-        return [mi for mi in self.multiInds if mi.isWithinRange(ctrCoord, radius)]
+        return self.multiInds.getWithinRange(ctrCoord, radius)
+
+    def _getMIndexesWithinRangeBatch(self, ctrCoordList, radiusList):
+        """!Get list of multi-index objects within range of any of several search regions
+
+        @param[in] ctrCoordList  centers of search regions (afwGeom.Coord)
+        @param[in] radiusList  radii of search regions (afwGeom.Angle)
+
+        @return list of multiindex objects, in catalog order
+        """
+        positionLists = self.multiInds.getPositionsWithinRangeBatch(ctrCoordList, radiusList)
+        return [self.multiInds[i] for i in sorted(set().union(*positionLists))]
 
     def _getSolver(self):
         solver = astrometry_net.Solver()
@@ -202,16 +737,41 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
 
 class LoadMultiIndexes(object):
     """Context manager for loading and unloading astrometry.net multi-index files
+
+    If a MultiIndexResidencyPool is provided, the multi-indexes are acquired
+    from and released to the pool, which decides when to unload them;
+    otherwise they are unloaded on exit.  While loaded, the multi-indexes are
+    marked as in use, so their files are not closed when another thread
+    forks (see MultiIndexCache.closeFiles).
     """
 
-    def __init__(self, multiInds):
+    def __init__(self, multiInds, pool=None):
         self.multiInds = multiInds
+        self.pool = pool
 
     def __enter__(self):
-        for mi in self.multiInds:
-            mi.reload()
+        entered = []
+        try:
+            for mi in self.multiInds:
+                if self.pool is None:
+                    mi.reload()
+                else:
+                    self.pool.acquire(mi)
+                mi.addUser()
+                entered.append(mi)
+        except Exception:
+            # Don't leave the multi-indexes already entered marked as in use
+            self._exit(entered)
+            raise
         return self.multiInds
 
     def __exit__(self, typ, val, trace):
-        for mi in self.multiInds:
-            mi.unload()
+        self._exit(self.multiInds)
+
+    def _exit(self, multiInds):
+        for mi in multiInds:
+            mi.removeUser()
+            if self.pool is None:
+                mi.unload()
+            else:
+                self.pool.release(mi)
@@ -1,18 +1,28 @@
 from __future__ import absolute_import, division, print_function
 
-__all__ = ["getIndexPath", "getConfigFromEnvironment", "AstrometryNetCatalog", "generateCache"]
+__all__ = ["getIndexPath", "getCachePath", "getConfigFromEnvironment", "AstrometryNetCatalog",
+           "generateCache", "readCache", "MultiIndexResidencyPool"]
 
 from builtins import zip
 from builtins import range
 from builtins import object
+from collections import OrderedDict
+import errno
+import fcntl
+import hashlib
+import multiprocessing
 import os
+import tempfile
+import threading
+import time
+import weakref
 
 import numpy as np
 from astropy.io import fits
 
 import lsst.utils
 from lsst.log import Log
-from .astrometry_net import MultiIndex, healpixDistance
+from .astrometry_net import MultiIndex, healpixDistance, healpixDistances, healpixRangeSearch
 from .astrometryNetDataConfig import AstrometryNetDataConfig
 
 
@@ -37,6 +47,66 @@ def getIndexPath(fn):
     return os.path.join(andir, fn)
 
 
+def getCachePath(andConfig, writable=False):
+    """!Get the path to the catalog cache file for a configuration
+
+    The cache directory is, in order of preference:
+    - the 'cacheDir' of the configuration;
+    - the directory named by the ASTROMETRY_NET_CACHE_DIR environment variable;
+    - the astrometry_net_data directory (as for getIndexPath), if the
+      directory is writable;
+    - the astrometry_net_data directory, if the cache file exists there and
+      there is no cache file in the per-user cache directory (unless a
+      writable path is requested);
+    - the 'astrometry_net' directory in the per-user cache directory
+      ($XDG_CACHE_HOME, defaulting to ~/.cache).
+
+    A cache in a read-only astrometry_net_data directory that is stale is
+    therefore rebuilt in the per-user cache directory, which is then
+    preferred.
+
+    In the astrometry_net_data directory, the cache is named andCache.fits.
+    Elsewhere, the cache name includes a hash of the astrometry_net_data
+    directory and the index files in the configuration, so that a single
+    cache directory may serve several data directories and configurations.
+
+    No effort is made to confirm that the file exists, or that the directory
+    exists.
+
+    @param[in] andConfig  Configuration (an AstrometryNetDataConfig)
+    @param[in] writable   Only use the astrometry_net_data directory if it is writable?
+    @return the absolute path to the cache file
+    """
+    cacheDir = andConfig.cacheDir or os.environ.get("ASTROMETRY_NET_CACHE_DIR")
+    if not cacheDir:
+        defaultName = getIndexPath(AstrometryNetCatalog._cacheFilename)
+        if os.access(os.path.dirname(defaultName), os.W_OK):
+            return defaultName
+        userDir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        userName = _getHashedCachePath(os.path.join(userDir, "astrometry_net"), andConfig)
+        if writable or os.path.exists(userName) or not os.path.exists(defaultName):
+            return userName
+        return defaultName
+    return _getHashedCachePath(cacheDir, andConfig)
+
+
+def _getHashedCachePath(cacheDir, andConfig):
+    """!Get the path to the catalog cache file for a configuration in a cache directory
+
+    The cache name includes a hash of the astrometry_net_data directory and
+    the index files in the configuration.
+
+    @param[in] cacheDir   Cache directory
+    @param[in] andConfig  Configuration (an AstrometryNetDataConfig)
+    @return the absolute path to the cache file
+    """
+    key = hashlib.sha1(os.path.realpath(getIndexPath("")).encode())
+    for fnList in AstrometryNetCatalog._getIndexFiles(andConfig):
+        key.update(repr([str(fn) for fn in fnList]).encode())
+    filename = "%s-%s.fits" % (os.path.splitext(AstrometryNetCatalog._cacheFilename)[0], key.hexdigest()[:16])
+    return os.path.join(os.path.abspath(os.path.expanduser(cacheDir)), filename)
+
+
 def getConfigFromEnvironment():
     """Find the config file from the environment
 
@@ -60,21 +130,213 @@ def getConfigFromEnvironment():
     return andConfig
 
 
+class IndexMetadata(object):
+    """Metadata for an astrometry.net index
+
+    This is what is needed to plan which indices to use, without loading
+    the index (see MultiIndexCache.getMetadata).
+    """
+
+    def __init__(self, indexid, healpix, hpnside, nstars, nquads, scaleLower, scaleUpper):
+        """!Constructor
+
+        @param indexid     Index identifier
+        @param healpix     Healpix number
+        @param hpnside     Healpix nside
+        @param nstars      Number of stars
+        @param nquads      Number of quads
+        @param scaleLower  Lower limit of quad scale (arcsec)
+        @param scaleUpper  Upper limit of quad scale (arcsec)
+        """
+        self.indexid = int(indexid)
+        self.healpix = int(healpix)
+        self.hpnside = int(hpnside)
+        self.nstars = int(nstars)
+        self.nquads = int(nquads)
+        self.scaleLower = float(scaleLower)
+        self.scaleUpper = float(scaleUpper)
+
+    @classmethod
+    def fromIndex(cls, ind):
+        """Construct from an index_t"""
+        return cls(ind.indexid, ind.healpix, ind.hpnside, ind.nstars, ind.nquads,
+                   ind.index_scale_lower, ind.index_scale_upper)
+
+    def overlapsScaleRange(self, qlo, qhi):
+        """!Does the index overlap the provided range of quad scales?
+
+        This is the same test as index_t.overlapsScaleRange.
+
+        @param qlo  Lower limit of quad scale (arcsec)
+        @param qhi  Upper limit of quad scale (arcsec)
+        """
+        return not (qlo > self.scaleUpper or qhi < self.scaleLower)
+
+
+class CacheLock(object):
+    """Context manager for an advisory lock on a cache file
+
+    The lock is held on a separate lock file (the cache filename with
+    '.lock' appended), because the cache file itself is replaced when it
+    is written.  Readers take a shared lock, and a process regenerating the
+    cache takes an exclusive lock, so that readers wait for regeneration
+    to finish and only one process regenerates at a time.
+
+    If the lock cannot be acquired within the timeout, or the lock file
+    cannot be created (e.g., a read-only directory), the context is entered
+    without the lock, and the 'locked' attribute is False.
+    """
+
+    pollInterval = 0.1  # Interval (sec) between attempts to acquire the lock
+
+    def __init__(self, filename, exclusive=False, timeout=0.0):
+        """!Constructor
+
+        @param filename   Name of the cache file to lock
+        @param exclusive  Take an exclusive lock (for writing), rather than a shared lock (for reading)?
+        @param timeout    Maximum time (sec) to wait for the lock
+        """
+        self.lockName = filename + ".lock"
+        self.exclusive = exclusive
+        self.timeout = timeout
+        self.locked = False
+        self._fd = None
+
+    def __enter__(self):
+        try:
+            self._fd = os.open(self.lockName, os.O_RDWR | os.O_CREAT, 0o666)
+        except (IOError, OSError):
+            return self
+        operation = (fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self._fd, operation)
+                self.locked = True
+                break
+            except (IOError, OSError) as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES) or time.time() >= deadline:
+                    break
+            time.sleep(self.pollInterval)
+        return self
+
+    def __exit__(self, typ, val, trace):
+        if self._fd is not None:
+            if self.locked:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        self._fd = None
+        self.locked = False
+
+
+class IndexFileStat(object):
+    """The size, modification time and content fingerprint of an index file
+
+    Used to determine whether an index file has changed since its metadata
+    was read.  The size and modification time are cheap to check; the
+    fingerprint (see 'computeFingerprint') distinguishes files whose content
+    is unchanged but whose modification time has changed (e.g., copied or
+    touched).
+    """
+
+    def __init__(self, size, mtime=None, fingerprint=None):
+        """!Constructor
+
+        @param size   Size of the file (bytes); zero if the file does not exist
+        @param mtime  Modification time of the file (seconds since the epoch), or None if unknown
+        @param fingerprint  Content fingerprint of the file, or None if unknown
+        """
+        self.size = int(size)
+        self.mtime = None if mtime is None else float(mtime)
+        self.fingerprint = fingerprint or None
+
+    @classmethod
+    def fromFilename(cls, filename, fingerprint=False):
+        """!Construct from the file, which need not exist
+
+        @param filename     Name of file
+        @param fingerprint  Compute the content fingerprint?
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return cls(0)
+        return cls(st.st_size, st.st_mtime, cls.computeFingerprint(filename) if fingerprint else None)
+
+    @staticmethod
+    def computeFingerprint(filename, blockSize=65536, numSamples=16):
+        """!Compute a fast fingerprint of the content of a file
+
+        Rather than reading the whole file, the fingerprint is a hash of the
+        size, the first and last blocks (which include the FITS headers
+        holding the index metadata) and small blocks sampled evenly through
+        the file.
+
+        @param filename    Name of file
+        @param blockSize   Size of the first and last blocks (bytes)
+        @param numSamples  Number of sampled blocks, each of size blockSize/16
+        @return hexadecimal digest
+        """
+        size = os.path.getsize(filename)
+        digest = hashlib.sha1(str(size).encode())
+        offsets = [0, max(0, size - blockSize)]
+        offsets += [(size*(i + 1))//(numSamples + 1) for i in range(numSamples)]
+        with open(filename, "rb") as fd:
+            for i, offset in enumerate(offsets):
+                fd.seek(offset)
+                digest.update(fd.read(blockSize if i < 2 else blockSize//16))
+        return digest.hexdigest()
+
+    def revalidate(self, filename):
+        """!Check whether a file is unchanged
+
+        @param filename  Name of file
+        @return an IndexFileStat for the current file if its content is
+            unchanged (which is self if the modification time is also
+            unchanged), otherwise None
+        """
+        current = self.fromFilename(filename)
+        if self.mtime is None or current.size != self.size:
+            return None
+        if current.mtime == self.mtime:
+            return self
+        if self.fingerprint is None or self.computeFingerprint(filename) != self.fingerprint:
+            return None
+        current.fingerprint = self.fingerprint
+        return current
+
+    def __eq__(self, other):
+        return (self.size == other.size and self.mtime == other.mtime and
+                self.fingerprint == other.fingerprint)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
 class MultiIndexCache(object):
     """A wrapper for the multiindex_t, which only reads the data when it
     needs to
 
     The MultiIndexCache may be instantiated directly, or via the
     'fromFilenameList' class method, which loads it from a list of filenames.
+
+    Loading and unloading are serialised with a lock, as they release the
+    GIL; a MultiIndexCache may be used by several threads, but loading and
+    unloading should be coordinated (e.g., by a MultiIndexResidencyPool) so
+    that one thread does not unload indices that another is using.
     """
 
-    def __init__(self, filenameList, healpix, nside):
+    def __init__(self, filenameList, healpix, nside, metadata=None, fileStats=None):
         """!Constructor
 
         @param filenameList  List of filenames; first is the multiindex, then
                              follows the individual index files
         @param healpix       Healpix number
         @param nside         Healpix nside
+        @param metadata      List of IndexMetadata for each index, or None to
+                             read from the indices when required
+        @param fileStats     List of IndexFileStat for each file, or None
+                             to get from the filesystem when required
         """
         if len(filenameList) < 2:
             raise RuntimeError("Insufficient filenames provided for multiindex (%s): expected >= 2" %
@@ -84,6 +346,12 @@ class MultiIndexCache(object):
         self._nside = int(nside)
         self._mi = None
         self._loaded = False
+        self._preloaded = False
+        self._numUsers = 0
+        self._metadata = metadata
+        self._fileStats = fileStats
+        self._numBytes = None
+        self._lock = threading.RLock()
         self.log = Log.getDefaultLogger()
 
     @classmethod
@@ -92,60 +360,188 @@ class MultiIndexCache(object):
 
         The list of filenames should contain the multiindex filename first,
         then the individual index filenames.  The healpix and nside are
-        determined by reading the indices, so this is not very efficient.
+        determined by reading the metadata of the indices.
         """
-        self = cls(filenameList, 0, 0)
-        self.reload()
-        healpixes = set(self[i].healpix for i in range(len(self)))
-        nsides = set(self[i].hpnside for i in range(len(self)))
-        assert len(healpixes) == 1
-        assert len(nsides) == 1
-        self._healpix = healpixes.pop()
-        self._nside = nsides.pop()
-        return self
+        healpix, nside, metadata, fileStats = _readMultiIndexMetadata(filenameList)
+        return cls(filenameList, healpix, nside, metadata=metadata, fileStats=fileStats)
 
     def read(self):
         """Read the indices"""
-        if self._mi is not None:
-            return
-        fn = getIndexPath(self._filenameList[0])
-        if not os.path.exists(fn):
-            raise RuntimeError(
-                "Unable to get filename for astrometry star file %s" % (self._filenameList[0],))
-        self._mi = MultiIndex(fn)
-        if self._mi is None:
-            # Can't proceed at all without stars
-            raise RuntimeError('Failed to read stars from astrometry multiindex filename "%s"' % fn)
-        for i, fn in enumerate(self._filenameList[1:]):
-            if fn is None:
-                self.log.debug('Unable to find index part of multiindex %s', fn)
-                continue
-            fn = getIndexPath(fn)
+        with self._lock:
+            if self._mi is not None:
+                return
+            fn = getIndexPath(self._filenameList[0])
             if not os.path.exists(fn):
-                self.log.warn("Unable to get filename for astrometry index %s", fn)
-                continue
-            self.log.debug('Reading index from multiindex file "%s"', fn)
-            self._mi.addIndex(fn, False)
-            ind = self._mi[i]
-            self.log.debug('  index %i, hp %i (nside %i), nstars %i, nquads %i',
-                           ind.indexid, ind.healpix, ind.hpnside, ind.nstars, ind.nquads)
+                raise RuntimeError(
+                    "Unable to get filename for astrometry star file %s" % (self._filenameList[0],))
+            self._mi = MultiIndex(fn)
+            if self._mi is None:
+                # Can't proceed at all without stars
+                raise RuntimeError('Failed to read stars from astrometry multiindex filename "%s"' % fn)
+            for i, fn in enumerate(self._filenameList[1:]):
+                if fn is None:
+                    self.log.debug('Unable to find index part of multiindex %s', fn)
+                    continue
+                fn = getIndexPath(fn)
+                if not os.path.exists(fn):
+                    self.log.warn("Unable to get filename for astrometry index %s", fn)
+                    continue
+                self.log.debug('Reading index from multiindex file "%s"', fn)
+                self._mi.addIndex(fn, False)
+                ind = self._mi[i]
+                self.log.debug('  index %i, hp %i (nside %i), nstars %i, nquads %i',
+                               ind.indexid, ind.healpix, ind.hpnside, ind.nstars, ind.nquads)
 
     def reload(self):
         """Reload the indices."""
-        if self._loaded:
-            return
-        if self._mi is None:
-            self.read()
-        else:
-            self._mi.reload()
-        self._loaded = True
+        with self._lock:
+            if self._loaded:
+                return
+            if self._mi is None:
+                self.read()
+            else:
+                self._mi.reload()
+            self._loaded = True
+            _loadedMultiIndexes.add(self)
 
     def unload(self):
-        """Unload the indices"""
-        if not self._loaded:
-            return
-        self._mi.unload()
-        self._loaded = False
+        """Unload the indices
+
+        Preloaded indices (see 'preload') are not unloaded.
+        """
+        with self._lock:
+            if not self._loaded or self._preloaded:
+                return
+            self._mi.unload()
+            self._loaded = False
+            _loadedMultiIndexes.discard(self)
+
+    def preload(self):
+        """Load the indices for the lifetime of the process
+
+        The files are closed once the indices are loaded; the data remain
+        memory-mapped, so processes forked afterwards share them (copy-on-write)
+        instead of reopening and mapping the files, and no file handles or
+        file offsets are shared between processes.  Preloaded indices are not
+        unloaded by 'unload'.
+        """
+        with self._lock:
+            self.reload()
+            self._mi.closeFiles()
+            self._preloaded = True
+
+    def closeFiles(self):
+        """Close the files held open by the loaded indices
+
+        The data remain memory-mapped; files are reopened as required.  The
+        files of indices in use (see 'addUser') are not closed, since a query
+        may be reading them.
+
+        @return True if the files were closed (or none were open), False if
+            the indices are in use
+        """
+        with self._lock:
+            if self._numUsers > 0:
+                return False
+            if self._loaded:
+                self._mi.closeFiles()
+            return True
+
+    def addUser(self):
+        """Mark the indices as in use by a query, so their files are not closed
+
+        The indices must be loaded; each call must be matched by a call to
+        'removeUser' when the query is done.
+        """
+        with self._lock:
+            self._numUsers += 1
+
+    def removeUser(self):
+        """Mark the end of a use registered with 'addUser'"""
+        with self._lock:
+            if self._numUsers <= 0:
+                raise RuntimeError("Multi-index %s is not in use" % (self._filenameList[0],))
+            self._numUsers -= 1
+
+    def isInUse(self):
+        """Are the indices in use by a query (see 'addUser')?"""
+        return self._numUsers > 0
+
+    def isLoaded(self):
+        """Are the indices currently loaded?"""
+        return self._loaded
+
+    def isPreloaded(self):
+        """Have the indices been preloaded (see 'preload')?"""
+        return self._preloaded
+
+    def getNumFiles(self):
+        """Get the number of distinct files opened when the indices are loaded"""
+        return len(set(self._filenameList))
+
+    def getMetadata(self, i):
+        """!Get the metadata for an index
+
+        The metadata is read from the indices if it was not provided on
+        construction.
+
+        @param i  Index of the index in the multi-index
+        @return IndexMetadata
+        """
+        with self._lock:
+            if self._metadata is None:
+                wasLoaded = self._loaded
+                self.reload()
+                try:
+                    self._metadata = [IndexMetadata.fromIndex(self._mi[j]) for j in range(len(self))]
+                finally:
+                    if not wasLoaded:
+                        self.unload()
+            return self._metadata[i]
+
+    def getFileStats(self):
+        """Get the IndexFileStat for each file in the multi-index"""
+        if self._fileStats is None:
+            self._fileStats = [IndexFileStat.fromFilename(getIndexPath(fn)) if fn is not None else
+                               IndexFileStat(0) for fn in self._filenameList]
+        return self._fileStats
+
+    def getFileSizes(self):
+        """Get the size (bytes) of each file in the multi-index
+
+        Files that do not exist have size zero.
+        """
+        return [stat.size for stat in self.getFileStats()]
+
+    def revalidate(self):
+        """Check whether the files are unchanged since their metadata was recorded
+
+        Files with an unchanged size and modification time are taken to be
+        unchanged; if only the modification time has changed, the content
+        fingerprint is checked, and the recorded modification time updated
+        if the content is unchanged.
+
+        This is False if the metadata or file modification times are not known.
+        """
+        if self._metadata is None or self._fileStats is None:
+            return False
+        fileStats = [stat.revalidate(getIndexPath(fn)) if fn is not None else stat for fn, stat in
+                     zip(self._filenameList, self._fileStats)]
+        if any(stat is None for stat in fileStats):
+            return False
+        if any(new is not old for new, old in zip(fileStats, self._fileStats)):
+            self._fileStats = fileStats
+        return True
+
+    def getNumBytes(self):
+        """Get the number of bytes mapped when the indices are loaded
+
+        This is estimated as the total size of the files.
+        """
+        if self._numBytes is None:
+            sizes = dict(zip(self._filenameList, self.getFileSizes()))
+            self._numBytes = sum(sizes.values())
+        return self._numBytes
 
     def isWithinRange(self, coord, distance):
         """!Is the index within range of the provided coordinates?
@@ -167,6 +563,178 @@ class MultiIndexCache(object):
         return iter(self._mi)
 
 
+class MultiIndexResidencyPool(object):
+    """Keep recently used multi-indexes loaded, within a budget
+
+    Loading a multi-index opens and maps its files, which is expensive to
+    repeat for every query when successive queries (e.g., adjacent CCDs) use
+    the same multi-indexes.  Multi-indexes are pinned while in use (see
+    'acquire' and 'release'), and stay loaded after release until the budget
+    is exceeded, when the least recently used are unloaded.  Pinned
+    multi-indexes are never unloaded, so the budget may be temporarily
+    exceeded while many are in use.  Preloaded multi-indexes (see
+    MultiIndexCache.preload) are permanently loaded, so are not tracked
+    and do not count against the budget.
+
+    The 'hits', 'misses' and 'evictions' attributes count the number of
+    acquisitions of an already-loaded multi-index, the number of
+    acquisitions that required loading, and the number of multi-indexes
+    unloaded to keep within the budget.
+
+    The pool may be shared between threads: acquisition and release are
+    serialised with a lock, so a multi-index is loaded once however many
+    threads acquire it, and is not unloaded while any thread has it pinned.
+    """
+
+    def __init__(self, maxEntries=0, maxBytes=None, maxFiles=None):
+        """!Constructor
+
+        @param maxEntries  Maximum number of multi-indexes to keep loaded; 0 to
+                           unload each multi-index as soon as it is released
+        @param maxBytes    Maximum number of bytes to keep mapped, or None for no limit
+        @param maxFiles    Maximum number of files to keep open, or None for no limit
+        """
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.maxFiles = maxFiles
+        self._resident = OrderedDict()  # MultiIndexCache --> pin count; least recently used first
+        self._numBytes = 0
+        self._numFiles = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, mi):
+        """!Load a multi-index (if not already loaded), and pin it
+
+        @param mi  MultiIndexCache to load
+        """
+        with self._lock:
+            if mi.isPreloaded():
+                self.hits += 1
+                return
+            if mi in self._resident and mi.isLoaded():
+                self.hits += 1
+                count = self._resident.pop(mi)
+            else:
+                self.misses += 1
+                count = self._resident.pop(mi, None)
+                if count is None:
+                    count = 0
+                    self._numBytes += mi.getNumBytes()
+                    self._numFiles += mi.getNumFiles()
+                self._resident[mi] = count  # keep the accounting if loading fails
+                mi.reload()
+            self._resident[mi] = count + 1
+
+    def release(self, mi):
+        """!Unpin a multi-index, unloading multi-indexes as required by the budget
+
+        @param mi  MultiIndexCache that was acquired
+        """
+        with self._lock:
+            if mi.isPreloaded():
+                return
+            count = self._resident.get(mi, 0)
+            if count <= 0:
+                raise RuntimeError("Multi-index %s has not been acquired" % (mi._filenameList[0],))
+            self._resident[mi] = count - 1
+            self._evict()
+
+    def clear(self):
+        """Unload all multi-indexes that are not in use"""
+        with self._lock:
+            self._evict(force=True)
+
+    def _isOverBudget(self):
+        return (len(self._resident) > self.maxEntries or
+                (self.maxBytes is not None and self._numBytes > self.maxBytes) or
+                (self.maxFiles is not None and self._numFiles > self.maxFiles))
+
+    def _evict(self, force=False):
+        """Unload the least recently used multi-indexes not in use until within the budget
+
+        The lock must be held.
+
+        @param force  Unload all multi-indexes not in use, regardless of the budget?
+        """
+        for mi, count in list(self._resident.items()):
+            if not (force or self._isOverBudget()):
+                break
+            if count > 0:
+                continue
+            del self._resident[mi]
+            self._numBytes -= mi.getNumBytes()
+            self._numFiles -= mi.getNumFiles()
+            mi.unload()
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._resident)
+
+
+class HealpixIndex(object):
+    """A spatial index over a list of multi-indexes, keyed by (nside, healpix)
+
+    Rather than calculating the distance to every multi-index, a cone query
+    visits only the healpixes within range (for each nside present) and
+    looks up the multi-indexes covering them.  Multi-indexes without a
+    healpix (healpix == -1) cover the whole sky, and are always in range.
+
+    The results are identical to calling MultiIndexCache.isWithinRange on
+    each multi-index in turn.
+    """
+
+    def __init__(self, multiInds):
+        """!Constructor
+
+        @param multiInds  List of MultiIndexCache
+        """
+        self._healpix = np.array([mi._healpix for mi in multiInds], dtype=np.intc)
+        self._nside = np.array([mi._nside for mi in multiInds], dtype=np.intc)
+        self._allSky = []
+        self._byNside = {}
+        for i, mi in enumerate(multiInds):
+            if mi._healpix == -1:
+                self._allSky.append(i)
+            else:
+                self._byNside.setdefault(mi._nside, {}).setdefault(mi._healpix, []).append(i)
+
+    def getWithinRange(self, coord, distance):
+        """!Get the positions of the multi-indexes within range of the provided coordinates
+
+        @param coord   ICRS coordinate to check (lsst.afw.geom.SpherePoint)
+        @param distance   Angular distance (lsst.afw.geom.Angle)
+        @return sorted list of positions in the list of multi-indexes
+        """
+        found = list(self._allSky)
+        for nside, healpixes in self._byNside.items():
+            for hp in healpixRangeSearch(coord, distance, nside):
+                found.extend(healpixes.get(hp, []))
+        return sorted(found)
+
+    def getWithinRangeBatch(self, coordList, distanceList):
+        """!Get the positions of the multi-indexes within range of each of several cones
+
+        The distances from every cone to every multi-index are calculated in a
+        single call, which is cheaper than a query per cone when there are
+        many cones (e.g., all the CCDs in a visit).
+
+        @param coordList   List of ICRS coordinates to check (lsst.afw.geom.SpherePoint)
+        @param distanceList   List of angular distances (lsst.afw.geom.Angle), one per coordinate
+        @return list (one per cone) of sorted lists of positions in the list of multi-indexes
+        """
+        if len(coordList) != len(distanceList):
+            raise RuntimeError("Length of coordList (%d) and distanceList (%d) differ" %
+                               (len(coordList), len(distanceList)))
+        ra = np.array([coord.getLongitude().asDegrees() for coord in coordList], dtype=float)
+        dec = np.array([coord.getLatitude().asDegrees() for coord in coordList], dtype=float)
+        radius = np.array([distance.asRadians() for distance in distanceList], dtype=float)
+        distances = healpixDistances(self._healpix, self._nside, ra, dec)
+        return [np.flatnonzero(row <= rr).tolist() for row, rr in zip(distances, radius)]
+
+
 class AstrometryNetCatalog(object):
     """An interface to an astrometry.net catalog
 
@@ -177,35 +745,101 @@ class AstrometryNetCatalog(object):
     alternative class methods.
     """
     _cacheFilename = "andCache.fits"
+    _cacheVersion = 4
 
-    def __init__(self, andConfig):
+    def __init__(self, andConfig, useCache=True, processes=1, previous=None):
         """!Constructor
 
         @param andConfig   Configuration (an AstrometryNetDataConfig)
+        @param useCache    Use the cache file, if it exists and andConfig allows it?
+        @param processes   Number of processes to use when reading the index files
+        @param previous    List of MultiIndexCache (e.g., from readCache) to reuse
+                           when reading the index files, for multi-indexes whose
+                           files have not changed
         """
         self.config = andConfig
-        cacheName = getIndexPath(self._cacheFilename)
-        if self.config.allowCache and os.path.exists(cacheName):
-            self._initFromCache(cacheName)
+        self.log = Log.getDefaultLogger()
+        if useCache and self.config.allowCache:
+            self._cacheName = getCachePath(self.config)
+            self._initFromCache(self._cacheName, processes=processes)
         else:
-            self._initFromIndexFiles(self.config)
+            self._cacheName = getCachePath(self.config, writable=True)
+            self._initFromIndexFiles(self.config, processes=processes, previous=previous)
+        self._healpixIndex = HealpixIndex(self._multiInds)
+
+    def _initFromIndexFiles(self, andConfig, processes=1, previous=None):
+        """Initialise from the index files in an AstrometryNetDataConfig
+
+        Only the metadata of the index files is read, using a pool of
+        'processes' processes.  Multi-indexes in 'previous' whose files
+        are unchanged are reused without reading the files.
+
+        @return True if the result differs from 'previous' (multi-indexes
+            were read, dropped or reordered, or file modification times were
+            updated)
+        """
+        previous = list(previous or [])
+        indexFiles = self._getIndexFiles(andConfig)
+        self._multiInds, updated = self._reuseMultiIndexes(indexFiles, previous)
+        toRead = [i for i, mi in enumerate(self._multiInds) if mi is None]
+        if toRead and previous:
+            self.log.info("Reading %d of %d multi-indexes that are new or changed",
+                          len(toRead), len(indexFiles))
+        readList = _readMultiIndexes([indexFiles[i] for i in toRead], processes)
+        for i, mi in zip(toRead, readList):
+            self._multiInds[i] = mi
+        return updated or self._multiInds != previous
+
+    @staticmethod
+    def _getIndexFiles(andConfig):
+        """Get the list of filename lists for each multi-index in an AstrometryNetDataConfig"""
+        return list(zip(andConfig.indexFiles, andConfig.indexFiles)) + andConfig.multiIndexFiles
 
-    def _initFromIndexFiles(self, andConfig):
-        """Initialise from the index files in an AstrometryNetDataConfig"""
-        indexFiles = list(zip(andConfig.indexFiles, andConfig.indexFiles)) + andConfig.multiIndexFiles
-        self._multiInds = [MultiIndexCache.fromFilenameList(fnList) for fnList in indexFiles]
+    @staticmethod
+    def _reuseMultiIndexes(indexFiles, previous):
+        """!Match multi-indexes whose files are unchanged to a list of filename lists
+
+        @param indexFiles  List of filename lists, as for MultiIndexCache
+        @param previous    List of MultiIndexCache to reuse
+        @return list of MultiIndexCache (None where there is no unchanged
+            multi-index for the filename list), and whether any file
+            modification times were updated
+        """
+        reusable = {}
+        updated = False
+        for mi in previous:
+            fileStats = mi._fileStats
+            if mi.revalidate():
+                reusable.setdefault(tuple(mi._filenameList), []).append(mi)
+                updated |= mi._fileStats is not fileStats
+        multiInds = []
+        for fnList in indexFiles:
+            candidates = reusable.get(tuple(fnList))
+            multiInds.append(candidates.pop(0) if candidates else None)
+        return multiInds, updated
 
     def writeCache(self):
         """Write a cache file
 
+        The cache is written to the path given by getCachePath.
+
         The cache file is a FITS file with all the required information to
         build the AstrometryNetCatalog quickly.  The first table extension
         contains a row for each multiindex, storing the healpix and nside
         values.  The second table extension contains a row for each filename
-        in all the multiindexes.  The two may be JOINed through the 'id'
-        column.
+        in all the multiindexes, with the size, modification time and content
+        fingerprint of the file and the metadata for the index it contains
+        (the first filename in each multiindex is the star file, for which
+        the index metadata is blank).  The two may be JOINed through the
+        'id' column.  The format version is recorded in the VERSION keyword
+        of the primary header.
+
+        The file is written to a temporary file which is then renamed, so
+        readers never see a partially-written cache.  Writers should hold
+        an exclusive CacheLock.
         """
-        outName = getIndexPath(self._cacheFilename)
+        outName = self._cacheName
+        _makeCacheDir(outName)
         numFilenames = sum(len(ind._filenameList) for ind in self._multiInds)
         maxLength = max(len(fn) for ind in self._multiInds for fn in ind._filenameList) + 1
 
@@ -221,39 +855,175 @@ class AstrometryNetCatalog(object):
         # Second table
         second = fits.BinTableHDU.from_columns([fits.Column(name="id", format="K"),
                                                 fits.Column(name="filename", format="%dA" % (maxLength)),
+                                                fits.Column(name="size", format="K"),
+                                                fits.Column(name="mtime", format="D"),
+                                                fits.Column(name="fingerprint", format="40A"),
+                                                fits.Column(name="indexid", format="K"),
+                                                fits.Column(name="nstars", format="K"),
+                                                fits.Column(name="nquads", format="K"),
+                                                fits.Column(name="scale_lo", format="D"),
+                                                fits.Column(name="scale_hi", format="D"),
                                                 ], nrows=numFilenames)
         ident = second.data.field("id")
         filenames = second.data.field("filename")
+        sizes = second.data.field("size")
+        mtimes = second.data.field("mtime")
+        fingerprints = second.data.field("fingerprint")
+        indexids = second.data.field("indexid")
+        nstars = second.data.field("nstars")
+        nquads = second.data.field("nquads")
+        scaleLo = second.data.field("scale_lo")
+        scaleHi = second.data.field("scale_hi")
         i = 0
         for j, ind in enumerate(self._multiInds):
-            for fn in ind._filenameList:
+            for k, (fn, stat) in enumerate(zip(ind._filenameList, ind.getFileStats())):
                 ident[i] = j
                 filenames[i] = fn
+                sizes[i] = stat.size
+                mtimes[i] = np.nan if stat.mtime is None else stat.mtime
+                fingerprints[i] = stat.fingerprint or ""
+                if k == 0:
+                    indexids[i] = nstars[i] = nquads[i] = -1
+                    scaleLo[i] = scaleHi[i] = np.nan
+                else:
+                    meta = ind.getMetadata(k - 1)
+                    indexids[i] = meta.indexid
+                    nstars[i] = meta.nstars
+                    nquads[i] = meta.nquads
+                    scaleLo[i] = meta.scaleLower
+                    scaleHi[i] = meta.scaleUpper
                 i += 1
 
-        fits.HDUList([fits.PrimaryHDU(), first, second]).writeto(outName, overwrite=True)
+        primary = fits.PrimaryHDU()
+        primary.header["VERSION"] = (self._cacheVersion, "AstrometryNetCatalog cache format version")
+        fd, tempName = tempfile.mkstemp(dir=os.path.dirname(outName), prefix=".andCache-", suffix=".fits")
+        os.close(fd)
+        try:
+            fits.HDUList([primary, first, second]).writeto(tempName, overwrite=True)
+            # mkstemp creates the file readable only by the owner
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tempName, 0o666 & ~umask)
+            os.rename(tempName, outName)
+        except Exception:
+            if os.path.exists(tempName):
+                os.unlink(tempName)
+            raise
 
-    def _initFromCache(self, filename):
+    def _initFromCache(self, filename, processes=1):
         """Initialise from a cache file
 
         Ingest the cache file written by the 'writeCache' method and
         use that to quickly instantiate the AstrometryNetCatalog.
+
+        If the cache is missing or stale (files have changed, or the
+        configuration has changed), the stale or missing entries are read
+        from the index files and the cache file rewritten.  This is
+        coordinated between processes with a CacheLock, so that only one
+        process regenerates the cache while the others wait (up to the
+        configured cacheLockTimeout) and then read the new cache; a process
+        that cannot get the lock reads the index files without writing.
+
+        If the cache is stale and its directory is not writable (e.g., a
+        read-only astrometry_net_data), the cache is rebuilt in the writable
+        location given by getCachePath, starting from the stale entries.
+        """
+        timeout = self.config.cacheLockTimeout
+        _makeCacheDir(filename)
+        with CacheLock(filename, exclusive=False, timeout=timeout):
+            cached = readCache(filename) if os.path.exists(filename) else []
+        multiInds, updated = self._reuseMultiIndexes(self._getIndexFiles(self.config), cached)
+        if not updated and multiInds == cached:
+            self._multiInds = multiInds
+            return
+
+        writableName = getCachePath(self.config, writable=True)
+        if writableName != filename:
+            self.log.info("Astrometry.net cache file %s is stale and cannot be updated; using %s",
+                          filename, writableName)
+            filename = self._cacheName = writableName
+            _makeCacheDir(filename)
+
+        with CacheLock(filename, exclusive=True, timeout=timeout) as lock:
+            if lock.locked:
+                # The cache may have been regenerated while we were waiting for the lock
+                exists = os.path.exists(filename)
+                if exists:
+                    cached = readCache(filename)
+                updated = self._initFromIndexFiles(self.config, processes=processes, previous=cached)
+                if updated or not exists:
+                    self.log.info("Updating astrometry.net cache file %s", filename)
+                    try:
+                        self.writeCache()
+                    except (IOError, OSError) as exc:
+                        self.log.warn("Unable to update astrometry.net cache file %s: %s", filename, exc)
+                return
+
+        self.log.info("Unable to lock astrometry.net cache file %s; not updating it", filename)
+        self._initFromIndexFiles(self.config, processes=processes, previous=cached)
+
+    def getFingerprint(self):
+        """Get a fingerprint of the index files, which changes when the files change
+
+        The fingerprint is a hash of the filenames of every multi-index and the
+        size and content fingerprint (or, if unknown, the modification time) of
+        each file, as recorded when the catalog was constructed.
         """
-        with fits.open(filename) as hduList:
-            first = hduList[1].data
-            second = hduList[2].data
+        sha = hashlib.sha1()
+        for mi in self._multiInds:
+            for fn, stat in zip(mi._filenameList, mi.getFileStats()):
+                version = stat.fingerprint if stat.fingerprint is not None else stat.mtime
+                sha.update(repr((fn, stat.size, version)).encode())
+        return sha.hexdigest()
 
-            # first JOIN second USING(id)
-            filenames = {i: [] for i in first.field("id")}
-            for id2, fn in zip(second.field("id"), second.field("filename")):
-                filenames[id2].append(fn)
-            self._multiInds = [MultiIndexCache(filenames[i], hp, nside) for i, hp, nside in
-                               zip(first.field("id"), first.field("healpix"), first.field("nside"))]
+    def preload(self, multiInds=None):
+        """!Preload multi-indexes, to be shared with forked processes
 
-        # Check for consistency
-        cacheFiles = set(second.field("filename"))
-        configFiles = set(sum(self.config.multiIndexFiles, []) + self.config.indexFiles)
-        assert(cacheFiles == configFiles)
+        The multi-indexes are loaded for the lifetime of the process, and their
+        files closed (see MultiIndexCache.preload).  Preloading in a parent
+        process before forking workers saves each worker from opening and
+        mapping the files, and the memory is shared between the workers.
+
+        @param multiInds  List of multi-indexes (MultiIndexCache) to preload,
+                          e.g., from getWithinRange; or None to preload all
+        @return list of preloaded multi-indexes
+        """
+        if multiInds is None:
+            multiInds = self._multiInds
+        for mi in multiInds:
+            mi.preload()
+        self.log.info("Preloaded %d of %d multi-indexes (%d bytes) in process %d",
+                      len(multiInds), len(self._multiInds), sum(mi.getNumBytes() for mi in multiInds),
+                      os.getpid())
+        return multiInds
+
+    def getWithinRange(self, coord, distance):
+        """!Get the multi-indexes within range of the provided coordinates
+
+        @param coord   ICRS coordinate to check (lsst.afw.geom.SpherePoint)
+        @param distance   Angular distance (lsst.afw.geom.Angle)
+        @return list of MultiIndexCache, in catalog order
+        """
+        return [self._multiInds[i] for i in self._healpixIndex.getWithinRange(coord, distance)]
+
+    def getWithinRangeBatch(self, coordList, distanceList):
+        """!Get the multi-indexes within range of each of several cones
+
+        @param coordList   List of ICRS coordinates to check (lsst.afw.geom.SpherePoint)
+        @param distanceList   List of angular distances (lsst.afw.geom.Angle), one per coordinate
+        @return list (one per cone) of lists of MultiIndexCache, in catalog order
+        """
+        return [[self._multiInds[i] for i in positions] for positions in
+                self.getPositionsWithinRangeBatch(coordList, distanceList)]
+
+    def getPositionsWithinRangeBatch(self, coordList, distanceList):
+        """!Get the positions (in this catalog) of the multi-indexes within range of each of several cones
+
+        @param coordList   List of ICRS coordinates to check (lsst.afw.geom.SpherePoint)
+        @param distanceList   List of angular distances (lsst.afw.geom.Angle), one per coordinate
+        @return list (one per cone) of sorted lists of positions
+        """
+        return self._healpixIndex.getWithinRangeBatch(coordList, distanceList)
 
     def __getitem__(self, ii):
         return self._multiInds[ii]
@@ -265,15 +1035,191 @@ class AstrometryNetCatalog(object):
         return len(self._multiInds)
 
 
-def generateCache(andConfig=None):
-    """Generate a cache file"""
+def readCache(filename):
+    """!Read a cache file written by AstrometryNetCatalog.writeCache
+
+    Version 1 cache files provide only the healpix, nside and filenames
+    of each multi-index; version 2 adds the file sizes and index metadata;
+    version 3 adds the file modification times; version 4 adds the file
+    content fingerprints.
+
+    @param filename  Name of cache file
+    @return list of MultiIndexCache
+    """
+    with fits.open(filename) as hduList:
+        version = hduList[0].header.get("VERSION", 1)
+        first = hduList[1].data
+        second = hduList[2].data
+
+        # first JOIN second USING(id)
+        filenames = {i: [] for i in first.field("id")}
+        for id2, fn in zip(second.field("id"), second.field("filename")):
+            filenames[id2].append(fn)
+        metadata = {i: None for i in first.field("id")}
+        fileStats = {i: None for i in first.field("id")}
+        if version >= 2:
+            for i in metadata:
+                metadata[i] = []
+                fileStats[i] = []
+            mtimes = second.field("mtime") if version >= 3 else np.full(len(second), np.nan)
+            fingerprints = second.field("fingerprint") if version >= 4 else [None]*len(second)
+            for id2, size, mtime, fingerprint, indexid, nstars, nquads, scaleLo, scaleHi in zip(
+                    second.field("id"), second.field("size"), mtimes, fingerprints,
+                    second.field("indexid"), second.field("nstars"), second.field("nquads"),
+                    second.field("scale_lo"), second.field("scale_hi")):
+                if fileStats[id2]:
+                    # The first file is the star file, which has no index metadata
+                    metadata[id2].append((indexid, nstars, nquads, scaleLo, scaleHi))
+                mtime = None if np.isnan(mtime) else mtime
+                fileStats[id2].append(IndexFileStat(size, mtime, fingerprint))
+        multiInds = []
+        for i, hp, nside in zip(first.field("id"), first.field("healpix"), first.field("nside")):
+            if metadata[i] is not None:
+                metadata[i] = [IndexMetadata(indexid, hp, nside, nstars, nquads, scaleLo, scaleHi) for
+                               indexid, nstars, nquads, scaleLo, scaleHi in metadata[i]]
+            multiInds.append(MultiIndexCache(filenames[i], hp, nside, metadata=metadata[i],
+                                             fileStats=fileStats[i]))
+    return multiInds
+
+
+# Loaded MultiIndexCache, whose files must be closed before forking
+_loadedMultiIndexes = weakref.WeakSet()
+
+# Loaded MultiIndexCache whose files were in use when forking, to be closed in the child
+_inUseAtFork = []
+
+
+def _closeFilesBeforeFork():
+    """Close the files of all loaded multi-indexes
+
+    A forked process inherits the open files of its parent, including their
+    file offsets, so reads in one process would corrupt those in the other.
+    The data remain memory-mapped, and each process reopens the files as
+    required.
+
+    The files of multi-indexes in use by a query in another thread (which
+    releases the GIL while reading) are left open in the parent, since
+    closing them would free data the query is reading; the child closes its
+    copies instead (see _closeFilesInChild).
+    """
+    del _inUseAtFork[:]
+    for mi in list(_loadedMultiIndexes):
+        if not mi.closeFiles():
+            _inUseAtFork.append(mi)
+
+
+def _closeFilesInChild():
+    """Close the files, in a forked process, of multi-indexes in use when forking
+
+    The threads running the queries do not exist in the child, so the files
+    can be closed without taking the locks, which those threads may hold.
+    """
+    for mi in _inUseAtFork:
+        if mi._loaded:
+            mi._mi.closeFiles()
+    del _inUseAtFork[:]
+
+
+def _clearInUseAtFork():
+    del _inUseAtFork[:]
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_closeFilesBeforeFork, after_in_parent=_clearInUseAtFork,
+                        after_in_child=_closeFilesInChild)
+
+
+def _makeCacheDir(filename):
+    """Create the directory for a cache file, if it does not exist
+
+    Failure is not fatal: it is reported when the cache is written.
+    """
+    dirName = os.path.dirname(filename)
+    if os.path.isdir(dirName):
+        return
+    try:
+        os.makedirs(dirName)
+    except OSError:
+        pass
+
+
+def _readMultiIndexMetadata(filenameList):
+    """!Read the metadata for a multi-index
+
+    Only the metadata of the indices is read (not the quads or code
+    kd-tree), and the multi-index is not kept open.  As when reading the
+    indices, index files that are missing are skipped with a warning.
+
+    @param filenameList  List of filenames; first is the multiindex, then
+                         follows the individual index files
+    @return healpix, nside, list of IndexMetadata, list of IndexFileStat
+    """
+    log = Log.getDefaultLogger()
+    fn = getIndexPath(filenameList[0])
+    if not os.path.exists(fn):
+        raise RuntimeError("Unable to get filename for astrometry star file %s" % (filenameList[0],))
+    mi = MultiIndex(fn)
+    for fn in filenameList[1:]:
+        if fn is None:
+            log.debug('Unable to find index part of multiindex %s', filenameList[0])
+            continue
+        fn = getIndexPath(fn)
+        if not os.path.exists(fn):
+            log.warn("Unable to get filename for astrometry index %s", fn)
+            continue
+        mi.addIndex(fn, True)
+    metadata = [IndexMetadata.fromIndex(ind) for ind in mi]
+    mi.unload()
+    del mi
+
+    healpixes = set(meta.healpix for meta in metadata)
+    nsides = set(meta.hpnside for meta in metadata)
+    if len(healpixes) != 1 or len(nsides) != 1:
+        raise RuntimeError("Indices in multiindex %s have inconsistent healpixes %s or nsides %s" %
+                           (filenameList[0], healpixes, nsides))
+    fileStats = [IndexFileStat.fromFilename(getIndexPath(fn), fingerprint=True) if fn is not None else
+                 IndexFileStat(0) for fn in filenameList]
+    return healpixes.pop(), nsides.pop(), metadata, fileStats
+
+
+def _readMultiIndexes(indexFiles, processes=1):
+    """!Construct MultiIndexCache objects from their index files
+
+    @param indexFiles  List of filename lists, as for MultiIndexCache
+    @param processes   Number of processes to use for reading the metadata
+    @return list of MultiIndexCache
+    """
+    if processes > 1 and len(indexFiles) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_readMultiIndexMetadata, indexFiles,
+                               chunksize=max(1, len(indexFiles)//(4*processes)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_readMultiIndexMetadata(fnList) for fnList in indexFiles]
+    return [MultiIndexCache(fnList, healpix, nside, metadata=metadata, fileStats=fileStats) for
+            fnList, (healpix, nside, metadata, fileStats) in zip(indexFiles, results)]
+
+
+def generateCache(andConfig=None, processes=1):
+    """!Generate a cache file
+
+    Only the metadata of the index files is read.  If a cache file already
+    exists, its entries are reused for multi-indexes whose files have not
+    changed, so only new or modified multi-indexes are read.
+
+    @param andConfig  Configuration (an AstrometryNetDataConfig), or None to
+                      read from the environment
+    @param processes  Number of processes to use when reading the index files
+    """
     if andConfig is None:
         andConfig = getConfigFromEnvironment()
-    catalog = AstrometryNetCatalog(andConfig)
-    try:
-        for index in catalog:
-            index.reload()
+    cacheName = getCachePath(andConfig, writable=True)
+    _makeCacheDir(cacheName)
+    with CacheLock(cacheName, exclusive=True, timeout=andConfig.cacheLockTimeout):
+        previousName = cacheName if os.path.exists(cacheName) else getCachePath(andConfig)
+        previous = readCache(previousName) if os.path.exists(previousName) else None
+        catalog = AstrometryNetCatalog(andConfig, useCache=False, processes=processes, previous=previous)
         catalog.writeCache()
-    finally:
-        for index in catalog:
-            index.unload()
@@ -0,0 +1,203 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["ReferenceQueryCache"]
+
+from builtins import object
+import hashlib
+import os
+import tempfile
+
+import lsst.afw.table as afwTable
+from lsst.log import Log
+
+
+class ReferenceQueryCache(object):
+    """A persistent on-disk cache of reference catalog queries
+
+    Reprocessing the same fields repeats the same reference catalog queries.
+    This cache stores the catalog read for each query as a FITS binary table
+    in a cache directory, so that later runs can read it without reading the
+    index files.  Queries are keyed by the cone, the arguments used to read
+    the catalog (e.g., the column mapping) and a fingerprint of the index
+    files, so that a change to the index files invalidates their queries.
+
+    When the total size of the cached files exceeds the budget, the least
+    recently used files are removed.  Files are written atomically, so the
+    cache may be shared by concurrent processes.  The total size is tracked
+    as files are written, and the directory is only listed when the total
+    exceeds the budget, so files written by other processes are counted
+    when this one next evicts.
+
+    The 'hits' and 'misses' attributes count the number of queries found in
+    and missing from the cache.
+    """
+
+    _prefix = "refcat-"
+    _suffix = ".fits"
+
+    def __init__(self, cacheDir, maxBytes, fingerprint=""):
+        """!Constructor
+
+        @param cacheDir     Directory in which to keep the cached queries (created if necessary)
+        @param maxBytes     Maximum total size (bytes) of the cached queries
+        @param fingerprint  Fingerprint of the index files
+                            (e.g., from AstrometryNetCatalog.getFingerprint)
+        """
+        self.cacheDir = os.path.abspath(os.path.expanduser(cacheDir))
+        self.maxBytes = maxBytes
+        self.fingerprint = fingerprint
+        self.log = Log.getDefaultLogger()
+        self.hits = 0
+        self.misses = 0
+        self._numBytes = None  # Tracked total size of the cached queries; None if not yet known
+        if not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                if not os.path.isdir(self.cacheDir):
+                    raise
+
+    def getKey(self, ctrCoord, radius, args=()):
+        """!Get the key for a query
+
+        @param ctrCoord  center of search region (an lsst.afw.geom.SpherePoint)
+        @param radius  radius of search region (an lsst.afw.geom.Angle)
+        @param args  arguments used to read the catalog (with a stable repr)
+        @return key (str)
+        """
+        cone = tuple(angle.asRadians().hex() for angle in
+                     (ctrCoord.getLongitude(), ctrCoord.getLatitude(), radius))
+        return hashlib.sha1(repr((cone, tuple(args), self.fingerprint)).encode()).hexdigest()
+
+    def getFilename(self, key):
+        """Get the filename for a key"""
+        return os.path.join(self.cacheDir, self._prefix + key + self._suffix)
+
+    def get(self, key):
+        """!Get a cached catalog
+
+        @param key  key for the query, from getKey
+        @return catalog (lsst.afw.table.SimpleCatalog), or None if the query is not cached
+        """
+        filename = self.getFilename(key)
+        try:
+            cat = afwTable.SimpleCatalog.readFits(filename)
+        except Exception:
+            # Not cached, or removed by another process while reading
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(filename, None)  # Record the use, for eviction
+        except OSError:
+            pass
+        return cat
+
+    def put(self, key, cat):
+        """!Cache a catalog
+
+        Failure to write is not fatal, because the cache is an optimisation.
+
+        @param key  key for the query, from getKey
+        @param cat  catalog (lsst.afw.table.SimpleCatalog) to cache
+        """
+        filename = self.getFilename(key)
+        tempName = None
+        try:
+            fd, tempName = tempfile.mkstemp(dir=self.cacheDir, prefix="." + self._prefix,
+                                            suffix=self._suffix)
+            os.close(fd)
+            cat.writeFits(tempName)
+            # mkstemp creates the file readable only by the owner
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tempName, 0o666 & ~umask)
+            size = os.path.getsize(tempName)
+            oldSize = self._getSize(filename)
+            os.rename(tempName, filename)
+        except Exception as exc:
+            self.log.warn("Unable to write reference catalog query cache file %s: %s", filename, exc)
+            if tempName is not None and os.path.exists(tempName):
+                os.unlink(tempName)
+            return
+        if self._numBytes is None:
+            self._numBytes = self.getNumBytes()
+        else:
+            self._numBytes += size - oldSize
+        if self._numBytes > self.maxBytes:
+            self._evict()
+
+    def getNumBytes(self):
+        """Get the total size (bytes) of the cached queries"""
+        return sum(size for _, size, _ in self._listFiles())
+
+    def clear(self):
+        """Remove all cached queries"""
+        for filename, _, _ in self._listFiles():
+            self._remove(filename)
+        self._numBytes = 0
+
+    def _listFiles(self):
+        """List the cached queries
+
+        @return list of (filename, size, modification time)
+        """
+        files = []
+        for name in os.listdir(self.cacheDir):
+            if not (name.startswith(self._prefix) and name.endswith(self._suffix)):
+                continue
+            filename = os.path.join(self.cacheDir, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue  # Removed by another process
+            files.append((filename, stat.st_size, stat.st_mtime))
+        return files
+
+    def _getSize(self, filename):
+        """Get the size (bytes) of a file, or zero if it does not exist"""
+        try:
+            return os.path.getsize(filename)
+        except OSError:
+            return 0
+
+    def _remove(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass  # Removed by another process
+
+    def _evict(self):
+        """Remove the least recently used queries until within the budget
+
+        The tracked total size is reset from the files listed.
+        """
+        files = self._listFiles()
+        numBytes = sum(size for _, size, _ in files)
+        for filename, size, _ in sorted(files, key=lambda ff: ff[2]):
+            if numBytes <= self.maxBytes:
+                break
+            self._remove(filename)
+            numBytes -= size
+        self._numBytes = numBytes
@@ -0,0 +1,230 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["ReferenceTileCache"]
+
+from builtins import zip
+from builtins import object
+from collections import OrderedDict
+
+import numpy as np
+
+import lsst.afw.table as afwTable
+from .astrometry_net import healpixBoundingCircle, healpixIndices, healpixRangeSearch
+
+
+def _unitVectors(ra, dec):
+    """!Convert arrays of ICRS coordinates to unit vectors
+
+    @param ra   right ascension (radians)
+    @param dec  declination (radians)
+    @return array of shape (len(ra), 3)
+    """
+    cosDec = np.cos(dec)
+    return np.column_stack((cosDec*np.cos(ra), cosDec*np.sin(ra), np.sin(dec)))
+
+
+class ReferenceTileCache(object):
+    """A cache of decoded reference catalogs for HEALPix tiles, with LRU eviction
+
+    Overlapping queries (e.g., neighbouring CCDs and dithered visits) read
+    the same reference objects again and again.  This cache holds the
+    reference objects read from the index files for tiles of the sky (the
+    HEALPix pixels at a fixed nside), each as a contiguous catalog.  A cone
+    query is answered by combining the cached tiles overlapping the cone and
+    selecting the objects within the cone; only missing tiles are read.
+
+    The least recently used tiles are evicted when the memory used by the
+    tiles exceeds the budget.  The 'hits', 'misses' and 'evictions'
+    attributes count the number of tiles found in the cache, the number of
+    tiles read, and the number of tiles evicted.
+    """
+
+    def __init__(self, nside, maxBytes):
+        """!Constructor
+
+        @param nside     HEALPix nside of the tiles
+        @param maxBytes  Maximum number of bytes of reference catalogs to keep
+        """
+        self.nside = nside
+        self.maxBytes = maxBytes
+        self._tiles = OrderedDict()  # (key, tile) --> SimpleCatalog; least recently used first
+        self._numBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getTiles(self, ctrCoord, radius):
+        """!Get the tiles overlapping a cone
+
+        @param ctrCoord  center of cone (an lsst.afw.geom.SpherePoint)
+        @param radius  radius of cone (an lsst.afw.geom.Angle)
+        @return sorted list of tile (HEALPix) numbers
+        """
+        return healpixRangeSearch(ctrCoord, radius, self.nside)
+
+    def query(self, ctrCoordList, radiusList, readCones, key=None, uniqueIds=True):
+        """!Get the reference objects in each of several cones
+
+        @param ctrCoordList  centers of cones (lsst.afw.geom.SpherePoint)
+        @param radiusList  radii of cones (lsst.afw.geom.Angle), one per center
+        @param readCones  callable reading reference objects from the index files,
+            with arguments ctrCoordList and radiusList, returning a list of
+            lsst.afw.table.SimpleCatalog, one per cone
+        @param key  hashable identifying the contents of the catalogs returned by
+            readCones (e.g., the columns read), so that tiles read differently are
+            cached separately
+        @param uniqueIds  only return the first of objects with the same ID in each cone?
+            The IDs must be external (not assigned when the catalogs are read), and
+            readCones should not remove duplicates itself (see _combine).
+        @return list of lsst.afw.table.SimpleCatalog, one per cone; each is contiguous
+        """
+        if len(ctrCoordList) != len(radiusList):
+            raise RuntimeError("Length of ctrCoordList (%d) and radiusList (%d) differ" %
+                               (len(ctrCoordList), len(radiusList)))
+        tileLists = [self.getTiles(ctrCoord, radius) for ctrCoord, radius in zip(ctrCoordList, radiusList)]
+
+        # Tiles required for this query are held here, in case they are evicted before use
+        tiles = {}
+        missing = []
+        for tile in sorted(set(tile for tileList in tileLists for tile in tileList)):
+            cat = self._get((key, tile))
+            if cat is None:
+                missing.append(tile)
+            else:
+                tiles[tile] = cat
+        if missing:
+            circles = [healpixBoundingCircle(tile, self.nside) for tile in missing]
+            catList = readCones([center for center, radius in circles],
+                                [radius for center, radius in circles])
+            for tile, cat in zip(missing, catList):
+                tiles[tile] = self._extractTile(cat, tile)
+                self._put((key, tile), tiles[tile])
+
+        return [self._combine([tiles[tile] for tile in tileList], ctrCoord, radius, uniqueIds) for
+                tileList, ctrCoord, radius in zip(tileLists, ctrCoordList, radiusList)]
+
+    def clear(self):
+        """Remove all tiles from the cache"""
+        self._tiles.clear()
+        self._numBytes = 0
+
+    def getNumBytes(self):
+        """Get the number of bytes of reference catalogs in the cache"""
+        return self._numBytes
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def _get(self, key):
+        """Get a tile from the cache, or None if it is not present"""
+        cat = self._tiles.pop(key, None)
+        if cat is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._tiles[key] = cat  # Most recently used
+        return cat
+
+    def _put(self, key, cat):
+        """Add a tile to the cache, evicting the least recently used tiles as required"""
+        numBytes = self._getCatalogBytes(cat)
+        if numBytes > self.maxBytes:
+            return
+        self._tiles[key] = cat
+        self._numBytes += numBytes
+        while self._numBytes > self.maxBytes:
+            _, evicted = self._tiles.popitem(last=False)
+            self._numBytes -= self._getCatalogBytes(evicted)
+            self.evictions += 1
+
+    @staticmethod
+    def _getCatalogBytes(cat):
+        """Get the number of bytes used by the records of a catalog"""
+        return len(cat)*cat.schema.getRecordSize()
+
+    def _extractTile(self, cat, tile):
+        """!Extract the objects in a tile from a catalog
+
+        @param cat  catalog of objects in a cone enclosing the tile
+        @param tile  tile (HEALPix) number
+        @return contiguous catalog of the objects in the tile
+        """
+        if len(cat) == 0:
+            return cat.copy(deep=True)
+        if not cat.isContiguous():
+            cat = cat.copy(deep=True)
+        hp = healpixIndices(np.degrees(cat["coord_ra"]), np.degrees(cat["coord_dec"]), self.nside)
+        return cat.subset(hp == tile).copy(deep=True)
+
+    def _combine(self, tileCats, ctrCoord, radius, uniqueIds):
+        """!Combine the objects within a cone from several tiles
+
+        The distance criterion is that of the star kd-tree search (chord
+        distance on the unit sphere), so the result contains the same objects
+        as reading the cone directly.
+
+        Duplicate IDs are removed after selecting the objects in the cone,
+        keeping the first in tile order and, within a tile, in the order read
+        (index order).  Copies of an object in several (overlapping) indexes
+        share its position and so its tile, so the copy kept is the one
+        Solver.getCatalog keeps.  Only distinct objects that share an ID and
+        lie in different tiles may be resolved differently: getCatalog keeps
+        the first in index order, but this keeps the first in tile order.
+
+        @param tileCats  catalogs of the tiles overlapping the cone
+        @param ctrCoord  center of cone (an lsst.afw.geom.SpherePoint)
+        @param radius  radius of cone (an lsst.afw.geom.Angle)
+        @param uniqueIds  only return the first of objects with the same ID?
+        @return contiguous catalog
+        """
+        center = _unitVectors(ctrCoord.getLongitude().asRadians(), ctrCoord.getLatitude().asRadians())[0]
+        maxDistSq = 2.0*(1.0 - np.cos(radius.asRadians()))
+        selections = []
+        for cat in tileCats:
+            if len(cat) == 0:
+                selections.append(np.zeros(0, dtype=bool))
+                continue
+            vectors = _unitVectors(cat["coord_ra"], cat["coord_dec"])
+            selections.append(((vectors - center)**2).sum(axis=1) <= maxDistSq)
+
+        if uniqueIds and tileCats:
+            # Keep the first object with each ID, in tile order, then the order read
+            ids = np.concatenate([cat["id"][sel] if len(cat) > 0 else np.zeros(0, dtype=np.int64)
+                                  for cat, sel in zip(tileCats, selections)])
+            keep = np.zeros(len(ids), dtype=bool)
+            keep[np.unique(ids, return_index=True)[1]] = True
+            start = 0
+            for sel in selections:
+                num = sel.sum()
+                sel[np.flatnonzero(sel)] = keep[start:start + num]
+                start += num
+
+        schema = afwTable.Schema(tileCats[0].schema)
+        schema.disconnectAliases()
+        combined = afwTable.SimpleCatalog(schema)
+        combined.reserve(sum(int(sel.sum()) for sel in selections))
+        for cat, sel in zip(tileCats, selections):
+            if sel.any():
+                combined.extend(cat.subset(sel), deep=True)
+        return combined
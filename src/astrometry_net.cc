@@ -1,6 +1,8 @@
 // -*- lsst-C++ -*-
 
+#include <algorithm>
 #include <sstream>
+#include <unordered_set>
 #include <utility>
 #include <vector>
 
@@ -27,6 +29,53 @@ static time_t timer_callback(void* baton) {
     return 1;
 }
 
+std::vector<detail::MagColInfo> makeMagColInfoList(
+    std::vector<std::string> const& filterNameList,
+    std::vector<std::string> const& magColList,
+    std::vector<std::string> const& magErrColList)
+{
+    if ((filterNameList.size() != magColList.size()) || (filterNameList.size() != magErrColList.size())) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+            "Filter name, mag column, and mag error column vectors must be the same length.");
+    }
+    std::vector<detail::MagColInfo> magColInfoList;
+    for (size_t i=0; i<filterNameList.size(); ++i) {
+        astrometryNet::detail::MagColInfo mc;
+        mc.filterName = filterNameList[i];
+        mc.magCol = magColList[i];
+        mc.magErrCol = magErrColList[i];
+        magColInfoList.push_back(mc);
+    }
+    return magColInfoList;
+}
+
+detail::RefObjFilter makeRefObjFilter(
+    std::vector<std::string> const& magLimitFilterList,
+    std::vector<double> const& minMagList,
+    std::vector<double> const& maxMagList,
+    bool photometricOnly,
+    bool excludeResolved,
+    bool excludeVariable)
+{
+    if ((magLimitFilterList.size() != minMagList.size()) ||
+        (magLimitFilterList.size() != maxMagList.size())) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+            "Magnitude limit filter name, minimum and maximum vectors must be the same length.");
+    }
+    detail::RefObjFilter refObjFilter;
+    for (size_t i=0; i<magLimitFilterList.size(); ++i) {
+        detail::MagLimit limit;
+        limit.filterName = magLimitFilterList[i];
+        limit.minMag = minMagList[i];
+        limit.maxMag = maxMagList[i];
+        refObjFilter.magLimits.push_back(limit);
+    }
+    refObjFilter.photometricOnly = photometricOnly;
+    refObjFilter.excludeResolved = excludeResolved;
+    refObjFilter.excludeVariable = excludeVariable;
+    return refObjFilter;
+}
+
 }  // namespace <anonymous>
 
 MultiIndex::MultiIndex(std::string const & filepath) : _multiindex(multiindex_new(filepath.c_str())) {
@@ -59,6 +108,20 @@ void MultiIndex::reload() {
     }
 }
 
+void MultiIndex::closeFiles() {
+    for (int i = 0; i < getLength(); ++i) {
+        detail::closeIndexFiles((*this)[i]);
+    }
+    startree_t* starkd = _multiindex->starkd;
+    if (starkd) {
+        detail::closeKdtreeFile(starkd->tree);
+        if (starkd->tagalong) {
+            fitstable_close(starkd->tagalong);
+            starkd->tagalong = NULL;
+        }
+    }
+}
+
 
 Solver::Solver() : _solver(solver_new()) {}
 
@@ -79,22 +142,113 @@ lsst::afw::table::SimpleCatalog Solver::getCatalog(
     std::vector<std::string> const& magErrColList,
     const char* starGalCol,
     const char* varCol,
-    bool uniqueIds)
+    bool uniqueIds,
+    std::vector<std::string> const& magLimitFilterList,
+    std::vector<double> const& minMagList,
+    std::vector<double> const& maxMagList,
+    bool photometricOnly,
+    bool excludeResolved,
+    bool excludeVariable,
+    int numThreads)
 {
-    if ((filterNameList.size() != magColList.size()) || (filterNameList.size() != magErrColList.size())) {
-        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
-            "Filter name, mag column, and mag error column vectors must be the same length.");
-    }
-    std::vector<detail::MagColInfo> magColInfoList;
-    for (size_t i=0; i<filterNameList.size(); ++i) {
-        astrometryNet::detail::MagColInfo mc;
-        mc.filterName = filterNameList[i];
-        mc.magCol = magColList[i];
-        mc.magErrCol = magErrColList[i];
-        magColInfoList.push_back(mc);
-    }
+    std::vector<detail::MagColInfo> magColInfoList = makeMagColInfoList(filterNameList, magColList,
+                                                                        magErrColList);
+    detail::RefObjFilter refObjFilter = makeRefObjFilter(magLimitFilterList, minMagList, maxMagList,
+                                                         photometricOnly, excludeResolved, excludeVariable);
     return detail::getCatalogImpl(inds, ctrCoord, radius,
-        idCol, magColInfoList, starGalCol, varCol, uniqueIds);
+        idCol, magColInfoList, starGalCol, varCol, uniqueIds, refObjFilter, numThreads);
+}
+
+std::vector<lsst::afw::table::SimpleCatalog> Solver::getCatalogs(
+    std::vector<index_t*> inds,
+    std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+    std::vector<lsst::afw::geom::Angle> const &radiusList,
+    const char* idCol,
+    std::vector<std::string> const& filterNameList,
+    std::vector<std::string> const& magColList,
+    std::vector<std::string> const& magErrColList,
+    const char* starGalCol,
+    const char* varCol,
+    bool uniqueIds,
+    std::vector<std::string> const& magLimitFilterList,
+    std::vector<double> const& minMagList,
+    std::vector<double> const& maxMagList,
+    bool photometricOnly,
+    bool excludeResolved,
+    bool excludeVariable,
+    int numThreads)
+{
+    std::vector<detail::MagColInfo> magColInfoList = makeMagColInfoList(filterNameList, magColList,
+                                                                        magErrColList);
+    detail::RefObjFilter refObjFilter = makeRefObjFilter(magLimitFilterList, minMagList, maxMagList,
+                                                         photometricOnly, excludeResolved, excludeVariable);
+    return detail::getCatalogsImpl(inds, ctrCoordList, radiusList,
+        idCol, magColInfoList, starGalCol, varCol, uniqueIds, true, refObjFilter,
+        std::vector<detail::SkyPolygon>(), numThreads);
+}
+
+std::vector<lsst::afw::table::SimpleCatalog> Solver::getPolygonCatalogs(
+    std::vector<index_t*> inds,
+    std::vector<std::vector<lsst::afw::geom::SpherePoint> > const& polygonList,
+    lsst::afw::geom::Angle const& margin,
+    const char* idCol,
+    std::vector<std::string> const& filterNameList,
+    std::vector<std::string> const& magColList,
+    std::vector<std::string> const& magErrColList,
+    const char* starGalCol,
+    const char* varCol,
+    bool uniqueIds,
+    std::vector<std::string> const& magLimitFilterList,
+    std::vector<double> const& minMagList,
+    std::vector<double> const& maxMagList,
+    bool photometricOnly,
+    bool excludeResolved,
+    bool excludeVariable,
+    int numThreads)
+{
+    std::vector<detail::MagColInfo> magColInfoList = makeMagColInfoList(filterNameList, magColList,
+                                                                        magErrColList);
+    detail::RefObjFilter refObjFilter = makeRefObjFilter(magLimitFilterList, minMagList, maxMagList,
+                                                         photometricOnly, excludeResolved, excludeVariable);
+    std::vector<detail::SkyPolygon> polygons;
+    std::vector<lsst::afw::geom::SpherePoint> ctrCoordList;
+    std::vector<lsst::afw::geom::Angle> radiusList;
+    polygons.reserve(polygonList.size());
+    for (auto const& vertices : polygonList) {
+        polygons.emplace_back(vertices, margin);
+        ctrCoordList.push_back(polygons.back().getCenter());
+        radiusList.push_back(polygons.back().getRadius());
+    }
+    return detail::getCatalogsImpl(inds, ctrCoordList, radiusList,
+        idCol, magColInfoList, starGalCol, varCol, uniqueIds, true, refObjFilter, polygons, numThreads);
+}
+
+std::vector<detail::RefObjColumns> Solver::getColumns(
+    std::vector<index_t*> inds,
+    std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+    std::vector<lsst::afw::geom::Angle> const &radiusList,
+    const char* idCol,
+    std::vector<std::string> const& filterNameList,
+    std::vector<std::string> const& magColList,
+    std::vector<std::string> const& magErrColList,
+    const char* starGalCol,
+    const char* varCol,
+    bool uniqueIds,
+    std::vector<std::string> const& magLimitFilterList,
+    std::vector<double> const& minMagList,
+    std::vector<double> const& maxMagList,
+    bool photometricOnly,
+    bool excludeResolved,
+    bool excludeVariable,
+    int numThreads)
+{
+    std::vector<detail::MagColInfo> magColInfoList = makeMagColInfoList(filterNameList, magColList,
+                                                                        magErrColList);
+    detail::RefObjFilter refObjFilter = makeRefObjFilter(magLimitFilterList, minMagList, maxMagList,
+                                                         photometricOnly, excludeResolved, excludeVariable);
+    return detail::getColumnsImpl(inds, ctrCoordList, radiusList,
+        idCol, magColInfoList, starGalCol, varCol, uniqueIds, true, refObjFilter,
+        std::vector<detail::SkyPolygon>(), numThreads);
 }
 
 std::shared_ptr<lsst::daf::base::PropertyList> Solver::getSolveStats() const {
@@ -246,4 +400,78 @@ lsst::afw::geom::Angle healpixDistance(int hp, int nside, lsst::afw::geom::Spher
                                   lsst::afw::geom::degrees);
 }
 
+void healpixDistances(int const* hp, int const* nside, std::size_t numHealpix,
+                      double const* ra, double const* dec, std::size_t numCoord,
+                      double* distances) {
+    for (std::size_t i = 0; i < numCoord; ++i) {
+        double* row = distances + i*numHealpix;
+        for (std::size_t j = 0; j < numHealpix; ++j) {
+            if (hp[j] < 0) {
+                row[j] = 0.0;
+                continue;
+            }
+            // Convert as healpixDistance does, so the results compare identically
+            double const dist = healpix_distance_to_radec(hp[j], nside[j], ra[i], dec[i], NULL);
+            row[j] = lsst::afw::geom::Angle(dist, lsst::afw::geom::degrees).asRadians();
+        }
+    }
+}
+
+std::vector<int> healpixRangeSearch(lsst::afw::geom::SpherePoint const& coord,
+                                    lsst::afw::geom::Angle const& radius, int nside) {
+    double const ra = coord.getLongitude().asDegrees();
+    double const dec = coord.getLatitude().asDegrees();
+    double const radiusDeg = radius.asDegrees();
+
+    // Breadth-first search outwards from the healpix containing the coordinates;
+    // the healpixes within range of a cone are contiguous.
+    int const start = radecdegtohealpix(ra, dec, nside);
+    std::vector<int> found = {start};
+    std::unordered_set<int> visited = {start};
+    for (std::size_t i = 0; i < found.size(); ++i) {
+        int neighbours[8];
+        int const num = healpix_get_neighbours(found[i], neighbours, nside);
+        for (int j = 0; j < num; ++j) {
+            if (!visited.insert(neighbours[j]).second) {
+                continue;
+            }
+            if (healpix_distance_to_radec(neighbours[j], nside, ra, dec, NULL) <= radiusDeg) {
+                found.push_back(neighbours[j]);
+            }
+        }
+    }
+    std::sort(found.begin(), found.end());
+    return found;
+}
+
+void healpixIndices(double const* ra, double const* dec, std::size_t numCoord, int nside, int* hp) {
+    for (std::size_t i = 0; i < numCoord; ++i) {
+        hp[i] = radecdegtohealpix(ra[i], dec[i], nside);
+    }
+}
+
+std::pair<lsst::afw::geom::SpherePoint, lsst::afw::geom::Angle> healpixBoundingCircle(int hp, int nside) {
+    double ra, dec;
+    healpix_to_radecdeg(hp, nside, 0.5, 0.5, &ra, &dec);
+    lsst::afw::geom::SpherePoint const center(ra, dec, lsst::afw::geom::degrees);
+
+    // The edges of a healpix are not great circles, so sample along them
+    // rather than using only the corners.
+    int const numSamples = 8;
+    double maxDistance = 0.0;
+    for (int i = 0; i <= numSamples; ++i) {
+        double const frac = static_cast<double>(i)/numSamples;
+        double const dx[4] = {frac, frac, 0.0, 1.0};
+        double const dy[4] = {0.0, 1.0, frac, frac};
+        for (int j = 0; j < 4; ++j) {
+            healpix_to_radecdeg(hp, nside, dx[j], dy[j], &ra, &dec);
+            lsst::afw::geom::SpherePoint const point(ra, dec, lsst::afw::geom::degrees);
+            maxDistance = std::max(maxDistance, center.separation(point).asRadians());
+        }
+    }
+    // Margin for the curvature of the edges between samples
+    double const margin = 1.01;
+    return std::make_pair(center, lsst::afw::geom::Angle(margin*maxDistance, lsst::afw::geom::radians));
+}
+
 }}}}  // namespace lsst::meas::extensions::astrometryNet
@@ -6,6 +6,7 @@ extern "C" {
 #include "astrometry/starkd.h"
 #include "astrometry/fitsioutils.h"
 #include "astrometry/fitstable.h"
+#include "astrometry/healpix.h"
 
 #undef ATTRIB_FORMAT
 #undef FALSE
@@ -14,8 +15,18 @@ extern "C" {
 #undef RAD_PER_DEG
 }
 
-#include <set>
+#include <algorithm>
+#include <array>
+#include <atomic>
+#include <cmath>
 #include <cstdint>
+#include <exception>
+#include <map>
+#include <memory>
+#include <string>
+#include <thread>
+#include <utility>
+#include <vector>
 #include "boost/format.hpp"
 
 #include "lsst/meas/extensions/astrometryNet/detail/utils.h"
@@ -38,42 +49,156 @@ namespace extensions {
 namespace astrometryNet {
 namespace detail {
 
-static float *
-read_column(
-    fitstable_t* tag,
-    char const *colName,
-    tfits_type type,
-    int *starinds,
-    int nstars,
-    char const *indexName)
-{
-    float *col = static_cast<float*>(fitstable_read_column_inds(tag, colName, type, starinds, nstars));
-    if (!col) {
-        throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError,
-                          str(boost::format("Unable to read data for %s from %s") % colName % indexName));
+namespace {
+
+typedef std::array<double, 3> Vector3;
+
+Vector3 toVector3(afwGeom::SpherePoint const& point) {
+    afwGeom::Point3D const vec = point.getVector();
+    return Vector3{{vec[0], vec[1], vec[2]}};
+}
+
+double dot(Vector3 const& a, Vector3 const& b) {
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2];
+}
+
+/// Center of a polygon: the normalised mean of its vertices
+afwGeom::SpherePoint getPolygonCenter(std::vector<afwGeom::SpherePoint> const& vertices) {
+    if (vertices.size() < 3) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+            str(boost::format("A polygon requires at least 3 vertices; %d given") % vertices.size()));
     }
+    Vector3 sum{{0.0, 0.0, 0.0}};
+    for (auto const& vertex : vertices) {
+        Vector3 const vec = toVector3(vertex);
+        for (int i = 0; i < 3; ++i) {
+            sum[i] += vec[i];
+        }
+    }
+    return afwGeom::SpherePoint(afwGeom::Point3D(sum[0], sum[1], sum[2]));
+}
 
-    return col;
+/// Number of nJy in one Jy; fluxes are returned in nJy
+double const nJyPerJy = 1.0e9;
+
+/*
+Array kernels converting magnitudes to fluxes
+
+These compute the same quantities as nJyPerJy*afw::image::fluxFromABMag and
+fluxErrFromABMagErr, over whole columns of magnitudes at once, as simple loops
+the compiler can vectorize.
+
+There is some dispute about returning flux or magnitudes
+flux is not conventional, but is convenient for several reasons
+- it simplifies matching to sources for astrometric calibration
+- flux errors are easier to combine than magnitude errors
+*/
+
+/// Convert AB magnitudes to fluxes (nJy)
+void magsToFluxes(float const* mag, std::size_t num, double* flux) {
+    double const zeroPoint = nJyPerJy*lsst::afw::image::fluxFromABMag(0.0);
+    double const scale = -0.4*std::log(10.0);
+    for (std::size_t i = 0; i < num; ++i) {
+        flux[i] = zeroPoint*std::exp(scale*mag[i]);
+    }
 }
 
-    
-afwTable::SimpleCatalog
-getCatalogImpl(std::vector<index_t*> inds,
-    lsst::afw::geom::SpherePoint const &ctrCoord,
-    lsst::afw::geom::Angle const &radius,
-    char const* idCol,
-    std::vector<MagColInfo> const& magColInfoList,
-    char const* isStarCol,
-    char const* isVarCol,
-    bool uniqueIds)
-{
-    /*
-     If uniqueIds == true: return only reference sources with unique IDs;
-     arbitrarily keep the first star found with each ID.
-     */
+/// Convert AB magnitude uncertainties to flux uncertainties (nJy), given the fluxes (nJy)
+void magErrsToFluxErrs(float const* magErr, double const* flux, std::size_t num, double* fluxErr) {
+    double const scale = 0.4*std::log(10.0);
+    for (std::size_t i = 0; i < num; ++i) {
+        fluxErr[i] = std::abs(scale*magErr[i]*flux[i]);
+    }
+}
+
+/// Schema and keys of the catalogs returned by getCatalogImpl, getCatalogsImpl and makeCatalogFromColumns
+struct CatalogKeys {
+    afwTable::Schema schema;
+    afwTable::Key<afwTable::Flag> hasCentroidKey;
+    std::vector<afwTable::Key<double> > fluxKey;    // these are double for consistency with measured fluxes;
+    std::vector<afwTable::Key<double> > fluxErrKey; // double may be unnecessary, but less surprising.
+    afwTable::Key<afwTable::Flag> resolvedKey;
+    afwTable::Key<afwTable::Flag> variableKey;
+    afwTable::Key<afwTable::Flag> photometricKey;
+
+    CatalogKeys(std::vector<MagColInfo> const& magColInfoList, bool hasResolved, bool hasVariable)
+        : schema(afwTable::SimpleTable::makeMinimalSchema()) // contains id and coord
+    {
+        afw::table::PointKey<double>::addFields(schema, "centroid",
+            "centroid on some exposure; invalid unless \"hasCentroid\" is true)", "pixels");
+        hasCentroidKey = schema.addField<afwTable::Flag>("hasCentroid",
+            "true if centroid field has been set");
+
+        fluxKey.reserve(magColInfoList.size());
+        fluxErrKey.reserve(magColInfoList.size());
+        for (auto mc = magColInfoList.cbegin(); mc != magColInfoList.cend(); ++mc) {
+            // Add schema elements for each requested flux (and optionally flux error)
+            // avoid the comment "flux flux"
+            fluxKey.push_back(
+                schema.addField<double>(
+                    mc->filterName + "_flux",
+                    mc->filterName + " flux", "nJy"));
+            if (mc->hasErr()) {
+                fluxErrKey.push_back(
+                    schema.addField<double>(
+                        mc->filterName + "_fluxErr",
+                        mc->filterName + " flux uncertainty (sigma)", "nJy"));
+            }
+        }
+
+        if (hasResolved) {
+            resolvedKey = schema.addField<afwTable::Flag>(
+                "resolved",
+                "set if the reference object is resolved");
+        }
+        if (hasVariable) {
+            variableKey = schema.addField<afwTable::Flag>(
+                "variable",
+                "set if the reference object is variable");
+        }
+        photometricKey = schema.addField<afwTable::Flag>(
+            "photometric",
+            "set if the reference object can be used in photometric calibration");
+    }
 
-    size_t const nMag = magColInfoList.size();   /* number of magnitude[error] columns */
+    afwTable::SimpleCatalog makeCatalog(bool hasId) const {
+        if (hasId) {
+            // make catalog with no IdFactory, since IDs are external
+            return afwTable::SimpleCatalog(afwTable::SimpleTable::make(schema, PTR(afwTable::IdFactory)()));
+        }
+        // let the catalog assign IDs
+        return afwTable::SimpleCatalog(afwTable::SimpleTable::make(schema));
+    }
+};
 
+/// Tag-along columns read for a list of stars; the memory is freed on destruction
+struct TagAlongData {
+    std::int64_t* id = NULL;
+    std::vector<float*> mag;
+    std::vector<float*> magErr;
+    bool* stargal = NULL;
+    bool* var = NULL;
+    std::vector<std::vector<double> > flux;  // fluxes (nJy) from mag
+    std::vector<std::vector<double> > fluxErr;  // flux uncertainties (nJy) from magErr
+
+    TagAlongData() = default;
+    TagAlongData(TagAlongData const&) = delete;
+    TagAlongData& operator=(TagAlongData const&) = delete;
+
+    ~TagAlongData() {
+        free(id);
+        for (size_t j=0; j<mag.size(); ++j) {
+            free(mag[j]);
+        }
+        for (size_t j=0; j<magErr.size(); ++j) {
+            free(magErr[j]);
+        }
+        free(stargal);
+        free(var);
+    }
+};
+
+void checkMagColInfo(std::vector<MagColInfo> const& magColInfoList) {
     for (auto mc = magColInfoList.cbegin(); mc != magColInfoList.cend(); ++mc) {
         if (mc->filterName.empty()) {
             throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
@@ -85,262 +210,942 @@ getCatalogImpl(std::vector<index_t*> inds,
             throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
                 "Magnitude column names cannot be empty strings.");
         }
-        //printf("mag col \"%s\", \"%s\", \"%s\"\n", mc->filterName.c_str(), mc->magCol.c_str(), mc->magErrCol.c_str());
     }
-    
-    double raDeg = ctrCoord.getLongitude().asDegrees();
-    double decDeg = ctrCoord.getLatitude().asDegrees();
-    double xyz[3];
-    radecdeg2xyzarr(raDeg, decDeg, xyz);
-    double r2 = deg2distsq(radius.asDegrees());
+}
 
-    afwTable::Schema schema = afwTable::SimpleTable::makeMinimalSchema(); // contains id and coord
+fitstable_t* getTagAlong(
+    index_t* ind,
+    char const* idCol,
+    std::vector<MagColInfo> const& magColInfoList,
+    char const* isStarCol,
+    char const* isVarCol)
+{
+    fitstable_t* tag = startree_get_tagalong(ind->starkd);
+    if (!tag) {
+        std::string msg = boost::str(boost::format(
+            "astrometry_net_data index file %s does not contain a tag-along table, "
+            "so can't retrieve extra columns.  idCol=%s, isStarCol=%s, isVarCol=%s") %
+            ind->indexname % idCol % isStarCol % isVarCol);
+        msg += ", mag columns=[";
+        for (unsigned int i=0; i<magColInfoList.size(); i++) {
+            if (i) {
+                msg += ",";
+            }
+            msg += " name='" + magColInfoList[i].filterName +
+                "', mag='" + magColInfoList[i].magCol +
+                "', magErr='" + magColInfoList[i].magErrCol + "'";
+        }
+        msg += " ].  You may need to edit the $ASTROMETRY_NET_DATA_DIR/andConfig.py file to set idColumn=None, etc.";
+        throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError, msg);
+    }
+    return tag;
+}
 
-    afw::table::PointKey<double>::addFields(schema, "centroid",
-        "centroid on some exposure; invalid unless \"hasCentroid\" is true)", "pixels");
-    auto hasCentroidKey = schema.addField<afwTable::Flag>("hasCentroid",
-        "true if centroid field has been set");
+/**
+Reader of columns of selected rows of a tag-along table, in one sequential pass
 
-    std::vector<afwTable::Key<double> > fluxKey;    // these are double for consistency with measured fluxes;
-    std::vector<afwTable::Key<double> > fluxErrKey; // double may be unnecessary, but less surprising.
-    fluxKey.reserve(nMag);
-    fluxErrKey.reserve(nMag);
+fitstable_read_column_inds locates a column by name and does its own scattered read of the rows
+for every column.  Instead, the layout of each column (its offset within a row and its FITS type)
+is found once, and each run of consecutive rows is read once, with all the requested columns
+extracted from it.  The values are converted as fitstable_read_column_inds converts them.
+The table file is opened for reading when first read, and closed when the reader is destroyed.
+*/
+class TagAlongGather {
+public:
+    /// A column to read: the result is an array of the given type, allocated with malloc
+    struct Request {
+        Request(std::string const& name_, tfits_type type_) : name(name_), type(type_) {}
 
-    for (auto mc = magColInfoList.cbegin(); mc != magColInfoList.cend(); ++mc) {
-        // Add schema elements for each requested flux (and optionally flux error)
-        // avoid the comment "flux flux"
-        fluxKey.push_back(
-            schema.addField<double>(
-                mc->filterName + "_flux",
-                mc->filterName + " flux"));
-        if (mc->hasErr()) {
-            fluxErrKey.push_back(
-                schema.addField<double>(
-                    mc->filterName + "_fluxErr",
-                    mc->filterName + " flux uncertainty (sigma)"));
+        std::string name;  ///< name of column
+        tfits_type type;  ///< type in which to return the values
+    };
+
+    TagAlongGather(fitstable_t* tag, char const* indexName)
+        : _tag(tag), _indexName(indexName), _rowSize(tag->table->tab_w), _columns() {}
+
+    /// Close the file opened by fitstable_read_nrows_data, so no file is left open after reading
+    ~TagAlongGather() {
+        closeFile(_tag->readfid);
+    }
+
+    TagAlongGather(TagAlongGather const&) = delete;
+    TagAlongGather& operator=(TagAlongGather const&) = delete;
+
+    /**
+    Read columns for a list of rows
+
+    @param[in] requests  columns to read
+    @param[in] rows  rows to read, in increasing order
+    @param[in] nrows  number of rows
+    @return one array per request, of nrows values; the caller must free them
+    */
+    std::vector<void*> read(std::vector<Request> const& requests, int const* rows, int nrows) {
+        std::vector<Column const*> columns;
+        columns.reserve(requests.size());
+        for (auto const& req : requests) {
+            columns.push_back(&_getColumn(req.name));
+        }
+        // each column to byte-swap, once
+        std::vector<Column const*> swapColumns;
+        for (Column const* column : columns) {
+            if (column->size > 1 &&
+                    std::find(swapColumns.begin(), swapColumns.end(), column) == swapColumns.end()) {
+                swapColumns.push_back(column);
+            }
+        }
+        std::vector<void*> results;
+        results.reserve(requests.size());
+        for (auto const& req : requests) {
+            results.push_back(malloc(std::max(nrows, 1)*fits_get_atom_size(req.type)));
+            if (!results.back()) {
+                _free(results);
+                throw LSST_EXCEPT(lsst::pex::exceptions::MemoryError,
+                    str(boost::format("Unable to allocate memory for %s from %s") % req.name % _indexName));
+            }
         }
+
+        std::vector<char> buffer;
+        for (int start = 0; start < nrows; ) {
+            int end = start + 1;
+            while (end < nrows && end - start < _maxRunRows && rows[end] == rows[end - 1] + 1) {
+                ++end;
+            }
+            int const num = end - start;
+            buffer.resize(static_cast<std::size_t>(num)*_rowSize);
+            if (fitstable_read_nrows_data(_tag, rows[start], num, buffer.data())) {
+                _free(results);
+                throw LSST_EXCEPT(lsst::pex::exceptions::IoError,
+                    str(boost::format("Unable to read rows %d-%d of the tag-along table of %s") %
+                        rows[start] % (rows[start] + num - 1) % _indexName));
+            }
+            if (_isLittleEndian()) {
+                // FITS data are big-endian
+                for (Column const* column : swapColumns) {
+                    for (int i = 0; i < num; ++i) {
+                        char* value = buffer.data() + static_cast<std::size_t>(i)*_rowSize + column->offset;
+                        std::reverse(value, value + column->size);
+                    }
+                }
+            }
+            for (std::size_t j = 0; j < requests.size(); ++j) {
+                int const size = fits_get_atom_size(requests[j].type);
+                if (fits_convert_data(static_cast<char*>(results[j]) + static_cast<std::size_t>(start)*size,
+                                      size, requests[j].type, buffer.data() + columns[j]->offset, _rowSize,
+                                      columns[j]->type, 1, num)) {
+                    _free(results);
+                    throw LSST_EXCEPT(lsst::pex::exceptions::TypeError,
+                        str(boost::format("Unable to convert data for %s from %s") %
+                            requests[j].name % _indexName));
+                }
+            }
+            start = end;
+        }
+        return results;
     }
 
-    afwTable::Key<afwTable::Flag> resolvedKey;
+private:
+    /// Layout of a column within a row
+    struct Column {
+        int offset;  ///< offset within a row (bytes)
+        int size;  ///< size of the value (bytes)
+        tfits_type type;  ///< FITS type of the value
+    };
+
+    /// Get the layout of a column, locating it the first time
+    Column const& _getColumn(std::string const& name) {
+        auto iter = _columns.find(name);
+        if (iter != _columns.end()) {
+            return iter->second;
+        }
+        qfits_table* table = _tag->table;
+        int const index = fits_find_column(table, name.c_str());
+        if (index < 0) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError,
+                str(boost::format("Unable to read data for %s from %s") % name % _indexName));
+        }
+        qfits_col const& col = table->col[index];
+        if (col.atom_nb != 1 || col.atom_type == TFITS_BIN_TYPE_X) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::TypeError,
+                str(boost::format("Column %s of %s is not a scalar") % name % _indexName));
+        }
+        Column column;
+        column.offset = fits_offset_of_column(table, index);
+        column.size = col.atom_size;
+        column.type = col.atom_type;
+        return _columns.emplace(name, column).first->second;
+    }
+
+    static bool _isLittleEndian() {
+        std::uint16_t const one = 1;
+        return *reinterpret_cast<unsigned char const*>(&one) == 1;
+    }
+
+    static void _free(std::vector<void*> & arrays) {
+        for (void* array : arrays) {
+            free(array);
+        }
+        arrays.clear();
+    }
+
+    static int const _maxRunRows = 4096;  // maximum number of rows to read at once
+
+    fitstable_t* _tag;
+    std::string _indexName;
+    std::size_t _rowSize;
+    std::map<std::string, Column> _columns;  // columns located so far, by name
+};
+
+std::int64_t* readIdColumn(TagAlongGather & gather, char const* idCol, int const* starinds, int nstars) {
+    std::vector<TagAlongGather::Request> requests(1, TagAlongGather::Request(idCol, fitscolumn_i64_type()));
+    return static_cast<std::int64_t*>(gather.read(requests, starinds, nstars)[0]);
+}
+
+/// Read the tag-along columns other than the ID, in one pass
+void readTagAlongColumns(
+    TagAlongData & data,
+    TagAlongGather & gather,
+    int const* starinds,
+    int nstars,
+    std::vector<MagColInfo> const& magColInfoList,
+    char const* isStarCol,
+    char const* isVarCol)
+{
+    tfits_type flt = fitscolumn_float_type();
+    tfits_type boo = fitscolumn_boolean_type();
+
+    std::vector<TagAlongGather::Request> requests;
+    for (auto const& mc : magColInfoList) {
+        requests.emplace_back(mc.magCol, flt);
+        if (mc.hasErr()) {
+            requests.emplace_back(mc.magErrCol, flt);
+        }
+    }
     if (isStarCol) {
-        resolvedKey = schema.addField<afwTable::Flag>(
-            "resolved",
-            "set if the reference object is resolved");
+        /*  There is something weird going on with handling of bools; maybe "T" vs "F"?
+            so read as uint8 and compare with zero.
+        */
+        requests.emplace_back(isStarCol, fitscolumn_u8_type());
     }
-    afwTable::Key<afwTable::Flag> variableKey;
     if (isVarCol) {
-        variableKey = schema.addField<afwTable::Flag>(
-            "variable",
-            "set if the reference object is variable");
-    }
-    afwTable::Key<afwTable::Flag> photometricKey = schema.addField<afwTable::Flag>(
-        "photometric",
-        "set if the reference object can be used in photometric calibration");
-
-    afwTable::SimpleCatalog cat;
-    if (idCol) {
-        // make catalog with no IdFactory, since IDs are external
-        cat = afwTable::SimpleCatalog(afwTable::SimpleTable::make(schema, PTR(afwTable::IdFactory)()));
-    } else {
-        // let the catalog assign IDs
-        cat = afwTable::SimpleCatalog(afwTable::SimpleTable::make(schema));
-    }
-
-    // for uniqueIds: keep track of the IDs we have already added to the result set.
-    std::set<std::int64_t> uids;
-
-    for (std::vector<index_t*>::iterator pind = inds.begin(); pind != inds.end(); ++pind) {
-        index_t* ind = (*pind);
-        // Find nearby stars
-        double *radecs = NULL;
-        int *starinds = NULL;
-        int nstars = 0;
-        startree_search_for(ind->starkd, xyz, r2, NULL, &radecs, &starinds, &nstars);
-        //printf("found %i in \"%s\"\n", nstars, ind->indexname);
-        if (nstars == 0) {
-            continue;
-        }
-
-        std::vector<float*> mag;
-        std::vector<float*> magErr;
-        mag.reserve(nMag);
-        magErr.reserve(nMag);
-        std::int64_t* id = NULL;
-        bool* stargal = NULL;
-        bool* var = NULL;
-        if (idCol || nMag || isStarCol || isVarCol) {
-            fitstable_t* tag = startree_get_tagalong(ind->starkd);
-            tfits_type flt = fitscolumn_float_type();
-            tfits_type boo = fitscolumn_boolean_type();
-            tfits_type i64 = fitscolumn_i64_type();
-
-            if (!tag) {
-                std::string msg = boost::str(boost::format(
-                    "astrometry_net_data index file %s does not contain a tag-along table, "
-                    "so can't retrieve extra columns.  idCol=%s, isStarCol=%s, isVarCol=%s") %
-                    ind->indexname % idCol % isStarCol % isVarCol);
-                 msg += ", mag columns=[";
-                 for (unsigned int i=0; i<nMag; i++) {
-                     if (i) {
-                         msg += ",";
-                     }
-                     msg += " name='" + magColInfoList[i].filterName +
-                         "', mag='" + magColInfoList[i].magCol +
-                         "', magErr='" + magColInfoList[i].magErrCol + "'";
-                 }
-                 msg += " ].  You may need to edit the $ASTROMETRY_NET_DATA_DIR/andConfig.py file to set idColumn=None, etc.";
-                 throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError, msg);
+        requests.emplace_back(isVarCol, boo);
+    }
+    if (requests.empty()) {
+        return;
+    }
+    std::vector<void*> arrays = gather.read(requests, starinds, nstars);
+
+    // TagAlongData frees the arrays
+    std::size_t j = 0;
+    data.mag.reserve(magColInfoList.size());
+    data.magErr.reserve(magColInfoList.size());
+    for (auto const& mc : magColInfoList) {
+        data.mag.push_back(static_cast<float*>(arrays[j++]));
+        if (mc.hasErr()) {
+            data.magErr.push_back(static_cast<float*>(arrays[j++]));
+        }
+    }
+    if (isStarCol) {
+        std::uint8_t* sg = static_cast<std::uint8_t*>(arrays[j++]);
+        data.stargal = static_cast<bool*>(malloc(std::max(nstars, 1)));
+        if (!data.stargal) {
+            free(sg);
+            throw LSST_EXCEPT(lsst::pex::exceptions::MemoryError,
+                str(boost::format("Unable to allocate memory for %s") % isStarCol));
+        }
+        for (int i = 0; i < nstars; ++i) {
+            data.stargal[i] = (sg[i] > 0);
+        }
+        free(sg);
+    }
+    if (isVarCol) {
+        data.var = static_cast<bool*>(arrays[j++]);
+    }
+
+    // Convert each band at once, before any objects are appended
+    data.flux.resize(data.mag.size());
+    data.fluxErr.resize(data.magErr.size());
+    std::size_t ej = 0;
+    for (std::size_t k = 0; k < magColInfoList.size(); ++k) {
+        data.flux[k].resize(nstars);
+        magsToFluxes(data.mag[k], nstars, data.flux[k].data());
+        if (magColInfoList[k].hasErr()) {
+            data.fluxErr[ej].resize(nstars);
+            magErrsToFluxErrs(data.magErr[ej], data.flux[k].data(), nstars, data.fluxErr[ej].data());
+            ++ej;
+        }
+    }
+}
+
+/**
+Append a reference object to columns
+
+@param[in,out] columns  columns to which to append the object
+@param[in] radec  position of the object: RA, Dec (deg)
+@param[in] data  tag-along data
+@param[in] row  row of the object in the tag-along data
+*/
+void appendRow(
+    RefObjColumns & columns,
+    double const* radec,
+    TagAlongData const& data,
+    int row)
+{
+    // Note that all coords in afwTable catalogs are ICRS; hopefully that's what the
+    // reference catalogs are (and that's what the code assumed before JFB modified it).
+    lsst::afw::geom::SpherePoint const coord(radec[0] * afwGeom::degrees, radec[1] * afwGeom::degrees);
+    columns.ra.push_back(coord.getLongitude().asRadians());
+    columns.dec.push_back(coord.getLatitude().asRadians());
+
+    if (data.id) {
+        columns.id.push_back(data.id[row]);
+    }
+
+    // fluxes were converted from the magnitudes by readTagAlongColumns;
+    // only non-empty error columns are populated in these vectors.
+    assert(columns.flux.size() == data.flux.size());
+    assert(columns.fluxErr.size() == data.fluxErr.size());
+    for (std::size_t j = 0; j < data.flux.size(); ++j) {
+        columns.flux[j].push_back(data.flux[j][row]);
+    }
+    for (std::size_t j = 0; j < data.fluxErr.size(); ++j) {
+        columns.fluxErr[j].push_back(data.fluxErr[j][row]);
+    }
+
+    bool photometric = true;
+    if (data.stargal) {
+        columns.resolved.push_back(!data.stargal[row]);
+        photometric &= data.stargal[row];
+    }
+    if (data.var) {
+        columns.variable.push_back(data.var[row]);
+        photometric &= (!data.var[row]);
+    }
+    columns.photometric.push_back(photometric);
+}
+
+/**
+Get the indices of the magnitude columns on which a filter places limits
+
+@param[in] refObjFilter  criteria reference objects must satisfy
+@param[in] magColInfoList  list of information about magnitude columns
+
+@return index in magColInfoList for each element of refObjFilter.magLimits
+
+@throw lsst::pex::exceptions::InvalidParameterError if a limit is for a filter not in magColInfoList
+*/
+std::vector<std::size_t> getMagLimitColumns(
+    RefObjFilter const& refObjFilter,
+    std::vector<MagColInfo> const& magColInfoList)
+{
+    std::vector<std::size_t> columns;
+    columns.reserve(refObjFilter.magLimits.size());
+    for (auto const& limit : refObjFilter.magLimits) {
+        std::size_t j = 0;
+        while (j < magColInfoList.size() && magColInfoList[j].filterName != limit.filterName) {
+            ++j;
+        }
+        if (j == magColInfoList.size()) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                str(boost::format("Cannot limit the magnitude of filter %s, which is not being read") %
+                    limit.filterName));
+        }
+        columns.push_back(j);
+    }
+    return columns;
+}
+
+/**
+Evaluate a filter on tag-along data
+
+@param[in] refObjFilter  criteria reference objects must satisfy
+@param[in] magLimitColumns  index of the magnitude column for each magnitude limit, from getMagLimitColumns
+@param[in] data  tag-along data
+@param[in] nrows  number of rows in the tag-along data
+
+@return whether each row satisfies the criteria
+*/
+std::vector<bool> evaluateFilter(
+    RefObjFilter const& refObjFilter,
+    std::vector<std::size_t> const& magLimitColumns,
+    TagAlongData const& data,
+    int nrows)
+{
+    std::vector<bool> pass(nrows, true);
+    for (std::size_t k = 0; k < magLimitColumns.size(); ++k) {
+        float const* mag = data.mag[magLimitColumns[k]];
+        double const minMag = refObjFilter.magLimits[k].minMag;
+        double const maxMag = refObjFilter.magLimits[k].maxMag;
+        for (int row = 0; row < nrows; ++row) {
+            // written so that NaN fails
+            if (!(mag[row] >= minMag && mag[row] <= maxMag)) {
+                pass[row] = false;
             }
+        }
+    }
+    // resolved and variable are as appendRow sets them in the column vectors (resolved is !stargal),
+    // and photometric is true if the object is neither
+    bool const checkResolved = data.stargal && (refObjFilter.excludeResolved || refObjFilter.photometricOnly);
+    bool const checkVariable = data.var && (refObjFilter.excludeVariable || refObjFilter.photometricOnly);
+    for (int row = 0; row < nrows; ++row) {
+        if ((checkResolved && !data.stargal[row]) || (checkVariable && data.var[row])) {
+            pass[row] = false;
+        }
+    }
+    return pass;
+}
+
+/// Results of a search of a star kd-tree; the memory is freed on destruction
+struct StarSearch {
+    double* radecs = NULL;
+    int* starinds = NULL;
+    int nstars = 0;
 
+    StarSearch() = default;
+    StarSearch(StarSearch const&) = delete;
+    StarSearch& operator=(StarSearch const&) = delete;
+    StarSearch(StarSearch && other) : radecs(other.radecs), starinds(other.starinds), nstars(other.nstars) {
+        other.radecs = NULL;
+        other.starinds = NULL;
+        other.nstars = 0;
+    }
+
+    ~StarSearch() {
+        free(radecs);
+        free(starinds);
+    }
+};
+
+/// Keep only the stars found by a search that are inside a polygon
+void restrictToPolygon(StarSearch & search, SkyPolygon const& polygon) {
+    int nkeep = 0;
+    for (int i = 0; i < search.nstars; ++i) {
+        double xyz[3];
+        radecdeg2xyzarr(search.radecs[i*2 + 0], search.radecs[i*2 + 1], xyz);
+        if (polygon.contains(xyz)) {
+            if (nkeep != i) {
+                search.starinds[nkeep] = search.starinds[i];
+                search.radecs[nkeep*2 + 0] = search.radecs[i*2 + 0];
+                search.radecs[nkeep*2 + 1] = search.radecs[i*2 + 1];
+            }
+            nkeep++;
+        }
+    }
+    search.nstars = nkeep;
+}
+
+/**
+Whether the stars of two indexes may overlap, so that they may have objects in common
+
+The stars of an index cover its healpix plus a small margin, so the stars of indexes
+with the same nside can only overlap if their healpixes are the same or neighbours.
+Indexes without a healpix, or with different nsides, are assumed to overlap.
+*/
+bool indexesOverlap(index_t const* ind1, index_t const* ind2) {
+    if (ind1->healpix < 0 || ind2->healpix < 0 || ind1->hpnside != ind2->hpnside) {
+        return true;
+    }
+    if (ind1->healpix == ind2->healpix) {
+        return true;
+    }
+    int neighbours[8];
+    int const num = healpix_get_neighbours(ind1->healpix, neighbours, ind1->hpnside);
+    return std::find(neighbours, neighbours + num, ind2->healpix) != neighbours + num;
+}
+
+/**
+Set of object IDs: an open-addressing hash table with linear probing
+
+Unlike std::set and std::unordered_set, this does not allocate per ID.
+*/
+class IdSet {
+public:
+    IdSet() : _slots(), _size(0), _hasZero(false) {}
+
+    /// Add an ID
+    void insert(std::int64_t id) {
+        if (id == 0) {  // zero marks an empty slot, so is recorded separately
+            _hasZero = true;
+            return;
+        }
+        if (2*(_size + 1) > _slots.size()) {
+            _rehash(std::max<std::size_t>(16, 2*_slots.size()));
+        }
+        std::size_t const mask = _slots.size() - 1;
+        for (std::size_t i = _hash(id) & mask; ; i = (i + 1) & mask) {
+            if (_slots[i] == id) {
+                return;
+            }
+            if (_slots[i] == 0) {
+                _slots[i] = id;
+                ++_size;
+                return;
+            }
+        }
+    }
+
+    /// Is an ID in the set?
+    bool contains(std::int64_t id) const {
+        if (id == 0) {
+            return _hasZero;
+        }
+        if (_slots.empty()) {
+            return false;
+        }
+        std::size_t const mask = _slots.size() - 1;
+        for (std::size_t i = _hash(id) & mask; _slots[i] != 0; i = (i + 1) & mask) {
+            if (_slots[i] == id) {
+                return true;
+            }
+        }
+        return false;
+    }
+
+private:
+    /// Mix the bits of an ID (the splitmix64 finalizer), as IDs are often sequential
+    static std::size_t _hash(std::int64_t id) {
+        std::uint64_t x = static_cast<std::uint64_t>(id);
+        x = (x ^ (x >> 30))*0xbf58476d1ce4e5b9ULL;
+        x = (x ^ (x >> 27))*0x94d049bb133111ebULL;
+        return x ^ (x >> 31);
+    }
+
+    void _rehash(std::size_t numSlots) {
+        std::vector<std::int64_t> old(numSlots, 0);
+        old.swap(_slots);
+        _size = 0;
+        for (std::int64_t id : old) {
+            if (id != 0) {
+                insert(id);
+            }
+        }
+    }
+
+    std::vector<std::int64_t> _slots;  // number of slots is a power of 2; 0 if empty
+    std::size_t _size;  // number of non-zero IDs
+    bool _hasZero;
+};
+
+/// Stars found in the cones by one index, with their tag-along data
+struct IndexStars {
+    explicit IndexStars(std::size_t nCones) : searches(nCones), unionInds(), gather(), data(),
+                                              rows(nCones), pass() {}
+
+    std::vector<StarSearch> searches;  // search results, one per cone
+    std::vector<int> unionInds;  // sorted indices of the stars found in any cone
+    std::unique_ptr<TagAlongGather> gather;  // reader of the tag-along table, or null if not read
+    TagAlongData data;  // tag-along data for unionInds
+    std::vector<std::vector<int> > rows;  // rows (in data) of the stars kept, one list per cone
+    std::vector<bool> pass;  // whether each row passes the filter; empty if all do
+};
+
+/// State for removing the duplicate IDs of a cone
+struct ConeIds {
+    ConeIds() : indexes(), keptIds(), ids(), numHashed(0) {}
+
+    std::vector<index_t const*> indexes;  // indexes that have contributed stars to the cone
+    std::vector<std::int64_t> keptIds;  // IDs of the stars kept so far (before filtering), in order
+    IdSet ids;  // the first numHashed of keptIds, hashed when an overlapping index needs them
+    std::size_t numHashed;
+};
+
+}  // namespace <anonymous>
+
+
+SkyPolygon::SkyPolygon(std::vector<afwGeom::SpherePoint> const& vertices, afwGeom::Angle const& margin)
+    : _minDot(-std::sin(margin.asRadians())),
+      _center(getPolygonCenter(vertices)),
+      _radius(0.0)
+{
+    std::size_t const num = vertices.size();
+    std::vector<Vector3> vectors;
+    vectors.reserve(num);
+    for (auto const& vertex : vertices) {
+        vectors.push_back(toVector3(vertex));
+    }
+    Vector3 const center = toVector3(_center);
+
+    double orientation = 1.0;  // +1 if the vertices wind anticlockwise about the center, else -1
+    _normals.reserve(num);
+    for (std::size_t i = 0; i < num; ++i) {
+        Vector3 const& a = vectors[i];
+        Vector3 const& b = vectors[(i + 1) % num];
+        Vector3 normal{{a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0]}};
+        double const norm = std::sqrt(dot(normal, normal));
+        if (norm == 0.0) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                str(boost::format("Polygon vertices %d and %d coincide") % i % ((i + 1) % num)));
+        }
+        // Point the normals inward, according to the winding of the first edge
+        double const sign = dot(normal, center) < 0 ? -1.0 : 1.0;
+        if (i == 0) {
+            orientation = sign;
+        } else if (sign != orientation) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                "Polygon vertices do not wind consistently around the polygon");
+        }
+        for (int k = 0; k < 3; ++k) {
+            normal[k] *= orientation/norm;
+        }
+        for (std::size_t j = 0; j < num; ++j) {
+            // allow for rounding in the vertices on the edge itself
+            if (dot(normal, vectors[j]) < -1.0e-12) {
+                throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError, "Polygon is not convex");
+            }
+        }
+        _normals.push_back(normal);
+    }
+
+    for (auto const& vertex : vertices) {
+        _radius = std::max(_radius, _center.separation(vertex));
+    }
+    _radius += margin;
+}
+
+
+afwTable::SimpleCatalog
+makeCatalogFromColumns(RefObjColumns const& columns)
+{
+    CatalogKeys const keys(columns.magColInfoList, columns.hasResolved, columns.hasVariable);
+    afwTable::SimpleCatalog cat = keys.makeCatalog(columns.hasId);
+    std::size_t const size = columns.size();
+
+    // Allocate all the records in one contiguous block, so that columns can be filled in bulk
+    cat.reserve(size);
+    for (std::size_t i = 0; i < size; ++i) {
+        cat.addNew();
+    }
+    afwTable::SimpleCatalog::ColumnView colView = cat.getColumnView();
+
+    afwTable::CoordKey const coordKey = afwTable::SimpleTable::getCoordKey();
+    std::copy(columns.ra.begin(), columns.ra.end(), colView.radians(coordKey.getRa()).begin());
+    std::copy(columns.dec.begin(), columns.dec.end(), colView.radians(coordKey.getDec()).begin());
+    if (columns.hasId) {
+        std::copy(columns.id.begin(), columns.id.end(), colView[afwTable::SimpleTable::getIdKey()].begin());
+    }
+    for (std::size_t j = 0; j < columns.flux.size(); ++j) {
+        std::copy(columns.flux[j].begin(), columns.flux[j].end(), colView[keys.fluxKey[j]].begin());
+    }
+    for (std::size_t j = 0; j < columns.fluxErr.size(); ++j) {
+        std::copy(columns.fluxErr[j].begin(), columns.fluxErr[j].end(), colView[keys.fluxErrKey[j]].begin());
+    }
+
+    // Flag columns are read-only in a ColumnView; new records have all flags (including hasCentroid) unset
+    for (std::size_t i = 0; i < size; ++i) {
+        afwTable::SimpleRecord & src = cat[i];
+        if (columns.hasResolved && columns.resolved[i]) {
+            src.set(keys.resolvedKey, true);
+        }
+        if (columns.hasVariable && columns.variable[i]) {
+            src.set(keys.variableKey, true);
+        }
+        if (columns.photometric[i]) {
+            src.set(keys.photometricKey, true);
+        }
+    }
+    return cat;
+}
+
+
+afwTable::SimpleCatalog
+getCatalogImpl(std::vector<index_t*> inds,
+    lsst::afw::geom::SpherePoint const &ctrCoord,
+    lsst::afw::geom::Angle const &radius,
+    char const* idCol,
+    std::vector<MagColInfo> const& magColInfoList,
+    char const* isStarCol,
+    char const* isVarCol,
+    bool uniqueIds,
+    RefObjFilter const& refObjFilter,
+    int numThreads)
+{
+    std::vector<afwTable::SimpleCatalog> cats = getCatalogsImpl(inds,
+        std::vector<lsst::afw::geom::SpherePoint>(1, ctrCoord), std::vector<lsst::afw::geom::Angle>(1, radius),
+        idCol, magColInfoList, isStarCol, isVarCol, uniqueIds, false, refObjFilter,
+        std::vector<SkyPolygon>(), numThreads);
+    return cats[0];
+}
+
+
+std::vector<afwTable::SimpleCatalog>
+getCatalogsImpl(std::vector<index_t*> inds,
+    std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+    std::vector<lsst::afw::geom::Angle> const &radiusList,
+    char const* idCol,
+    std::vector<MagColInfo> const& magColInfoList,
+    char const* isStarCol,
+    char const* isVarCol,
+    bool uniqueIds,
+    bool checkRange,
+    RefObjFilter const& refObjFilter,
+    std::vector<SkyPolygon> const& polygonList,
+    int numThreads)
+{
+    std::vector<RefObjColumns> columnsList = getColumnsImpl(inds, ctrCoordList, radiusList, idCol,
+        magColInfoList, isStarCol, isVarCol, uniqueIds, checkRange, refObjFilter, polygonList, numThreads);
+    std::vector<afwTable::SimpleCatalog> cats;
+    cats.reserve(columnsList.size());
+    for (auto const& columns : columnsList) {
+        cats.push_back(makeCatalogFromColumns(columns));
+    }
+    return cats;
+}
+
+
+std::vector<RefObjColumns>
+getColumnsImpl(std::vector<index_t*> inds,
+    std::vector<lsst::afw::geom::SpherePoint> const &ctrCoordList,
+    std::vector<lsst::afw::geom::Angle> const &radiusList,
+    char const* idCol,
+    std::vector<MagColInfo> const& magColInfoList,
+    char const* isStarCol,
+    char const* isVarCol,
+    bool uniqueIds,
+    bool checkRange,
+    RefObjFilter const& refObjFilter,
+    std::vector<SkyPolygon> const& polygonList,
+    int numThreads)
+{
+    /*
+     If uniqueIds == true: return only reference sources with unique IDs;
+     arbitrarily keep the first star found with each ID (independently for each cone).
+     Duplicates are removed before filtering, so a star rejected by the filter still hides
+     later stars with the same ID.  Repeats within an index are found by sorting its IDs;
+     duplicates in earlier indexes can only arise where the stars of the indexes overlap, so
+     the IDs kept from earlier indexes are only hashed and checked if the index overlaps one
+     that has already contributed stars to the cone.
+     */
+    if (ctrCoordList.size() != radiusList.size()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+            str(boost::format("Length of ctrCoordList (%d) and radiusList (%d) differ") %
+                ctrCoordList.size() % radiusList.size()));
+    }
+    if (!polygonList.empty() && polygonList.size() != ctrCoordList.size()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+            str(boost::format("Length of polygonList (%d) and ctrCoordList (%d) differ") %
+                polygonList.size() % ctrCoordList.size()));
+    }
+    checkMagColInfo(magColInfoList);
+    std::vector<std::size_t> const magLimitColumns = getMagLimitColumns(refObjFilter, magColInfoList);
+    std::size_t const nCones = ctrCoordList.size();
+    bool const readTagAlong = idCol || !magColInfoList.empty() || isStarCol || isVarCol;
+
+    std::vector<double> raDeg(nCones), decDeg(nCones), radiusDeg(nCones), r2(nCones);
+    std::vector<std::array<double, 3> > xyz(nCones);
+    for (std::size_t c = 0; c < nCones; ++c) {
+        raDeg[c] = ctrCoordList[c].getLongitude().asDegrees();
+        decDeg[c] = ctrCoordList[c].getLatitude().asDegrees();
+        radiusDeg[c] = radiusList[c].asDegrees();
+        radecdeg2xyzarr(raDeg[c], decDeg[c], xyz[c].data());
+        r2[c] = deg2distsq(radiusDeg[c]);
+    }
+
+    RefObjColumns emptyColumns;
+    emptyColumns.magColInfoList = magColInfoList;
+    emptyColumns.hasId = idCol;
+    emptyColumns.hasResolved = isStarCol;
+    emptyColumns.hasVariable = isVarCol;
+    emptyColumns.flux.resize(magColInfoList.size());
+    for (auto const& mc : magColInfoList) {
+        if (mc.hasErr()) {
+            emptyColumns.fluxErr.push_back(std::vector<double>());
+        }
+    }
+    std::vector<RefObjColumns> columnsList(nCones, emptyColumns);
+
+    // for uniqueIds: keep track of the IDs we have already kept for each result set.
+    std::vector<ConeIds> coneIds(nCones);
+
+    // Search a star kd-tree for the stars in each cone, and read their IDs;
+    // returns null if no stars are found
+    auto searchIndex = [&](index_t* ind) -> std::unique_ptr<IndexStars> {
+        std::unique_ptr<IndexStars> stars(new IndexStars(nCones));
+        for (std::size_t c = 0; c < nCones; ++c) {
+            if (checkRange && !index_is_within_range(ind, raDeg[c], decDeg[c], radiusDeg[c])) {
+                continue;
+            }
+            StarSearch & search = stars->searches[c];
+            startree_search_for(ind->starkd, xyz[c].data(), r2[c], NULL, &search.radecs, &search.starinds,
+                                &search.nstars);
+            if (!polygonList.empty()) {
+                restrictToPolygon(search, polygonList[c]);
+            }
+            stars->unionInds.insert(stars->unionInds.end(), search.starinds, search.starinds + search.nstars);
+        }
+        if (stars->unionInds.empty()) {
+            return nullptr;
+        }
+        // Read each tag-along row at most once, in file order
+        std::vector<int> & unionInds = stars->unionInds;
+        std::sort(unionInds.begin(), unionInds.end());
+        unionInds.erase(std::unique(unionInds.begin(), unionInds.end()), unionInds.end());
+
+        if (readTagAlong) {
+            stars->gather.reset(new TagAlongGather(getTagAlong(ind, idCol, magColInfoList, isStarCol,
+                                                               isVarCol), ind->indexname));
             if (idCol) {
-                id = static_cast<int64_t*>(fitstable_read_column_inds(tag, idCol, i64, starinds, nstars));
-                if (!id) {
-                    throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError,
-                        str(boost::format("Unable to read data for %s from %s") % idCol % ind->indexname));
-                }
+                stars->data.id = readIdColumn(*stars->gather, idCol, unionInds.data(),
+                                              static_cast<int>(unionInds.size()));
             }
-            if (id && uniqueIds) {
+        }
+
+        // Rows (in the tag-along data) of the stars found, for each cone
+        for (std::size_t c = 0; c < nCones; ++c) {
+            StarSearch const& search = stars->searches[c];
+            std::vector<int> & rows = stars->rows[c];
+            rows.reserve(search.nstars);
+            for (int i = 0; i < search.nstars; ++i) {
+                rows.push_back(std::lower_bound(unionInds.begin(), unionInds.end(), search.starinds[i]) -
+                               unionInds.begin());
+            }
+        }
+        return stars;
+    };
+
+    // Read the remaining tag-along columns of the stars found, and evaluate the filter
+    auto readColumns = [&](IndexStars & stars) {
+        int const nUnion = stars.unionInds.size();
+        if (readTagAlong) {
+            readTagAlongColumns(stars.data, *stars.gather, stars.unionInds.data(), nUnion, magColInfoList,
+                                isStarCol, isVarCol);
+        }
+        if (!refObjFilter.isTrivial()) {
+            stars.pass = evaluateFilter(refObjFilter, magLimitColumns, stars.data, nUnion);
+        }
+    };
+
+    // Drop the stars whose IDs have already been found in each cone; returns whether any remain
+    auto removeDuplicates = [&](IndexStars & stars, index_t* ind) -> bool {
+        bool anyKept = false;
+        std::vector<std::pair<std::int64_t, int> > sortedIds;  // (ID, position in the search)
+        std::vector<bool> keep;
+        for (std::size_t c = 0; c < nCones; ++c) {
+            StarSearch & search = stars.searches[c];
+            std::vector<int> & rows = stars.rows[c];
+            if (stars.data.id && uniqueIds && !rows.empty()) {
                 // remove duplicate IDs.
 
                 // FIXME -- this shouldn't be necessary once we get astrometry_net 0.40
                 // multi-index functionality in place.
+                ConeIds & cone = coneIds[c];
+                int const nstars = rows.size();
+                keep.assign(nstars, true);
 
-                if (uids.empty()) {
-                    uids = std::set<std::int64_t>(id, id+nstars);
-                } else {
-                    int nkeep = 0;
-                    for (int i=0; i<nstars; i++) {
-                        //std::pair<std::set<std::int64_t>::iterator, bool> 
-                        if (uids.insert(id[i]).second) {
-                            // inserted; keep this one.
-                            if (nkeep != i) {
-                                // compact the arrays.
-                                starinds[nkeep] = starinds[i];
-                                radecs[nkeep*2+0] = radecs[i*2+0];
-                                radecs[nkeep*2+1] = radecs[i*2+1];
-                                id[nkeep] = id[i];
-                            }
-                            nkeep++;
-                        } else {
-                            // did not insert (this id has already been found);
-                            // drop this star.
-                        }
-                    }
-                    nstars = nkeep;
-                    // if they were all duplicate IDs...
-                    if (nstars == 0) {
-                        free(starinds);
-                        free(radecs);
-                        free(id);
-                        continue;
+                // Repeats within this index: keep the first of each ID
+                sortedIds.clear();
+                for (int i = 0; i < nstars; ++i) {
+                    sortedIds.emplace_back(stars.data.id[rows[i]], i);
+                }
+                std::sort(sortedIds.begin(), sortedIds.end());
+                for (std::size_t k = 1; k < sortedIds.size(); ++k) {
+                    if (sortedIds[k].first == sortedIds[k - 1].first) {
+                        keep[sortedIds[k].second] = false;
                     }
                 }
-            }
 
-            for (auto mc = magColInfoList.cbegin(); mc != magColInfoList.cend(); ++mc) {
-                char const* col = mc->magCol.c_str();
-                mag.push_back(read_column(tag, col, flt, starinds, nstars, ind->indexname));
-                if (mc->hasErr()) {
-                    char const* col = mc->magErrCol.c_str();
-                    magErr.push_back(read_column(tag, col, flt, starinds, nstars, ind->indexname));
-                }
-            }
-            if (isStarCol) {
-                /*  There is something weird going on with handling of bools; maybe "T" vs "F"?
-                stargal = static_cast<bool*>(fitstable_read_column_inds(tag, isStarCol, boo, starinds, nstars));
-                for (int j=0; j<nstars; j++) {
-                printf("  sg %i = %i, vs %i\n", j, (int)sg[j], stargal[j] ? 1:0);
-                }
-                */
-                uint8_t* sg = static_cast<uint8_t*>(fitstable_read_column_inds(
-                    tag, isStarCol, fitscolumn_u8_type(), starinds, nstars));
-                stargal = static_cast<bool*>(malloc(nstars));
-                if (!stargal) {
-                    throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError,
-                        str(boost::format("Unable to read data for %s from %s") % isStarCol % ind->indexname));
+                // Objects found with the same ID in an earlier, overlapping index are duplicates
+                if (std::any_of(cone.indexes.begin(), cone.indexes.end(),
+                                [ind](index_t const* other) { return indexesOverlap(ind, other); })) {
+                    for (; cone.numHashed < cone.keptIds.size(); ++cone.numHashed) {
+                        cone.ids.insert(cone.keptIds[cone.numHashed]);
+                    }
+                    for (int i = 0; i < nstars; ++i) {
+                        if (keep[i] && cone.ids.contains(stars.data.id[rows[i]])) {
+                            keep[i] = false;
+                        }
+                    }
                 }
-                for (int j=0; j<nstars; j++) {
-                    stargal[j] = (sg[j] > 0);
+
+                int nkeep = 0;
+                for (int i = 0; i < nstars; ++i) {
+                    if (keep[i]) {
+                        // not found yet; keep this one.
+                        int const row = rows[i];
+                        if (nkeep != i) {
+                            // compact the arrays.
+                            rows[nkeep] = row;
+                            search.radecs[nkeep*2 + 0] = search.radecs[i*2 + 0];
+                            search.radecs[nkeep*2 + 1] = search.radecs[i*2 + 1];
+                        }
+                        cone.keptIds.push_back(stars.data.id[row]);
+                        nkeep++;
+                    }
                 }
-                free(sg);
+                rows.resize(nkeep);
+                cone.indexes.push_back(ind);
             }
-            if (isVarCol) {
-                var = static_cast<bool*>(fitstable_read_column_inds(tag, isVarCol, boo, starinds, nstars));
-                if (!var) {
-                    throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError,
-                        str(boost::format("Unable to read data for %s from %s") % isVarCol % ind->indexname));
+            anyKept |= !rows.empty();
+        }
+        return anyKept;
+    };
+
+    // Append the stars that pass the filter to the columns of each cone
+    auto appendStars = [&](IndexStars const& stars) {
+        for (std::size_t c = 0; c < nCones; ++c) {
+            double const* radecs = stars.searches[c].radecs;
+            std::vector<int> const& rows = stars.rows[c];
+            RefObjColumns & columns = columnsList[c];
+            for (std::size_t i = 0; i < rows.size(); ++i) {
+                if (!stars.pass.empty() && !stars.pass[rows[i]]) {
+                    continue;
                 }
+                appendRow(columns, radecs + 2*i, stars.data, rows[i]);
             }
         }
+    };
 
-        for (int i=0; i<nstars; i++) {
-            PTR(afwTable::SimpleRecord) src = cat.addNew();
-
-            // Note that all coords in afwTable catalogs are ICRS; hopefully that's what the 
-            // reference catalogs are (and that's what the code assumed before JFB modified it).
-            src->setCoord(
-                lsst::afw::geom::SpherePoint(
-                    radecs[i * 2 + 0] * afwGeom::degrees,
-                    radecs[i * 2 + 1] * afwGeom::degrees
-                )
-            );
-
-            if (id) {
-                src->setId(id[i]);
+    std::size_t const numInds = inds.size();
+    std::size_t const numWorkers = std::min<std::size_t>(std::max(numThreads, 1), numInds);
+    if (numWorkers <= 1) {
+        for (index_t* ind : inds) {
+            std::unique_ptr<IndexStars> stars = searchIndex(ind);
+            if (!stars || !removeDuplicates(*stars, ind)) {
+                // no stars, or all duplicate IDs
+                continue;
             }
+            readColumns(*stars);
+            appendStars(*stars);
+        }
+        return columnsList;
+    }
 
-            src->set(hasCentroidKey, false);
-
-            assert(fluxKey.size() == nMag);
-            // only non-empty error columns are populated in these vectors.
-            assert(fluxErrKey.size() == magErr.size());
-            // index into non-empty error columns.
-            size_t ej = 0;
-            size_t j = 0;
-            for (auto mc = magColInfoList.cbegin(); mc != magColInfoList.cend(); ++mc, ++j) {
-                // There is some dispute about returning flux or magnitudes
-                // flux is not conventional, but is convenient for several reasons
-                // - it simplifies matching to sources for astrometric calibration
-                // - flux errors are easier to combine than magnitude errors
-                //printf("mag %s = %g\n", mc->filterName.c_str(), mag[j][i]);
-                double flux = lsst::afw::image::fluxFromABMag(mag[j][i]);
-                //printf("flux %g\n", flux);
-                src->set(fluxKey[j], flux);
-                if (mc->hasErr()) {
-                    //printf("mag err = %g\n", magErr[ej][i]);
-                    double fluxErr = lsst::afw::image::fluxErrFromABMagErr(magErr[ej][i], mag[j][i]);
-                    //printf("flux err = %g\n", fluxErr);
-                    src->set(fluxErrKey[ej], fluxErr);
-                    ej++;
+    // Search and read the indexes in parallel; the stars of each index are merged in index order
+    // afterwards, so the results are the same as above.  Duplicates are not known until the merge,
+    // so all the columns of the stars found are read.
+    std::vector<std::unique_ptr<IndexStars> > starsList(numInds);
+    std::vector<std::exception_ptr> errors(numInds);
+    std::atomic<std::size_t> next(0);
+    auto work = [&]() {
+        for (std::size_t k = next++; k < numInds; k = next++) {
+            try {
+                starsList[k] = searchIndex(inds[k]);
+                if (starsList[k]) {
+                    readColumns(*starsList[k]);
                 }
+            } catch (...) {
+                errors[k] = std::current_exception();
             }
-            assert(ej == fluxErrKey.size());
-
-            bool photometric = true;
-            if (stargal) {
-                src->set(resolvedKey, !stargal[i]);
-                photometric &= stargal[i];
-            }
-            if (var) {
-                src->set(variableKey, var[i]);
-                photometric &= (!var[i]);
-            }
-            src->set(photometricKey, photometric);
         }
+    };
+    std::vector<std::thread> threads;
+    threads.reserve(numWorkers - 1);
+    for (std::size_t t = 1; t < numWorkers; ++t) {
+        threads.emplace_back(work);
+    }
+    work();
+    for (auto & thread : threads) {
+        thread.join();
+    }
 
-        free(id);
-        for (size_t j=0; j<mag.size(); ++j) {
-            free(mag[j]);
+    for (std::size_t k = 0; k < numInds; ++k) {
+        if (errors[k]) {
+            std::rethrow_exception(errors[k]);
         }
-        for (size_t j=0; j<magErr.size(); ++j) {
-            free(magErr[j]);
+        if (starsList[k] && removeDuplicates(*starsList[k], inds[k])) {
+            appendStars(*starsList[k]);
         }
-        free(stargal);
-        free(var);
-        free(radecs);
-        free(starinds);
+        starsList[k].reset();
     }
-    return cat;
+    return columnsList;
 }
 
 }}}}}
@@ -0,0 +1,119 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.meas.extensions.astrometryNet import AstrometryNetDataConfig
+from lsst.meas.extensions.astrometryNet.catalogBenchmark import benchmarkCases, benchmarkCatalog, \
+    compareToBaseline
+from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
+
+# Numbers of shards in the synthetic catalogs, as for benchmarkANetCatalog.py
+SHARDS = [10, 1000, 10000]
+
+# Environment variable naming a baseline to use instead of the one in this directory
+BASELINE_ENV = "ANET_CATALOG_BENCHMARK_BASELINE"
+
+
+def getBaselinePath():
+    """Get the name of the baseline benchmark results for the startup regression gate
+
+    The baseline is written on the reference machine by:
+        benchmarkANetCatalog.py --template tests/astrometry_net_data/photocal/andConfig6.py \
+            --output tests/catalogBenchmarkBaseline.json
+    """
+    return os.environ.get(BASELINE_ENV) or os.path.join(os.path.dirname(__file__),
+                                                        "catalogBenchmarkBaseline.json")
+
+
+class CatalogBenchmarkTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.datapath = setupAstrometryNetDataDir('photocal')
+        self.template = AstrometryNetDataConfig()
+        self.template.load(os.path.join(self.datapath, 'andConfig6.py'))
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+        del self.template
+
+    def testStartup(self):
+        """Startup regression gate: the time, peak RSS and file descriptors left
+        open must not regress against the baseline (see compareToBaseline)
+
+        The times depend on the machine, so the gate is skipped unless a
+        baseline from this machine is available (see getBaselinePath).
+        """
+        filename = getBaselinePath()
+        if not os.path.exists(filename):
+            self.skipTest("No benchmark baseline %s" % (filename,))
+        with open(filename) as inFile:
+            baseline = json.load(inFile)
+        for numShards in SHARDS:
+            for case in benchmarkCases:
+                self.assertIn("seconds", baseline[str(numShards)][case])
+
+        results = benchmarkCatalog(self.template, SHARDS, self.workDir, repeat=1)
+        self.assertEqual(sorted(results.keys(), key=int), [str(numShards) for numShards in SHARDS])
+        for caseResults in results.values():
+            self.assertEqual(sorted(caseResults.keys()), sorted(benchmarkCases))
+        self.assertEqual(compareToBaseline(results, baseline), [])
+
+    def testCompareToBaseline(self):
+        """Regressions are reported against the baseline"""
+        baseline = {"10": dict((case, dict(seconds=1.0, peakRss=1000, fds=0)) for case in benchmarkCases)}
+        results = copy.deepcopy(baseline)
+        self.assertEqual(compareToBaseline(results, baseline), [])
+        results["10"]["warmCache"]["seconds"] = 3.0
+        results["10"]["noCache"]["peakRss"] = 2000
+        results["10"]["task"]["fds"] = 11
+        results["1000"] = baseline["10"]  # not in baseline, so not compared
+        regressions = compareToBaseline(results, baseline)
+        self.assertEqual(len(regressions), 3)
+        self.assertEqual(compareToBaseline(results, baseline, timeFactor=4.0, rssFactor=3.0, fdMargin=20),
+                         [])
+
+        # Quantities missing from the baseline are not compared
+        for caseBaseline in baseline["10"].values():
+            del caseBaseline["seconds"]
+        self.assertEqual(len(compareToBaseline(results, baseline)), 2)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -23,13 +23,21 @@ from builtins import zip
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
 import unittest
 
+import numpy as np
+
 import lsst.utils.tests
+from astrometry.util import ttime
 from lsst.daf.base import PropertySet
 import lsst.afw.geom as afwGeom
 from lsst.afw.table import CoordKey, Point2DKey
+from lsst.meas.algorithms import LoadReferenceObjectsTask
 from lsst.meas.extensions.astrometryNet import LoadAstrometryNetObjectsTask, \
     AstrometryNetDataConfig
 from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
@@ -91,6 +99,31 @@ class TestLoadAstrometryNetObjects(unittest.TestCase):
         for fieldName in ("coord_ra", "coord_dec", "centroid_x", "centroid_y", "hasCentroid",
                           "photometric", "resolved"):
             schema.find(fieldName)
+        self.assertTrue(np.all(refCat["hasCentroid"]))
+        pixels = self.wcs.skyToPixel([refObj.getCoord() for refObj in refCat])
+        self.assertFloatsAlmostEqual(refCat["centroid_x"], np.array([pixel.getX() for pixel in pixels]))
+        self.assertFloatsAlmostEqual(refCat["centroid_y"], np.array([pixel.getY() for pixel in pixels]))
+
+    def testPolygonSearch(self):
+        """Searching the polygon of a pixel box gives the same objects as trimming its circle
+        """
+        circleConfig = LoadAstrometryNetObjectsTask.ConfigClass()
+        circleConfig.pixelMargin = self.config.pixelMargin
+        circleConfig.polygonSearch = False
+        circleLoader = LoadAstrometryNetObjectsTask(config=circleConfig)
+        polygonLoader = LoadAstrometryNetObjectsTask(config=self.config)
+
+        thinBox = afwGeom.Box2I(afwGeom.Point2I(0, 1200), afwGeom.Extent2I(3001, 600))
+        for bbox in (self.bbox, thinBox):
+            expected = circleLoader.loadPixelBox(bbox=bbox, wcs=self.wcs, filterName="r").refCat
+            # the bulk trim matches the per-record trim of the base class
+            baseRes = LoadReferenceObjectsTask.loadPixelBox(circleLoader, bbox=bbox, wcs=self.wcs,
+                                                            filterName="r")
+            self.assertEqual(list(expected["id"]), list(baseRes.refCat["id"]))
+            loadRes = polygonLoader.loadPixelBox(bbox=bbox, wcs=self.wcs, filterName="r")
+            self.assertEqual(loadRes.fluxField, "r_flux")
+            self.assertEqual(sorted(loadRes.refCat["id"]), sorted(expected["id"]))
+            self.assertObjInBBox(refCat=loadRes.refCat, bbox=bbox, wcs=self.wcs)
 
     def testLoadSkyCircle(self):
         loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
@@ -100,6 +133,308 @@ class TestLoadAstrometryNetObjects(unittest.TestCase):
 
         loadRes = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r")
         self.assertEqual(len(loadRes.refCat), self.desNumStarsInSkyCircle)
+        self.assertEqual(len(np.unique(loadRes.refCat["id"])), len(loadRes.refCat))
+        for fieldName in ("r_flux", "r_fluxErr"):
+            self.assertEqual(loadRes.refCat.schema.find(fieldName).field.getUnits(), "nJy")
+
+    def testRepeatedIds(self):
+        """Objects with an ID repeated within a single index are only returned once
+        """
+        # Truncated magnitudes make an ID column with many repeats within the index
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.datapath, "andConfig.py"))
+        andConfig.idColumn = "r"
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config, andConfig=andConfig)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        ids = loadANetObj.loadColumns([(ctrCoord, radius)], filterName="r")[0].id
+        self.assertGreater(len(ids), 1)
+        self.assertLess(len(ids), self.desNumStarsInSkyCircle)
+        self.assertEqual(len(np.unique(ids)), len(ids))
+
+    def testLoadSkyCircles(self):
+        """Loading several regions at once matches loading them one at a time
+        """
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        cones = [(ctrCoord, radius), (ctrCoord, 0.5*radius)]
+        cones += [(self.wcs.pixelToSky(afwGeom.Point2D(x, y)), 0.5*radius) for x, y in
+                  ((0, 0), (3000, 0), (1500, 3000))]
+        cones.append((afwGeom.SpherePoint(ctrCoord.getLongitude(), -ctrCoord.getLatitude()), radius))
+
+        results = loadANetObj.loadSkyCircles(cones, filterName="r")
+        self.assertEqual(len(results), len(cones))
+        self.assertEqual(len(results[0].refCat), self.desNumStarsInSkyCircle)
+        self.assertEqual(len(results[-1].refCat), 0)
+        for (coord, rad), batchRes in zip(cones, results):
+            loadRes = loadANetObj.loadSkyCircle(ctrCoord=coord, radius=rad, filterName="r")
+            self.assertEqual(batchRes.fluxField, loadRes.fluxField)
+            self.assertEqual(batchRes.refCat.schema, loadRes.refCat.schema)
+            self.assertEqual(list(batchRes.refCat["id"]), list(loadRes.refCat["id"]))
+            for name in ("coord_ra", "coord_dec", "r_flux", "r_fluxErr"):
+                self.assertEqual(list(batchRes.refCat[name]), list(loadRes.refCat[name]))
+
+    def testNumThreads(self):
+        """Searching the index files in parallel loads the same objects in the same order
+        """
+        serialLoader = LoadAstrometryNetObjectsTask(config=self.config)
+        self.config.numThreads = 4
+        parallelLoader = LoadAstrometryNetObjectsTask(config=self.config)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        cones = [(ctrCoord, 3*radius), (self.wcs.pixelToSky(afwGeom.Point2D(0, 0)), radius)]
+        for serialRes, parallelRes in zip(serialLoader.loadSkyCircles(cones, filterName="r"),
+                                          parallelLoader.loadSkyCircles(cones, filterName="r")):
+            self.assertGreater(len(serialRes.refCat), 0)
+            for name in ("id", "coord_ra", "coord_dec", "r_flux", "r_fluxErr"):
+                self.assertEqual(list(parallelRes.refCat[name]), list(serialRes.refCat[name]))
+        serialRes = serialLoader.loadPixelBox(bbox=self.bbox, wcs=self.wcs, filterName="r")
+        parallelRes = parallelLoader.loadPixelBox(bbox=self.bbox, wcs=self.wcs, filterName="r")
+        self.assertEqual(list(parallelRes.refCat["id"]), list(serialRes.refCat["id"]))
+
+    def testNumThreadsMultiIndex(self):
+        """A cone covering several multi-indexes loads the same objects in the same order in parallel
+        """
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        for andConfigFile in ("andConfig5.py", "andConfigOpenFiles.py"):
+            andConfig = AstrometryNetDataConfig()
+            andConfig.load(os.path.join(self.datapath, andConfigFile))
+            self.config.numThreads = 1
+            serialLoader = LoadAstrometryNetObjectsTask(config=self.config, andConfig=andConfig)
+            self.config.numThreads = 4
+            parallelLoader = LoadAstrometryNetObjectsTask(config=self.config, andConfig=andConfig)
+
+            # A single cone is read by solver.getCatalog
+            serialRes = serialLoader.loadSkyCircle(ctrCoord, radius, filterName="r")
+            parallelRes = parallelLoader.loadSkyCircle(ctrCoord, radius, filterName="r")
+            self.assertGreater(len(parallelLoader._getMIndexesWithinRange(ctrCoord, radius)), 1)
+            self.assertGreater(len(serialRes.refCat), 0)
+            for name in ("id", "coord_ra", "coord_dec", "r_flux"):
+                self.assertEqual(list(parallelRes.refCat[name]), list(serialRes.refCat[name]))
+
+    def testPythonThreads(self):
+        """Loaders used by concurrent Python threads load the same objects as when used serially
+        """
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        expected = LoadAstrometryNetObjectsTask(config=self.config).loadSkyCircle(ctrCoord, radius,
+                                                                                  filterName="r")
+        loaders = [LoadAstrometryNetObjectsTask(config=self.config) for _ in range(4)]
+        results = [None]*len(loaders)
+
+        def load(i):
+            results[i] = loaders[i].loadSkyCircle(ctrCoord, radius, filterName="r")
+
+        threads = [threading.Thread(target=load, args=(i,)) for i in range(len(loaders))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for loadRes in results:
+            self.assertEqual(list(loadRes.refCat["id"]), list(expected.refCat["id"]))
+
+    def testLoadColumns(self):
+        """Columns contain the same objects as the catalogs from loadSkyCircles
+        """
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        cones = [(ctrCoord, radius), (self.wcs.pixelToSky(afwGeom.Point2D(0, 0)), 0.5*radius)]
+
+        columnsList = loadANetObj.loadColumns(cones, filterName="r")
+        results = loadANetObj.loadSkyCircles(cones, filterName="r")
+        self.assertEqual(len(columnsList), len(cones))
+        self.assertEqual(len(columnsList[0]), self.desNumStarsInSkyCircle)
+        self.assertGreater(len(columnsList[1]), 0)
+
+        # A single cone goes through the same batch search
+        single = loadANetObj.loadColumns(cones[:1], filterName="r")
+        self.assertEqual(list(single[0].id), list(columnsList[0].id))
+        loadRes = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r")
+        self.assertEqual(list(single[0].id), list(loadRes.refCat["id"]))
+        for columns, res in zip(columnsList, results):
+            refCat = res.refCat
+            self.assertEqual(len(columns), len(refCat))
+            self.assertEqual(list(columns.id), list(refCat["id"]))
+            self.assertEqual(list(columns.ra), list(refCat["coord_ra"]))
+            self.assertEqual(list(columns.dec), list(refCat["coord_dec"]))
+            self.assertEqual(list(columns.photometric), list(refCat["photometric"]))
+            self.assertIn("r", columns.filterNames)
+            self.assertEqual(len(columns.getFlux("r")), len(refCat))
+            self.assertEqual(len(columns.getFluxErr("r")), len(refCat))
+
+            catalog = columns.makeCatalog()
+            self.assertTrue(catalog.isContiguous())
+            self.assertEqual(list(catalog["id"]), list(refCat["id"]))
+            self.assertEqual(list(catalog["photometric"]), list(columns.photometric))
+            self.assertFalse(catalog["hasCentroid"].any())
+            self.assertEqual(list(catalog["r_flux"]), list(columns.getFlux("r")))
+
+    def testTileCache(self):
+        """Loading through the tile cache gives the same objects as reading the index files
+        """
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+        tileConfig = LoadAstrometryNetObjectsTask.ConfigClass()
+        tileConfig.pixelMargin = self.config.pixelMargin
+        tileConfig.tileCacheNside = 64
+        tileLoader = LoadAstrometryNetObjectsTask(config=tileConfig)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        cones = [(ctrCoord, radius), (ctrCoord, 0.5*radius),
+                 (self.wcs.pixelToSky(afwGeom.Point2D(0, 0)), 0.5*radius)]
+        for coord, rad in cones:
+            expected = loadANetObj.loadSkyCircle(ctrCoord=coord, radius=rad, filterName="r").refCat
+            tileRes = tileLoader.loadSkyCircle(ctrCoord=coord, radius=rad, filterName="r")
+            self.assertEqual(tileRes.fluxField, "r_flux")
+            self.assertTrue(tileRes.refCat.isContiguous())
+            self.assertEqual(sorted(tileRes.refCat["id"]), sorted(expected["id"]))
+            tileFlux = dict(zip(tileRes.refCat["id"], tileRes.refCat["r_flux"]))
+            for recId, flux in zip(expected["id"], expected["r_flux"]):
+                self.assertEqual(tileFlux[recId], flux)
+
+        # The later cones are within the tiles read for the first
+        tileCache = tileLoader.tileCache
+        self.assertGreater(tileCache.hits, 0)
+        numTiles = len(tileCache)
+        self.assertEqual(tileCache.misses, numTiles)
+        self.assertEqual(len(tileLoader.loadSkyCircles(cones, filterName="r")), len(cones))
+        self.assertEqual(tileCache.misses, numTiles)
+
+        # A small budget evicts tiles
+        tileCache.maxBytes = tileCache.getNumBytes() - 1
+        tileCache.clear()
+        results = tileLoader.loadSkyCircles(cones, filterName="r")
+        self.assertEqual(len(results[0].refCat), self.desNumStarsInSkyCircle)
+        self.assertGreater(tileCache.evictions, 0)
+        self.assertLessEqual(tileCache.getNumBytes(), tileCache.maxBytes)
+
+    def testTileCacheDuplicates(self):
+        """The tile cache removes duplicate IDs as a direct read does
+        """
+        tileConfig = LoadAstrometryNetObjectsTask.ConfigClass()
+        tileConfig.pixelMargin = self.config.pixelMargin
+        tileConfig.tileCacheNside = 64
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+
+        # Copies of each object in many indexes: the same records are returned
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.datapath, 'andConfigOpenFiles.py'))
+        expected = LoadAstrometryNetObjectsTask(config=self.config, andConfig=andConfig).loadSkyCircle(
+            ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+        tileCat = LoadAstrometryNetObjectsTask(config=tileConfig, andConfig=andConfig).loadSkyCircle(
+            ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+        self.assertEqual(len(expected), self.desNumStarsInSkyCircle)
+        self.assertEqual(sorted(tileCat["id"]), sorted(expected["id"]))
+        tileRecords = dict((rec.getId(), rec) for rec in tileCat)
+        for rec in expected:
+            tileRec = tileRecords[rec.getId()]
+            for name in ("coord_ra", "coord_dec", "r_flux"):
+                self.assertEqual(tileRec[name], rec[name])
+
+        # Distinct objects sharing IDs (truncated magnitudes): the same IDs are returned,
+        # though objects in different tiles may be chosen differently (see ReferenceTileCache._combine)
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.datapath, 'andConfig.py'))
+        andConfig.idColumn = "r"
+        expected = LoadAstrometryNetObjectsTask(config=self.config, andConfig=andConfig).loadSkyCircle(
+            ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+        tileCat = LoadAstrometryNetObjectsTask(config=tileConfig, andConfig=andConfig).loadSkyCircle(
+            ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+        self.assertEqual(len(np.unique(tileCat["id"])), len(tileCat))
+        self.assertEqual(sorted(tileCat["id"]), sorted(expected["id"]))
+
+    def testQueryCache(self):
+        """Queries cached on disk are reused by later tasks, until the index files change
+        """
+        cacheDir = tempfile.mkdtemp()
+        try:
+            loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+            cacheConfig = LoadAstrometryNetObjectsTask.ConfigClass()
+            cacheConfig.pixelMargin = self.config.pixelMargin
+            cacheConfig.queryCacheDir = cacheDir
+
+            ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+            radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+            expected = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+
+            for numHits in (0, 1):
+                cacheLoader = LoadAstrometryNetObjectsTask(config=cacheConfig)
+                refCat = cacheLoader.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+                queryCache = cacheLoader.queryCache
+                self.assertEqual(queryCache.hits, numHits)
+                self.assertEqual(queryCache.misses, 1 - numHits)
+                self.assertEqual(list(refCat["id"]), list(expected["id"]))
+                self.assertEqual(list(refCat["r_flux"]), list(expected["r_flux"]))
+
+            # A change to the index files invalidates the cached queries
+            queryCache.fingerprint = "changed"
+            cacheLoader.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r")
+            self.assertEqual(queryCache.misses, 1)
+
+            # A small budget evicts the least recently used queries
+            numFiles = len(os.listdir(cacheDir))
+            queryCache.maxBytes = queryCache.getNumBytes() - 1
+            cacheLoader.loadSkyCircle(ctrCoord=ctrCoord, radius=0.5*radius, filterName="r")
+            self.assertLessEqual(queryCache.getNumBytes(), queryCache.maxBytes)
+            self.assertLessEqual(len(os.listdir(cacheDir)), numFiles)
+            self.assertEqual(queryCache._numBytes, queryCache.getNumBytes())
+
+            # Failure to write (here, to a removed directory) is not fatal
+            shutil.rmtree(cacheDir)
+            queryCache.put(queryCache.getKey(ctrCoord, radius), expected)
+        finally:
+            shutil.rmtree(cacheDir, ignore_errors=True)
+
+    def testPreload(self):
+        """Preloaded multi-indexes stay loaded, and are usable by forked processes
+        """
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        self.assertGreater(loadANetObj.preload(ctrCoord, radius), 0)
+        multiInds = loadANetObj.multiInds.getWithinRange(ctrCoord, radius)
+        self.assertTrue(all(mi.isPreloaded() for mi in multiInds))
+
+        loadRes = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r")
+        self.assertEqual(len(loadRes.refCat), self.desNumStarsInSkyCircle)
+        self.assertTrue(all(mi.isLoaded() for mi in multiInds))
+
+        def load(queue):
+            queue.put(len(loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius).refCat))
+
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=load, args=(queue,)) for _ in range(2)]
+        for proc in processes:
+            proc.start()
+        results = [queue.get() for _ in processes]
+        for proc in processes:
+            proc.join()
+        self.assertEqual(results, [self.desNumStarsInSkyCircle]*len(processes))
+
+    def testTagAlongFiles(self):
+        """Reading the tag-along data leaves no file open beyond those counted for the loaded multi-indexes
+        """
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.datapath, 'andConfigOpenFiles.py'))
+        self.config.maxResidentIndexes = len(andConfig.indexFiles)
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config, andConfig=andConfig)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        fd0 = ttime.count_file_descriptors()
+        loadRes = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r")
+        self.assertEqual(len(loadRes.refCat), self.desNumStarsInSkyCircle)
+        multiInds = loadANetObj.multiInds.getWithinRange(ctrCoord, radius)
+        self.assertTrue(all(mi.isLoaded() for mi in multiInds))
+        self.assertLessEqual(ttime.count_file_descriptors() - fd0, sum(mi.getNumFiles() for mi in multiInds))
 
     def testNoMagErrs(self):
         """Exclude magnitude errors from the found catalog
@@ -120,6 +455,56 @@ class TestLoadAstrometryNetObjects(unittest.TestCase):
             with self.assertRaises(KeyError):
                 schema.find(filterName + "_fluxErr")
 
+    def testProjectBands(self):
+        """Only the magnitude columns of the requested bands are read
+        """
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.datapath, 'andConfig2.py'))
+        self.config.projectBands = True
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config, andConfig=andConfig)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        for filterName, bands, expected in (("r", None, ['r']), ("r", ['g', 'r'], ['g', 'r'])):
+            loadRes = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName=filterName,
+                                                bands=bands)
+            self.assertEqual(loadRes.fluxField, "r_flux")
+            self.assertEqual(len(loadRes.refCat), self.desNumStarsInSkyCircle)
+            schema = loadRes.refCat.getSchema()
+            for band in ['u', 'g', 'r', 'i', 'z']:
+                if band in expected:
+                    schema.find(band + "_flux")
+                    schema.find(band + "_fluxErr")
+                else:
+                    with self.assertRaises(KeyError):
+                        schema.find(band + "_flux")
+
+        with self.assertRaises(RuntimeError):
+            loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r", bands=["unknown"])
+
+    def testFilterPushdown(self):
+        """Objects failing the magnitude limits and flags are not loaded
+        """
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+        refCat = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+
+        # A limit halfway between two magnitudes, so rounding cannot matter
+        mags = np.sort(np.unique(-2.5*np.log10(refCat["r_flux"]) + 31.4))
+        faint = 0.5*(mags[len(mags)//2] + mags[len(mags)//2 + 1])
+        select = (-2.5*np.log10(refCat["r_flux"]) + 31.4 < faint) & refCat["photometric"]
+        expected = sorted(refCat["id"][select])
+        self.assertGreater(len(expected), 0)
+        self.assertLess(len(expected), len(refCat))
+
+        self.config.maxMagnitude = {"r": faint}
+        self.config.requirePhotometric = True
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+        filtered = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r").refCat
+        self.assertEqual(sorted(filtered["id"]), expected)
+        self.assertTrue(filtered["photometric"].all())
+
     def testRequestForeignFilter(self):
         """The user requests a filter not in the astrometry.net catalog.
 
@@ -21,7 +21,10 @@
 #
 
 from __future__ import absolute_import, division, print_function
+import multiprocessing
 import os
+import shutil
+import tempfile
 import unittest
 
 import lsst.afw.geom as afwGeom
@@ -32,10 +35,20 @@ from astrometry.util import ttime
 from lsst.log import Log
 from lsst.meas.extensions.astrometryNet import AstrometryNetDataConfig, \
     ANetBasicAstrometryConfig, ANetBasicAstrometryTask
-from lsst.meas.extensions.astrometryNet.multiindex import generateCache
+from lsst.meas.extensions.astrometryNet.loadAstrometryNetObjects import LoadMultiIndexes
+from lsst.meas.extensions.astrometryNet.multiindex import generateCache, getCachePath, AstrometryNetCatalog, \
+    MultiIndexCache
 from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
 
 
+def readCatalogWithCache(filename):
+    """Read the catalog for a configuration file, using the cache; for multiprocessing"""
+    andConfig = AstrometryNetDataConfig()
+    andConfig.load(filename)
+    andConfig.allowCache = True
+    return [list(mi._filenameList) for mi in AstrometryNetCatalog(andConfig)]
+
+
 class MultiIndexTest(unittest.TestCase):
 
     def setUp(self):
@@ -111,18 +124,200 @@ class MultiIndexTest(unittest.TestCase):
         fn = os.path.join(self.an_data_dir, 'andConfig6.py')
         andConfig.load(fn)
         andConfig.allowCache = True
-        cacheName = os.path.join(self.an_data_dir, 'andCache.fits')
+        cacheName = getCachePath(andConfig)
         if os.path.exists(cacheName):
             os.unlink(cacheName)
         try:
             generateCache(andConfig)
             self.assertTrue(os.path.exists(cacheName))
+            self._testCacheMetadata(andConfig)
             self._testGetSolution(andConfig=andConfig)
+
+            # Regenerating the cache reuses the entries for unchanged files
+            mtime = os.stat(cacheName).st_mtime
+            generateCache(andConfig, processes=2)
+            self.assertGreaterEqual(os.stat(cacheName).st_mtime, mtime)
+            self._testCacheMetadata(andConfig)
+
+            # A cache for a different configuration is brought up to date
+            otherConfig = AstrometryNetDataConfig()
+            otherConfig.load(os.path.join(self.an_data_dir, 'andConfig5.py'))
+            otherConfig.allowCache = True
+            otherConfig.cacheDir = andConfig.cacheDir
+            catalog = AstrometryNetCatalog(otherConfig)
+            expected = [list(fnList) for fnList in zip(otherConfig.indexFiles, otherConfig.indexFiles)]
+            expected += otherConfig.multiIndexFiles
+            self.assertEqual([list(mi._filenameList) for mi in catalog], expected)
+            self._testCacheMetadata(otherConfig)
+        finally:
+            for name in (cacheName, cacheName + ".lock"):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    # The cache may be relocated, e.g., for a read-only astrometry_net_data
+    def testCacheDir(self):
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.an_data_dir, 'andConfig6.py'))
+        andConfig.allowCache = True
+        cacheDir = tempfile.mkdtemp()
+        try:
+            andConfig.cacheDir = os.path.join(cacheDir, "subdir")
+            cacheName = getCachePath(andConfig)
+            self.assertEqual(os.path.dirname(cacheName), andConfig.cacheDir)
+            generateCache(andConfig)
+            self.assertTrue(os.path.exists(cacheName))
+            self.assertFalse(os.path.exists(os.path.join(self.an_data_dir, 'andCache.fits')))
+            self._testCacheMetadata(andConfig)
+
+            # A different configuration gets its own cache
+            otherConfig = AstrometryNetDataConfig()
+            otherConfig.load(os.path.join(self.an_data_dir, 'andConfig5.py'))
+            otherConfig.cacheDir = andConfig.cacheDir
+            self.assertNotEqual(getCachePath(otherConfig), cacheName)
+        finally:
+            shutil.rmtree(cacheDir)
+
+    # A stale cache in a read-only astrometry_net_data is rebuilt in the per-user cache directory
+    def testReadOnlyCache(self):
+        if os.environ.get("ASTROMETRY_NET_CACHE_DIR"):
+            self.skipTest("ASTROMETRY_NET_CACHE_DIR overrides the cache location")
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.an_data_dir, 'andConfig6.py'))
+        andConfig.allowCache = True
+        dataCacheName = getCachePath(andConfig)
+        self.assertEqual(os.path.dirname(dataCacheName), self.an_data_dir)
+        userDir = tempfile.mkdtemp()
+        oldXdg = os.environ.get("XDG_CACHE_HOME")
+        mode = os.stat(self.an_data_dir).st_mode
+        try:
+            generateCache(andConfig)
+            os.environ["XDG_CACHE_HOME"] = userDir
+            os.chmod(self.an_data_dir, mode & ~0o222)
+            if os.access(self.an_data_dir, os.W_OK):
+                self.skipTest("Unable to make %s read-only" % (self.an_data_dir,))
+
+            # A current cache is read from astrometry_net_data
+            self.assertEqual(getCachePath(andConfig), dataCacheName)
+            self.assertNotEqual(getCachePath(andConfig, writable=True), dataCacheName)
+
+            # A stale cache is rebuilt in the per-user cache directory, and read from there
+            otherConfig = AstrometryNetDataConfig()
+            otherConfig.load(os.path.join(self.an_data_dir, 'andConfig5.py'))
+            otherConfig.allowCache = True
+            userCacheName = getCachePath(otherConfig, writable=True)
+            self.assertEqual(os.path.dirname(os.path.dirname(userCacheName)), userDir)
+            catalog = AstrometryNetCatalog(otherConfig)
+            expected = [list(fnList) for fnList in zip(otherConfig.indexFiles, otherConfig.indexFiles)]
+            expected += otherConfig.multiIndexFiles
+            self.assertEqual([list(mi._filenameList) for mi in catalog], expected)
+            self.assertTrue(os.path.exists(userCacheName))
+            self.assertEqual(getCachePath(otherConfig), userCacheName)
+            self._testCacheMetadata(otherConfig)
         finally:
-            if os.path.exists(cacheName):
-                os.unlink(cacheName)
+            os.chmod(self.an_data_dir, mode)
+            if oldXdg is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = oldXdg
+            shutil.rmtree(userDir)
+            for name in (dataCacheName, dataCacheName + ".lock"):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    # Many processes starting at once on a cold cache should produce a single valid cache
+    def testConcurrentCache(self):
+        fn = os.path.join(self.an_data_dir, 'andConfig6.py')
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(fn)
+        andConfig.allowCache = True
+        cacheName = getCachePath(andConfig)
+        if os.path.exists(cacheName):
+            os.unlink(cacheName)
+        numProcesses = 4
+        pool = multiprocessing.Pool(numProcesses)
+        try:
+            results = pool.map(readCatalogWithCache, [fn]*numProcesses)
+            expected = [list(fnList) for fnList in zip(andConfig.indexFiles, andConfig.indexFiles)]
+            expected += andConfig.multiIndexFiles
+            for result in results:
+                self.assertEqual(result, expected)
+            self.assertTrue(os.path.exists(cacheName))
+            cacheDir = os.path.dirname(cacheName)
+            self.assertEqual([name for name in os.listdir(cacheDir) if name.startswith(".andCache-")], [])
+            self._testCacheMetadata(andConfig)
+        finally:
+            pool.close()
+            pool.join()
+            for name in (cacheName, cacheName + ".lock"):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    def _testCacheMetadata(self, andConfig):
+        """The index metadata from the cache should match the indices, without loading them"""
+        cached = AstrometryNetCatalog(andConfig)
+        andConfig.allowCache = False
+        try:
+            direct = AstrometryNetCatalog(andConfig)
+        finally:
+            andConfig.allowCache = True
+        self.assertEqual(len(cached), len(direct))
+        for cachedMi, directMi in zip(cached, direct):
+            self.assertEqual(cachedMi.getFileSizes(), directMi.getFileSizes())
+            for i in range(len(cachedMi)):
+                cachedMeta = cachedMi.getMetadata(i)
+                ind = directMi[i]
+                for name in ("indexid", "healpix", "hpnside", "nstars", "nquads"):
+                    self.assertEqual(getattr(cachedMeta, name), getattr(ind, name))
+                self.assertEqual(cachedMeta.scaleLower, ind.index_scale_lower)
+                self.assertEqual(cachedMeta.scaleUpper, ind.index_scale_upper)
+            self.assertFalse(cachedMi.isLoaded())
+
+    # The spatial index must give the same results as a linear scan
+    def testWithinRange(self):
+        andConfig = AstrometryNetDataConfig()
+        fn = os.path.join(self.an_data_dir, 'andConfig5.py')
+        andConfig.load(fn)
+        catalog = AstrometryNetCatalog(andConfig)
+        for ra in range(0, 360, 15):
+            for dec in range(-90, 91, 15):
+                coord = afwGeom.SpherePoint(ra, dec, afwGeom.degrees)
+                for radius in (0.1, 1.0, 10.0, 90.0):
+                    distance = radius*afwGeom.degrees
+                    expected = [mi for mi in catalog if mi.isWithinRange(coord, distance)]
+                    self.assertEqual(catalog.getWithinRange(coord, distance), expected)
+                    self.assertEqual(catalog.getWithinRangeBatch([coord], [distance]), [expected])
+                    positions = catalog.getPositionsWithinRangeBatch([coord], [distance])
+                    self.assertEqual([[catalog[i] for i in pp] for pp in positions], [expected])
+
+    def testMissingIndexPart(self):
+        """Missing index parts of a multi-index are skipped, but a missing star file is an error
+        """
+        starFile = os.path.join(self.an_data_dir, 'index-photocal-test-stars.fits')
+        indexFile = os.path.join(self.an_data_dir, 'mindex-photocal-test.fits')
+        missingFile = os.path.join(self.an_data_dir, 'mindex-does-not-exist.fits')
+        expected = MultiIndexCache.fromFilenameList([starFile, indexFile])
+        for filenameList in ([starFile, indexFile, missingFile], [starFile, None, indexFile]):
+            mi = MultiIndexCache.fromFilenameList(filenameList)
+            self.assertEqual((mi._healpix, mi._nside), (expected._healpix, expected._nside))
+            self.assertEqual(len(mi.getFileStats()), len(filenameList))
+            # A missing file may appear later, so the metadata are not trusted
+            self.assertEqual(mi.revalidate(), missingFile not in filenameList)
+        with self.assertRaises(RuntimeError):
+            MultiIndexCache.fromFilenameList([missingFile, indexFile])
+
+    def testCloseFilesInUse(self):
+        """The files of multi-indexes in use are not closed (e.g., when another thread forks)"""
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(self.an_data_dir, 'andConfig6.py'))
+        mi = AstrometryNetCatalog(andConfig)[0]
+        with LoadMultiIndexes([mi]):
+            self.assertTrue(mi.isInUse())
+            self.assertFalse(mi.closeFiles())
+        self.assertFalse(mi.isInUse())
+        self.assertTrue(mi.closeFiles())
+        with self.assertRaises(RuntimeError):
+            mi.removeUser()
 
-    # Test that creating an Astrometry object with many index files
     # does not use up a lot of memory or file descriptors.
     # FIXME -- there are no tests on memory usage -- not clear exactly
     # what to enforce.
@@ -0,0 +1,220 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+import unittest
+
+import lsst.utils.tests
+from lsst.meas.extensions.astrometryNet.multiindex import MultiIndexResidencyPool
+from lsst.meas.extensions.astrometryNet.loadAstrometryNetObjects import LoadMultiIndexes
+
+
+class DummyMultiIndex(object):
+    """Stand-in for MultiIndexCache that records loading and unloading"""
+
+    def __init__(self, name, numBytes=100, numFiles=2):
+        self._filenameList = [name]
+        self.numBytes = numBytes
+        self.numFiles = numFiles
+        self.loaded = False
+        self.preloaded = False
+        self.numLoads = 0
+        self.numUsers = 0
+
+    def isLoaded(self):
+        return self.loaded
+
+    def isPreloaded(self):
+        return self.preloaded
+
+    def reload(self):
+        if not self.loaded:
+            self.numLoads += 1
+        self.loaded = True
+
+    def unload(self):
+        if not self.preloaded:
+            self.loaded = False
+
+    def preload(self):
+        self.reload()
+        self.preloaded = True
+
+    def addUser(self):
+        self.numUsers += 1
+
+    def removeUser(self):
+        self.numUsers -= 1
+
+    def isInUse(self):
+        return self.numUsers > 0
+
+    def getNumBytes(self):
+        return self.numBytes
+
+    def getNumFiles(self):
+        return self.numFiles
+
+
+class SlowMultiIndex(DummyMultiIndex):
+    """Stand-in for MultiIndexCache whose loading takes time (releasing the GIL, as the real one does)"""
+
+    def __init__(self, *args, **kwargs):
+        DummyMultiIndex.__init__(self, *args, **kwargs)
+        self.numLoading = 0
+        self.maxLoading = 0
+
+    def reload(self):
+        self.numLoading += 1
+        self.maxLoading = max(self.maxLoading, self.numLoading)
+        time.sleep(0.001)
+        DummyMultiIndex.reload(self)
+        self.numLoading -= 1
+
+
+class ResidencyPoolTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.multiInds = [DummyMultiIndex("mi%d" % i) for i in range(5)]
+
+    def tearDown(self):
+        del self.multiInds
+
+    def testNoResidency(self):
+        """With no budget, multi-indexes are unloaded on release"""
+        pool = MultiIndexResidencyPool()
+        for _ in range(2):
+            with LoadMultiIndexes(self.multiInds[:2], pool):
+                self.assertTrue(all(mi.isLoaded() for mi in self.multiInds[:2]))
+            self.assertFalse(any(mi.isLoaded() for mi in self.multiInds))
+        self.assertEqual(pool.hits, 0)
+        self.assertEqual(pool.misses, 4)
+        self.assertEqual(pool.evictions, 4)
+
+    def testEntryBudget(self):
+        """Least recently used multi-indexes are unloaded beyond the budget"""
+        pool = MultiIndexResidencyPool(maxEntries=2)
+        with LoadMultiIndexes(self.multiInds[:2], pool):
+            pass
+        with LoadMultiIndexes(self.multiInds[1:3], pool):
+            pass
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 3)
+        self.assertEqual(pool.evictions, 1)
+        self.assertEqual([mi.isLoaded() for mi in self.multiInds[:3]], [False, True, True])
+        self.assertEqual(self.multiInds[1].numLoads, 1)
+
+    def testPinned(self):
+        """Multi-indexes in use are not unloaded, even when over budget"""
+        pool = MultiIndexResidencyPool(maxEntries=1)
+        with LoadMultiIndexes(self.multiInds, pool):
+            self.assertTrue(all(mi.isLoaded() for mi in self.multiInds))
+            self.assertEqual(len(pool), len(self.multiInds))
+        self.assertEqual(len(pool), 1)
+        self.assertTrue(self.multiInds[-1].isLoaded())
+
+    def testPreloaded(self):
+        """Preloaded multi-indexes stay loaded and do not count against the budget"""
+        pool = MultiIndexResidencyPool(maxEntries=1)
+        self.multiInds[0].preload()
+        with LoadMultiIndexes(self.multiInds[:3], pool):
+            pass
+        self.assertTrue(self.multiInds[0].isLoaded())
+        self.assertEqual(self.multiInds[0].numLoads, 1)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 2)
+        pool.clear()
+        self.assertTrue(self.multiInds[0].isLoaded())
+
+    def testByteAndFileBudgets(self):
+        """The byte and file budgets are respected"""
+        pool = MultiIndexResidencyPool(maxEntries=10, maxBytes=250)
+        with LoadMultiIndexes(self.multiInds, pool):
+            pass
+        self.assertEqual(len(pool), 2)
+
+        pool = MultiIndexResidencyPool(maxEntries=10, maxFiles=6)
+        with LoadMultiIndexes(self.multiInds, pool):
+            pass
+        self.assertEqual(len(pool), 3)
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+        self.assertFalse(any(mi.isLoaded() for mi in self.multiInds))
+
+    def testThreads(self):
+        """Threads sharing a pool never load a multi-index twice at once, or unload one in use"""
+        pool = MultiIndexResidencyPool()
+        multiInds = [SlowMultiIndex("slow%d" % i) for i in range(2)]
+        failures = []
+
+        def load():
+            for _ in range(20):
+                with LoadMultiIndexes(multiInds, pool):
+                    time.sleep(0.001)
+                    if not all(mi.isLoaded() for mi in multiInds):
+                        failures.append("unloaded while in use")
+
+        threads = [threading.Thread(target=load) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertEqual([mi.maxLoading for mi in multiInds], [1, 1])
+        self.assertEqual(len(pool), 0)
+        self.assertFalse(any(mi.isLoaded() for mi in multiInds))
+
+    def testInUse(self):
+        """Multi-indexes are marked in use while loaded, and unmarked if loading fails"""
+        pool = MultiIndexResidencyPool()
+        with LoadMultiIndexes(self.multiInds[:2], pool):
+            self.assertEqual([mi.isInUse() for mi in self.multiInds[:3]], [True, True, False])
+        self.assertFalse(any(mi.isInUse() for mi in self.multiInds))
+
+        def fail():
+            raise RuntimeError("Unable to load")
+        self.multiInds[1].reload = fail
+        with self.assertRaises(RuntimeError):
+            with LoadMultiIndexes(self.multiInds[:2], pool):
+                pass
+        self.assertFalse(any(mi.isInUse() for mi in self.multiInds))
+        self.assertFalse(self.multiInds[0].isLoaded())
+
+    def testReleaseUnacquired(self):
+        pool = MultiIndexResidencyPool()
+        with self.assertRaises(RuntimeError):
+            pool.release(self.multiInds[0])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()